@@ -1,9 +1,6 @@
 import streamlit as st
-import requests
-from combined_improvement import run_combined_improvement  # NEW combined module
-from improvement4 import run_improvement4  # if you want to keep Improvement 4 separately
-import config
-import utils
+
+from app_pages import CHAT_ARGS, EMBEDDING_ARGS, PIPELINE_ARGS, Page, model_settings, show_pages
 
 st.set_page_config(page_title="Quran Tafsir Enricher", layout="wide")
 
@@ -27,36 +24,18 @@ with st.container():
 st.markdown("<div style='max-width: 800px; margin: auto;'>", unsafe_allow_html=True)
 
 # Model & API Setup
-model_choice = st.selectbox("🤖 Choose AI Chat Model", list(config.DEFAULT_CHAT_MODELS.keys()) + ["Custom"])
-if model_choice != "Custom":
-    chat_model = config.DEFAULT_CHAT_MODELS[model_choice]
-    api_url = chat_model["api_url"]
-    model_name = chat_model["model_name"]
-else:
-    api_url = st.text_input("🔗 Custom API Endpoint")
-    model_name = st.text_input("💬 Custom Model Name")
-
-embedding_choice = st.selectbox("🔎 Choose Embedding Model", list(config.EMBEDDING_MODELS.keys()))
-embedding_model = config.EMBEDDING_MODELS[embedding_choice]
-embedding_api_url = config.EMBEDDING_API_URL
-
-api_key = st.text_input("🔑 API Key", type="password")
-
-headers = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {api_key}"
-}
-
-# -----------------------------
-# Combined Enrichment & Thematic Splitting (Steps 1+3)
-# -----------------------------
-st.markdown("---")
-st.markdown("<h2 style='text-align: center;'>🧩 Combined Enrichment & Thematic Splitting</h2>", unsafe_allow_html=True)
-run_combined_improvement(model_name, api_url, api_key, headers)
-
-# Optionally, you can still have separate Improvement 4 for embeddings if desired:
-st.markdown("---")
-st.markdown("<h2 style='text-align: center;'>🔎 Improvement 4: Embeddings & Relationship Mapping</h2>", unsafe_allow_html=True)
-run_improvement4(embedding_model, embedding_api_url, api_key, headers)
+settings = model_settings()
+
+# Each step's module is only imported once its step is picked
+PAGES = [
+    # Combined Enrichment & Thematic Splitting (Steps 1+3)
+    Page("🧩 Combined Enrichment & Thematic Splitting", "combined_improvement", "run_combined_improvement", CHAT_ARGS),
+    Page("🔎 Improvement 4: Embeddings & Relationship Mapping", "improvement4", "run_improvement4", EMBEDDING_ARGS),
+    # All steps on one upload, without downloading and re-uploading CSVs in between
+    Page("🔗 All Steps in One Pass", "pipeline", "run_pipeline", PIPELINE_ARGS),
+    # Long runs as background jobs that survive reruns and closed browser tabs
+    Page("📨 Background Jobs", "jobs", "run_jobs", PIPELINE_ARGS),
+]
+show_pages(PAGES, settings)
 
 st.markdown("</div>", unsafe_allow_html=True)
@@ -0,0 +1,69 @@
+"""
+The steps of the Streamlit apps, loaded lazily.
+
+A Page names the module and function that render a step. The module, with pandas,
+openai, requests and the rest, is only imported when its page is opened, so an app
+starts with streamlit and config alone, and every rerun renders one step instead of
+all of them.
+"""
+import importlib
+
+import streamlit as st
+
+import config
+
+# Arguments each kind of step is rendered with (keys of model_settings())
+CHAT_ARGS = ("model_name", "api_url", "api_key", "headers")
+EMBEDDING_ARGS = ("embedding_model", "embedding_api_url", "api_key", "headers")
+PIPELINE_ARGS = CHAT_ARGS + ("embedding_model",)
+
+
+class Page:
+    """One step: its title and the function that renders it, given as module and name."""
+
+    def __init__(self, title, module, function, args=CHAT_ARGS):
+        self.title = title
+        self.module = module
+        self.function = function
+        self.args = args
+
+    def render(self, settings):
+        run = getattr(importlib.import_module(self.module), self.function)
+        run(*(settings[arg] for arg in self.args))
+
+
+def model_settings():
+    """Chat and embedding model pickers plus the API key; returns the settings the steps are rendered with."""
+    model_choice = st.selectbox("🤖 Choose AI Chat Model", list(config.DEFAULT_CHAT_MODELS.keys()) + ["Custom"])
+    if model_choice != "Custom":
+        chat_model = config.DEFAULT_CHAT_MODELS[model_choice]
+        api_url = chat_model["api_url"]
+        model_name = chat_model["model_name"]
+    else:
+        api_url = st.text_input("🔗 Custom API Endpoint")
+        model_name = st.text_input("💬 Custom Model Name")
+
+    embedding_choice = st.selectbox("🔎 Choose Embedding Model", list(config.EMBEDDING_MODELS.keys()))
+
+    api_key = st.text_input("🔑 API Key", type="password")
+
+    return {
+        "model_name": model_name,
+        "api_url": api_url,
+        "api_key": api_key,
+        "headers": {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        },
+        "embedding_model": config.EMBEDDING_MODELS[embedding_choice],
+        "embedding_api_url": config.EMBEDDING_API_URL,
+    }
+
+
+def show_pages(pages, settings, key="page"):
+    """Step picker; only the chosen step is imported and rendered."""
+    st.markdown("---")
+    title = st.radio("📑 Step", [page.title for page in pages], horizontal=True, key=key)
+    page = next(page for page in pages if page.title == title)
+    st.markdown(f"<h2 style='text-align: center;'>{page.title}</h2>", unsafe_allow_html=True)
+    page.render(settings)
@@ -0,0 +1,493 @@
+"""
+Offline micro-benchmarks for the CSV pipeline.
+
+Usage:
+    python benchmarks.py sections --sizes 10000 100000 1000000
+    python benchmarks.py chunking --megabytes 1 10 100
+    python benchmarks.py segments --paragraphs 6 60 600 --max-tokens 700
+    python benchmarks.py writeback --rows 10000 100000 1000000
+    python benchmarks.py columnar --rows 100000 1000000
+    python benchmarks.py pipeline --rows 1000 10000 --save-baseline
+    python benchmarks.py pipeline --rows 1000 10000 --latency lognormal:0.05:0.5 --rate-limit-rate 0.02
+    python benchmarks.py startup --apps app.py app1.py --reruns 10 --rows 100000
+
+The pipeline benchmark runs the stages through cli.py against a local mock_provider,
+so it needs no API key. Each size is compared with the baseline file (when one was
+saved with the same settings) and the run fails when a stage got slower, lost
+throughput or used more memory than the tolerance allows.
+
+The startup benchmark renders each Streamlit app headless (streamlit.testing) in a fresh
+interpreter: the cold start includes importing everything the app needs, reruns are
+timed after it. It also times parsing an upload against fetching it memoized.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import cli
+import config
+from columnar import read_table, write_parquet
+from combined_enrichment import apply_results, enrich_fields_for_mode
+from mock_provider import MockProvider
+from sections import SectionBuilder, section_fields, segment_commentary
+from utils import chunk_text_with_overlap, estimate_tokens, iter_token_chunks
+
+BASE_COLUMNS = ["Commentary Group", "Surah", "Verses", "Latest (English) Translation", "English Commentary"]
+
+
+def measure(fn, trace_memory=True):
+    """
+    Returns (result, seconds, peak traced MB). Timing comes from an untraced run, since
+    tracemalloc slows allocation-heavy code unevenly; peak memory from a second, traced run.
+    """
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    if not trace_memory:
+        return result, elapsed, float("nan")
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / (1024 * 1024)
+
+
+def synthetic_groups(n_sections, sections_per_group=5):
+    """Yields (group_name, base_row, sections) tuples totalling n_sections sections."""
+    made = 0
+    group = 0
+    while made < n_sections:
+        count = min(sections_per_group, n_sections - made)
+        base_row = {
+            "Commentary Group": f"G{group}",
+            "Surah": group % 114 + 1,
+            "Verses": f"{group}-{group + 3}",
+            "Latest (English) Translation": "In the name of God, the Gracious, the Merciful. " * 4,
+            "English Commentary": "Commentary text for the group. " * 40,
+        }
+        sections = [
+            {
+                "SectionNumber": i + 1,
+                "ThemeTitle": f"Theme {i + 1}",
+                "ThemeText": "Section text " * 30,
+                "ContextualQuestion": "What does this passage ask of the reader?",
+                "ThemeSummary": "A short summary of the theme.",
+                "Keywords": ["mercy", "guidance", "patience", "gratitude", "trust"],
+                "Outline": ["Point one", "Point two", "Point three"],
+            }
+            for i in range(count)
+        ]
+        yield f"G{group}", base_row, sections
+        made += count
+        group += 1
+
+
+def build_with_concat(n_sections):
+    """The previous approach: one pd.concat per section."""
+    result_df = pd.DataFrame()
+    for group_name, base_row, sections in synthetic_groups(n_sections):
+        for section in sections:
+            new_row = dict(base_row)
+            new_row.update(section_fields(group_name, section))
+            result_df = pd.concat([result_df, pd.DataFrame([new_row])], ignore_index=True)
+    return result_df
+
+
+def build_with_builder(n_sections):
+    builder = SectionBuilder(BASE_COLUMNS)
+    for group_name, base_row, sections in synthetic_groups(n_sections):
+        builder.add_group(group_name, base_row, sections)
+    return builder.to_frame()
+
+
+def bench_sections(sizes, legacy_limit):
+    print(f"{'sections':>10} {'method':>10} {'seconds':>10} {'peak MB':>10}")
+    for n in sizes:
+        frame, elapsed, peak = measure(lambda: build_with_builder(n))
+        assert len(frame) == n
+        print(f"{n:>10} {'builder':>10} {elapsed:>10.2f} {peak:>10.1f}")
+        if n <= legacy_limit:
+            frame, elapsed, peak = measure(lambda: build_with_concat(n), trace_memory=False)
+            assert len(frame) == n
+            print(f"{n:>10} {'concat':>10} {elapsed:>10.2f} {peak:>10.1f}")
+
+
+def synthetic_commentary(megabytes):
+    """Commentary-like text of roughly the given size: sentences of varied length, blank-line paragraphs."""
+    sentences = [
+        "This verse reminds the believer that mercy precedes judgement.",
+        "Patience in hardship is described as a form of gratitude, because it trusts the wisdom behind events "
+        "that we cannot yet see, and it keeps the heart from despair.",
+        "The commentators differ on the occasion of revelation.",
+        "Some say it was revealed in Makkah; others place it after the migration, pointing to its legal content.",
+    ]
+    paragraph = " ".join(sentences * 3) + "\n\n"
+    return paragraph * max(1, int(megabytes * 1024 * 1024 / len(paragraph)))
+
+
+def chunk_stats(chunks):
+    tokens = [estimate_tokens(chunk) for chunk in chunks]
+    return len(chunks), max(tokens), sum(tokens)
+
+
+def bench_chunking(sizes, max_tokens, overlap_tokens):
+    # chunk_text_with_overlap counts words; ~0.75 words per token gives it a comparable target size
+    chunk_words = int(max_tokens * 0.75)
+    print(f"{'MB':>6} {'method':>10} {'seconds':>9} {'peak MB':>9} {'chunks':>8} {'max tok':>8} {'total tok':>10}")
+    for mb in sizes:
+        text = synthetic_commentary(mb)
+        methods = [
+            ("words", lambda: chunk_text_with_overlap(text, chunk_size=chunk_words, overlap_ratio=overlap_tokens / max_tokens)),
+            ("tokens", lambda: list(iter_token_chunks(text, max_tokens=max_tokens, overlap_tokens=overlap_tokens))),
+        ]
+        for name, fn in methods:
+            chunks, elapsed, peak = measure(fn)
+            count, longest, total = chunk_stats(chunks)
+            print(f"{mb:>6} {name:>10} {elapsed:>9.2f} {peak:>9.1f} {count:>8} {longest:>8} {total:>10}")
+
+
+def bench_segments(paragraph_counts, max_tokens):
+    """
+    segment_commentary on multi-paragraph commentary: checks that it cuts the fewest segments
+    the token limit allows, of about equal size, and keeps the paragraph breaks.
+    """
+    paragraph = synthetic_commentary(0).split("\n\n")[0]
+    print(f"{'paragraphs':>10} {'seconds':>9} {'segments':>9} {'fewest':>7} {'min tok':>8} {'max tok':>8}")
+    for n in paragraph_counts:
+        text = "\n\n".join([paragraph] * n)
+        segments, elapsed, _ = measure(lambda: segment_commentary(text, max_tokens), trace_memory=False)
+        tokens = [estimate_tokens(segment) for segment in segments]
+        # Whole sentences are packed, so a segment may end up to one sentence short of the limit
+        longest = max(estimate_tokens(sentence) for sentence in paragraph.split(". "))
+        fewest = -(-estimate_tokens(text) // max_tokens)
+        assert len(segments) <= -(-estimate_tokens(text) // (max_tokens - longest)), (len(segments), fewest)
+        assert max(tokens) <= max_tokens and max(tokens) - min(tokens) <= max_tokens // 4, tokens
+        assert sum(segment.count("\n\n") for segment in segments) + len(segments) - 1 >= n - 1
+        print(f"{n:>10} {elapsed:>9.3f} {len(segments):>9} {fewest:>7} {min(tokens):>8} {max(tokens):>8}")
+
+
+def synthetic_results(n_rows, rows_per_group=5):
+    """A tafsir-like frame plus one enrichment result per Commentary Group, as the workers return them."""
+    n_groups = max(1, n_rows // rows_per_group)
+    df = pd.DataFrame({
+        "Commentary Group": [f"G{i // rows_per_group}" for i in range(n_rows)],
+        "Latest (English) Translation": "In the name of God, the Gracious, the Merciful.",
+        "English Commentary": "Commentary text for the group.",
+    })
+    fields = enrich_fields_for_mode("Run Both Together")
+    results = {
+        f"G{g}": {field: f'["{field} {g}", "second item"]' for field in fields}
+        for g in range(n_groups)
+    }
+    return df, results, fields
+
+
+def writeback_iterrows(df, results, fields):
+    """The previous approach: df.at per row and field."""
+    for field in fields:
+        df[field] = ""
+    for idx, row in df.iterrows():
+        enriched = results.get(row["Commentary Group"], {})
+        for field in fields:
+            df.at[idx, field] = enriched.get(field, "")
+    return df
+
+
+def bench_writeback(sizes, legacy_limit):
+    print(f"{'rows':>10} {'method':>10} {'seconds':>10} {'peak MB':>10}")
+    for n in sizes:
+        df, results, fields = synthetic_results(n)
+        frame, elapsed, peak = measure(lambda: apply_results(df.copy(), "Commentary Group", results, fields))
+        assert (frame[fields[0]] != "").all()
+        print(f"{n:>10} {'map':>10} {elapsed:>10.2f} {peak:>10.1f}")
+        if n <= legacy_limit:
+            frame, elapsed, peak = measure(lambda: writeback_iterrows(df.copy(), results, fields), trace_memory=False)
+            print(f"{n:>10} {'iterrows':>10} {elapsed:>10.2f} {peak:>10.1f}")
+
+
+def bench_columnar(sizes):
+    """CSV vs. Parquet output of split sections: file size, full load and a two-column load."""
+    print(f"{'rows':>10} {'format':>8} {'MB':>8} {'write s':>8} {'load s':>8} {'2 cols s':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            frame = build_with_builder(n)
+            outputs = [
+                ("csv", os.path.join(tmp, f"{n}.csv"), lambda path: frame.to_csv(path, index=False)),
+                ("parquet", os.path.join(tmp, f"{n}.parquet"), lambda path: write_parquet(frame, path)),
+            ]
+            for name, path, write in outputs:
+                _, write_seconds, _ = measure(lambda: write(path), trace_memory=False)
+                loaded, load_seconds, _ = measure(lambda: read_table(path), trace_memory=False)
+                assert len(loaded) == n
+                _, columns_seconds, _ = measure(lambda: read_table(path, columns=["SectionNumber", "Keywords"]),
+                                                trace_memory=False)
+                megabytes = os.path.getsize(path) / (1024 * 1024)
+                print(f"{n:>10} {name:>8} {megabytes:>8.1f} {write_seconds:>8.2f} {load_seconds:>8.2f} {columns_seconds:>9.2f}")
+
+
+def synthetic_tafsir(n_rows, rows_per_group=5, groups_per_chapter=20, commentary_words=400):
+    """
+    A tafsir-like input CSV frame: verse rows in Commentary Groups, the group's commentary on
+    its first row (as exported), one 'Detected Title' per chapter and a 'TEXT CHUNK' per row.
+    """
+    words = synthetic_commentary(0).split()
+    commentary = " ".join((words * (commentary_words // len(words) + 1))[:commentary_words])
+    groups = [i // rows_per_group for i in range(n_rows)]
+    return pd.DataFrame({
+        "Commentary Group": [f"G{g}" for g in groups],
+        "Surah": [g // groups_per_chapter % 114 + 1 for g in groups],
+        "Verses": [f"{i + 1}" for i in range(n_rows)],
+        "Latest (English) Translation": [f"Verse {i + 1}: In the name of God, the Gracious, the Merciful."
+                                         for i in range(n_rows)],
+        "English Commentary": [f"Group {g}. {commentary}" if i % rows_per_group == 0 else None
+                               for i, g in enumerate(groups)],
+        "Detected Title": [f"Chapter {g // groups_per_chapter + 1}" for g in groups],
+        "TEXT CHUNK": [f"Chunk {i + 1}. " + " ".join(words[i % 20:i % 20 + 60]) for i in range(n_rows)],
+    })
+
+
+def run_cli_stage(argv, verbose):
+    """Runs cli.main(argv); its progress log is only shown with --verbose or when the stage fails."""
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(sys.stderr if verbose else log):
+            cli.main(argv)
+    except SystemExit as e:
+        raise SystemExit(f"{argv[0]} failed: {e}\n{log.getvalue()}")
+
+
+def bench_pipeline(sizes, stages, provider, concurrency, trace_memory, verbose):
+    """
+    Runs each stage on its own, as 'python cli.py IN -o OUT --stages STAGE', each stage
+    reading the output of the previous one. Returns {rows: {stage: metrics}}.
+    """
+    # Register the mock like a configured model, so its limits apply instead of the custom-endpoint defaults
+    config.DEFAULT_CHAT_MODELS["Mock provider"] = {
+        "api_url": provider.chat_url, "model_name": "mock",
+        "max_concurrency": concurrency, "requests_per_minute": 60 * 1000 * concurrency,
+    }
+    results = {}
+    print(f"{'rows':>9} {'stage':>9} {'rows out':>9} {'seconds':>8} {'requests':>9} {'errors':>7} "
+          f"{'req/s':>8} {'peak MB':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            path = os.path.join(tmp, f"tafsir-{n}.csv")
+            synthetic_tafsir(n).to_csv(path, index=False)
+            results[str(n)] = {}
+            for stage in stages:
+                out_path = os.path.join(tmp, f"{stage}-{n}.csv")
+                report = os.path.join(tmp, f"{stage}-{n}-report")
+                argv = [path, "-o", out_path, "--stages", stage, "--api-url", provider.chat_url,
+                        "--model-name", "mock", "--api-key", "mock", "--embedding-api-url", provider.base_url,
+                        "--embedding-workers", str(concurrency), "--no-cache", "--no-resume", "--report", report]
+                started = time.perf_counter()
+                run_cli_stage(argv, verbose)
+                elapsed = time.perf_counter() - started
+                with open(report + ".json", encoding="utf-8") as f:
+                    metrics = json.load(f)["stages"][stage]
+                peak = float("nan")
+                if trace_memory:
+                    # As in measure(): tracemalloc slows the stage down, so the peak comes from a second run
+                    tracemalloc.start()
+                    run_cli_stage(argv, verbose)
+                    peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                    tracemalloc.stop()
+                rows_out = len(pd.read_csv(out_path, usecols=[0]))
+                results[str(n)][stage] = {
+                    "seconds": round(elapsed, 3),
+                    "requests": metrics["requests"],
+                    "errors": metrics["errors"],
+                    "requests_per_sec": round(metrics["requests"] / elapsed, 3) if elapsed > 0 else 0.0,
+                    "peak_mb": round(peak, 1),
+                }
+                r = results[str(n)][stage]
+                print(f"{n:>9} {stage:>9} {rows_out:>9} {r['seconds']:>8.2f} {r['requests']:>9} {r['errors']:>7} "
+                      f"{r['requests_per_sec']:>8.1f} {r['peak_mb']:>8.1f}")
+                path = out_path
+    return results
+
+
+def find_regressions(results, baseline, tolerance, slack_seconds=0.5):
+    """
+    Messages for every stage that is slower, has lower throughput or a higher memory peak
+    than its baseline by more than 'tolerance' (a fraction). Timings also get an absolute
+    'slack_seconds', so sub-second stages do not fail on noise.
+    """
+    problems = []
+    for rows, stages in results.items():
+        for stage, metrics in stages.items():
+            base = baseline.get(rows, {}).get(stage)
+            if not base:
+                continue
+            label = f"{rows} rows / {stage}"
+            if metrics["seconds"] > base["seconds"] * (1 + tolerance) + slack_seconds:
+                problems.append(f"{label}: {metrics['seconds']:.2f}s vs. baseline {base['seconds']:.2f}s")
+            if metrics["requests"] and base["requests"] and \
+                    metrics["requests_per_sec"] < base["requests_per_sec"] * (1 - tolerance) \
+                    and metrics["seconds"] > base["seconds"] + slack_seconds:
+                problems.append(f"{label}: {metrics['requests_per_sec']:.1f} req/s vs. baseline "
+                                f"{base['requests_per_sec']:.1f} req/s")
+            if metrics["peak_mb"] == metrics["peak_mb"] and base["peak_mb"] == base["peak_mb"] \
+                    and metrics["peak_mb"] > base["peak_mb"] * (1 + tolerance):
+                problems.append(f"{label}: peak {metrics['peak_mb']:.1f} MB vs. baseline {base['peak_mb']:.1f} MB")
+    return problems
+
+
+def pipeline_benchmark(args):
+    settings = {
+        "stages": args.stages, "latency": args.latency, "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate, "truncate_rate": args.truncate_rate,
+        "concurrency": args.concurrency, "memory": args.memory,
+    }
+    provider = MockProvider(latency=args.latency, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                            truncate_rate=args.truncate_rate, seed=0)
+    with provider:
+        results = bench_pipeline(args.rows, args.stages, provider, args.concurrency, args.memory, args.verbose)
+    print("mock provider: " + " · ".join(f"{key} {value}" for key, value in sorted(provider.stats.items())))
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"settings": settings, "results": results}, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+    if baseline is None:
+        print(f"No baseline at {args.baseline} (save one with --save-baseline)")
+        return
+    if baseline.get("settings") != settings:
+        print(f"Baseline {args.baseline} was recorded with other settings, not comparing: {baseline.get('settings')}")
+        return
+    problems = find_regressions(results, baseline["results"], args.tolerance)
+    if problems:
+        raise SystemExit("Regressions against the baseline:\n  " + "\n  ".join(problems))
+    print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+# Run in a fresh interpreter by bench_startup(), so the cold start pays for every import
+STARTUP_SCRIPT = """
+import json, statistics, sys, time
+from streamlit.testing.v1 import AppTest
+loaded = set(sys.modules)
+app = AppTest.from_file(sys.argv[1], default_timeout=120)
+started = time.perf_counter()
+app.run()
+cold = time.perf_counter() - started
+imported = [name for name in set(sys.modules) - loaded if "." not in name]
+reruns = []
+for _ in range(int(sys.argv[2])):
+    started = time.perf_counter()
+    app.run()
+    reruns.append(time.perf_counter() - started)
+print(json.dumps({
+    "cold_start_sec": cold,
+    "rerun_sec": statistics.median(reruns) if reruns else float("nan"),
+    "modules": sorted(imported),
+    "errors": [str(e.value) for e in app.exception],
+}))
+"""
+
+
+def bench_startup(apps, reruns, rows):
+    """Cold start and median rerun time of each app, then parsing an upload vs. the memoized parse."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    heavy = {"pandas", "numpy", "pyarrow", "openai", "requests"}
+    print(f"{'app':>12} {'cold s':>8} {'rerun s':>8} {'modules':>8}  heavy modules loaded")
+    for app in apps:
+        out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, app, str(reruns)], cwd=here,
+                             capture_output=True, text=True)
+        if out.returncode:
+            raise SystemExit(f"{app} failed to start:\n{out.stderr}")
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        if r["errors"]:
+            raise SystemExit(f"{app} raised: {r['errors']}")
+        loaded = ", ".join(sorted(heavy & set(r["modules"]))) or "-"
+        print(f"{app:>12} {r['cold_start_sec']:>8.2f} {r['rerun_sec']:>8.3f} {len(r['modules']):>8}  {loaded}")
+
+    if rows:
+        from uploads import read_upload
+
+        upload = io.BytesIO(synthetic_tafsir(rows).to_csv(index=False).encode("utf-8"))
+        upload.name = "tafsir.csv"
+        parse = measure(lambda: read_table(io.BytesIO(upload.getvalue())), trace_memory=False)
+        read_upload(upload)
+        memoized = measure(lambda: read_upload(upload), trace_memory=False)
+        print(f"upload of {rows} rows: parsed in {parse[1]:.3f}s, memoized in {memoized[1]:.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = sub.add_parser("sections", help="SectionBuilder vs. per-section pd.concat")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    p.add_argument("--legacy-limit", type=int, default=2_000,
+                   help="largest size to also time with pd.concat (quadratic, so keep this small)")
+
+    p = sub.add_parser("chunking", help="iter_token_chunks vs. word-count chunk_text_with_overlap")
+    p.add_argument("--megabytes", type=float, nargs="+", default=[1, 10, 100])
+    p.add_argument("--max-tokens", type=int, default=400)
+    p.add_argument("--overlap-tokens", type=int, default=40)
+
+    p = sub.add_parser("segments", help="segment_commentary: segment count, sizes and paragraph breaks")
+    p.add_argument("--paragraphs", type=int, nargs="+", default=[6, 60, 600])
+    p.add_argument("--max-tokens", type=int, default=config.SPLIT_SEGMENT_TOKENS)
+
+    p = sub.add_parser("writeback", help="group results mapped onto rows vs. df.iterrows/df.at")
+    p.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    p.add_argument("--legacy-limit", type=int, default=20_000,
+                   help="largest size to also time with iterrows (slow, so keep this small)")
+
+    p = sub.add_parser("columnar", help="CSV vs. Parquet output: size, load time, column-subset load time")
+    p.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+
+    p = sub.add_parser("pipeline", help="stages end to end against a local mock provider, with a regression check")
+    p.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000])
+    p.add_argument("--stages", nargs="+", choices=cli.STAGES, default=cli.STAGES)
+    p.add_argument("--latency", default="fixed:0.02", help="mock latency spec (see mock_provider.py)")
+    p.add_argument("--error-rate", type=float, default=0.0)
+    p.add_argument("--rate-limit-rate", type=float, default=0.0)
+    p.add_argument("--truncate-rate", type=float, default=0.0)
+    p.add_argument("--concurrency", type=int, default=16, help="requests in flight (chat and embeddings)")
+    p.add_argument("--memory", action="store_true",
+                   help="also record each stage's peak traced memory (runs every stage a second time)")
+    p.add_argument("--baseline", default=config.BENCHMARK_BASELINE, help="baseline file to compare with or save")
+    p.add_argument("--save-baseline", action="store_true", help="record this run as the new baseline")
+    p.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown/extra memory as a fraction")
+    p.add_argument("--verbose", action="store_true", help="show the CLI's progress log")
+
+    p = sub.add_parser("startup", help="Streamlit app cold start and rerun time, and memoized upload parsing")
+    p.add_argument("--apps", nargs="+", default=["app.py", "app1.py"])
+    p.add_argument("--reruns", type=int, default=10)
+    p.add_argument("--rows", type=int, default=100_000, help="rows of the upload to parse (0 to skip)")
+
+    args = parser.parse_args()
+    if args.benchmark == "sections":
+        bench_sections(args.sizes, args.legacy_limit)
+    elif args.benchmark == "chunking":
+        bench_chunking(args.megabytes, args.max_tokens, args.overlap_tokens)
+    elif args.benchmark == "segments":
+        bench_segments(args.paragraphs, args.max_tokens)
+    elif args.benchmark == "writeback":
+        bench_writeback(args.rows, args.legacy_limit)
+    elif args.benchmark == "columnar":
+        bench_columnar(args.rows)
+    elif args.benchmark == "pipeline":
+        pipeline_benchmark(args)
+    elif args.benchmark == "startup":
+        bench_startup(args.apps, args.reruns, args.rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import contextvars
+import email.utils
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+from dispatch import provider_limits
+from instrumentation import count, current_recorder
+from response_cache import cache_key, get_cache
+
+# Status codes worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# The routing.Router requests go through while one is activated, and the provider that answered
+# the last routed request made in this context
+CURRENT_ROUTER = contextvars.ContextVar("csvimprove_router", default=None)
+ANSWERED_BY = contextvars.ContextVar("csvimprove_answered_by", default=None)
+
+
+def retry_after_seconds(response):
+    """Parses a Retry-After header (seconds or HTTP date); None when absent or unparseable."""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ChatClient:
+    """
+    Pooled HTTP client shared by every stage.
+
+    One requests.Session keeps TCP/TLS connections alive across requests. Each
+    provider (API URL) gets a semaphore sized from its max_concurrency in
+    config.DEFAULT_CHAT_MODELS, so concurrent stages together never exceed it.
+    429 and 5xx responses, timeouts and connection errors are retried with
+    exponential backoff and jitter, honoring Retry-After when the server sends it.
+    Every request is reported to the active instrumentation.RunRecorder.
+    """
+
+    def __init__(self, max_retries=config.CHAT_MAX_RETRIES, backoff_base=config.CHAT_BACKOFF_BASE,
+                 backoff_max=config.CHAT_BACKOFF_MAX, pool_size=32):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def provider_slot(self, api_url):
+        with self._lock:
+            if api_url not in self._semaphores:
+                self._semaphores[api_url] = threading.BoundedSemaphore(provider_limits(api_url)["max_concurrency"])
+            return self._semaphores[api_url]
+
+    def backoff(self, attempt, response=None):
+        delay = retry_after_seconds(response)
+        if delay is None:
+            delay = self.backoff_base * 2 ** attempt + random.uniform(0, self.backoff_base)
+        return min(self.backoff_max, delay)
+
+    def send(self, api_url, headers, payload, timeout=90, stream=False, max_retries=None):
+        """
+        Posts a payload with retries and returns (response, retries, started). The provider
+        slot is still held on return; callers release it once the body has been read.
+        'max_retries' overrides the client's setting (the router uses 0 and fails over instead).
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        slot = self.provider_slot(api_url)
+        for attempt in range(max_retries + 1):
+            response, error = None, None
+            started = time.perf_counter()
+            slot.acquire()
+            try:
+                response = self.session.post(api_url, headers=headers, json=payload, timeout=timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except BaseException:
+                slot.release()
+                raise
+            if response is not None and response.status_code < 400:
+                return response, attempt, started
+            slot.release()
+
+            status = response.status_code if response is not None else type(error).__name__
+            retryable = response is None or response.status_code in RETRY_STATUSES
+            if not retryable or attempt == max_retries:
+                current_recorder().record_request(payload.get("model"), time.perf_counter() - started, status, retries=attempt)
+                if error is not None:
+                    raise error
+                response.raise_for_status()
+            time.sleep(self.backoff(attempt, response))
+
+    def post(self, api_url, headers, payload, timeout=90, max_retries=None):
+        """Posts a chat-completion payload with retries; returns the decoded JSON reply."""
+        response, retries, started = self.send(api_url, headers, payload, timeout, max_retries=max_retries)
+        try:
+            reply = response.json()
+        finally:
+            self.provider_slot(api_url).release()
+        usage = reply.get("usage") or {}
+        current_recorder().record_request(
+            payload.get("model"), time.perf_counter() - started, response.status_code,
+            usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), retries
+        )
+        return reply
+
+    def stream(self, api_url, headers, payload, timeout=90, max_retries=None):
+        """
+        Posts with "stream": true and yields (content_delta, finish_reason) per server-sent
+        event. The provider slot is held until the stream ends or the generator is closed.
+        """
+        stream_payload = dict(payload, stream=True, stream_options={"include_usage": True})
+        response, retries, started = self.send(api_url, headers, stream_payload, timeout, stream=True,
+                                               max_retries=max_retries)
+        usage = {}
+        try:
+            response.encoding = "utf-8"
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                event = json.loads(data)
+                usage = event.get("usage") or usage
+                for choice in event.get("choices", []):
+                    delta = (choice.get("delta") or {}).get("content") or ""
+                    yield delta, choice.get("finish_reason")
+        finally:
+            response.close()
+            self.provider_slot(api_url).release()
+            current_recorder().record_request(
+                payload.get("model"), time.perf_counter() - started, response.status_code,
+                usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), retries
+            )
+
+
+class StreamedReply:
+    """
+    Iterable over the content deltas of a streamed completion. Once fully read, 'text'
+    holds the whole reply and 'finish_reason' the model's stop reason (e.g. "length").
+    """
+
+    def __init__(self, api_url, headers, payload, timeout=90):
+        self.args = (api_url, headers, payload, timeout)
+        self.text = ""
+        self.finish_reason = None
+
+    def __iter__(self):
+        parts = []
+        router = current_router(self.args[0])
+        events = router.stream(*self.args[2:]) if router else get_client().stream(*self.args)
+        try:
+            for delta, finish_reason in events:
+                if finish_reason:
+                    self.finish_reason = finish_reason
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            self.text = "".join(parts)
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def get_client():
+    """Process-wide client, so every stage shares one connection pool and one set of provider limits."""
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = ChatClient()
+        return _default_client
+
+
+def current_router(api_url):
+    """The activated router, if it covers 'api_url' (the endpoint the stage was configured with)."""
+    router = CURRENT_ROUTER.get()
+    return router if router is not None and router.handles(api_url) else None
+
+
+def answered_by():
+    """Provider that answered this context's last routed request ("cache" for a cached reply); None without routing."""
+    return ANSWERED_BY.get()
+
+
+def mark_cached(api_url):
+    """Records a cached reply as the answer to a routed request."""
+    if current_router(api_url) is not None:
+        ANSWERED_BY.set("cache")
+
+
+def answered_cache_key(api_url, payload):
+    """
+    Cache key for a reply that was just received: that of the provider and model that
+    answered it, which under routing may not be the ones 'api_url' and the payload name.
+    Otherwise a later run with the primary model would be served another model's reply.
+    """
+    router = current_router(api_url)
+    provider = router.provider(answered_by()) if router is not None else None
+    if provider is None:
+        return request_cache_key(api_url, payload)
+    return request_cache_key(provider.api_url, dict(payload, model=provider.model_name))
+
+
+def request_cache_key(api_url, payload):
+    """Response-cache key of a chat payload; streamed and plain requests for the same prompt share it."""
+    return cache_key(
+        payload.get("model"),
+        api_url,
+        json.dumps(payload["messages"], ensure_ascii=False),
+        payload.get("temperature"),
+        payload.get("max_tokens"),
+    )
+
+
+def chat_completion(api_url, headers, payload, timeout=90, use_cache=True, parse=None):
+    """
+    Posts a chat-completion payload and returns the reply text.
+
+    Identical requests are answered from the shared response cache. When 'parse'
+    is given the reply is passed through it and the parsed value is returned;
+    replies that fail to parse raise and are never cached. While a router covering
+    'api_url' is activated, the request goes through it (see routing.Router).
+    """
+    cache = get_cache()
+    key = None
+    if use_cache and cache.enabled:
+        key = request_cache_key(api_url, payload)
+        cached = cache.get(key)
+        count("cache_hits" if cached is not None else "cache_misses")
+        if cached is not None:
+            mark_cached(api_url)
+            return parse(cached) if parse else cached
+
+    router = current_router(api_url)
+    if router is not None:
+        reply, provider = router.post(payload, timeout=timeout)
+        ANSWERED_BY.set(provider)
+    else:
+        reply = get_client().post(api_url, headers, payload, timeout=timeout)
+    content = reply["choices"][0]["message"]["content"]
+    try:
+        result = parse(content) if parse else content
+    except Exception:
+        count("parse_failures")
+        raise
+    if key:
+        cache.set(answered_cache_key(api_url, payload), content)
+    return result
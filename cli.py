@@ -0,0 +1,374 @@
+"""
+Headless runner for the enrichment pipeline, for long jobs on servers.
+
+Runs one or more stages in order on a CSV file, passing the data from stage to
+stage in memory, and writes the result of the last stage:
+
+    python cli.py data.csv -o enriched.csv --stages enrich split embed
+    python cli.py big.csv -o enriched.csv --stages enrich --stream --concurrency 8
+    python cli.py data.csv -o enriched.csv --stages enrich split embed --fused
+
+Stages: enrich (combined enrichment), split (thematic splitting), embed
+(embeddings + related sections) and chapters (chapter & chunk enrichment).
+The API key is read from --api-key or the CSVIMPROVE_API_KEY environment variable.
+"""
+import argparse
+import hashlib
+import os
+import sys
+import time
+from contextlib import nullcontext
+
+import config
+from columnar import is_parquet, read_columns, read_table, write_parquet
+from combined_enrichment import MODES, enrich_csv_stream, enrich_dataframe, resolve_columns
+from dedupe import RequestPlan
+from dispatch import provider_limits
+from embedding_store import save_embeddings
+from fingerprints import FingerprintManifest
+from instrumentation import RunRecorder
+from improvement3 import split_csv_stream, split_dataframe
+from improvement4 import add_embeddings, add_relationships, configure_openai, embeddings_to_json, row_ids_for
+from improvement5 import enrich_chapters_and_chunks
+from pipeline import Pipeline
+from response_cache import get_cache
+from routing import Router
+from run_journal import RunJournal, journal_path
+
+STAGES = ["enrich", "split", "embed", "chapters"]
+EMBEDDING_FORMATS = {"csv": None, "npy": ("npy", "float32"), "npy16": ("npy", "float16"), "parquet": ("parquet", "float32")}
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="input CSV or .parquet path")
+    parser.add_argument("-o", "--output", required=True,
+                        help="output CSV path, or a .parquet path for Parquet with list columns (needs pyarrow)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=["enrich"], help="stages to run, in order")
+
+    chat = parser.add_argument_group("chat model")
+    chat.add_argument("--model", choices=list(config.DEFAULT_CHAT_MODELS), default=next(iter(config.DEFAULT_CHAT_MODELS)),
+                      help="configured chat model (ignored when --api-url is given)")
+    chat.add_argument("--api-url", help="custom chat-completions endpoint")
+    chat.add_argument("--model-name", help="model name for a custom endpoint")
+    chat.add_argument("--api-key", default=os.environ.get("CSVIMPROVE_API_KEY", ""))
+    chat.add_argument("--mode", choices=list(MODES), default="both", help="what the enrich stage extracts")
+
+    run = parser.add_argument_group("execution")
+    run.add_argument("--concurrency", type=int, help="max chat requests in flight (default: provider limit)")
+    run.add_argument("--no-cache", action="store_true", help="bypass the on-disk response cache")
+    run.add_argument("--no-resume", action="store_true", help="ignore run journals and start the split stage over")
+    run.add_argument("--stream", action="store_true",
+                     help="read the input in chunks and write output incrementally (single enrich or split stage; "
+                          "input must be sorted by its group column)")
+
+    run.add_argument("--fused", action="store_true",
+                     help="run the stages as one pipeline: each group moves on to the next stage as soon as it is "
+                          "done, so later stages start before earlier ones finish")
+    run.add_argument("--route", action="store_true",
+                     help="route chat requests across all configured models: hedge slow requests and fail over on "
+                          "errors (other providers need their key in the api_key_env variable named in config.py); "
+                          "adds a Provider column")
+    run.add_argument("--no-dedupe", action="store_true",
+                     help="send one request per group even when groups have identical commentary")
+    run.add_argument("--report", metavar="PATH",
+                     help="write the run report to PATH.json and PATH.csv (default: under the runs directory)")
+    run.add_argument("--incremental", action="store_true",
+                     help="single enrich or split stage: only request groups that changed since the previous "
+                          "output at -o (tracked in a .manifest.json beside it)")
+    run.add_argument("--stream-replies", action="store_true",
+                     help="split stage: stream model replies, continuing cut-off replies instead of redoing them")
+    run.add_argument("--no-segment", action="store_true",
+                     help="split stage: send long commentary in one request instead of cutting it into segments "
+                          "that are split in parallel")
+    run.add_argument("--no-chunk-batching", action="store_true",
+                     help="chapters stage: send one request per text chunk instead of packing several per request")
+
+    emb = parser.add_argument_group("embeddings")
+    emb.add_argument("--embedding-model", choices=list(config.EMBEDDING_MODELS), default=next(iter(config.EMBEDDING_MODELS)))
+    emb.add_argument("--embedding-api-key", default=os.environ.get("OPENAI_API_KEY"),
+                     help="OpenAI key for embeddings (default: OPENAI_API_KEY, then --api-key)")
+    emb.add_argument("--embedding-api-url", default=config.EMBEDDING_API_URL,
+                     help="embeddings API base URL (e.g. a local mock_provider)")
+    emb.add_argument("--embedding-workers", type=int, default=config.EMBEDDING_MAX_WORKERS)
+    emb.add_argument("--embedding-format", choices=list(EMBEDDING_FORMATS), default="csv",
+                     help="csv keeps vectors in the output (JSON text in a CSV, a float list column in a .parquet "
+                          "output); npy/npy16/parquet write a matrix next to the output")
+    emb.add_argument("--top-k", type=int, default=5, help="related sections per row (0 disables relationship mapping)")
+
+    args = parser.parse_args(argv)
+    if args.stream and (len(args.stages) != 1 or args.stages[0] not in ("enrich", "split")):
+        parser.error("--stream supports a single 'enrich' or 'split' stage")
+    if args.incremental and (len(args.stages) != 1 or args.stages[0] not in ("enrich", "split")):
+        parser.error("--incremental supports a single 'enrich' or 'split' stage")
+    if args.fused and (args.stream or args.incremental):
+        parser.error("--fused cannot be combined with --stream or --incremental")
+    if args.api_url and not args.model_name:
+        parser.error("--api-url requires --model-name")
+    return args
+
+
+def chat_settings(args):
+    if args.api_url:
+        api_url, model_name = args.api_url, args.model_name
+    else:
+        chat_model = config.DEFAULT_CHAT_MODELS[args.model]
+        api_url, model_name = chat_model["api_url"], chat_model["model_name"]
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {args.api_key}"
+    }
+    limits = provider_limits(api_url)
+    request_options = dict(
+        max_workers=args.concurrency or limits["max_concurrency"],
+        requests_per_minute=limits["requests_per_minute"],
+        use_cache=not args.no_cache,
+    )
+    return model_name, api_url, headers, request_options
+
+
+def report_group(i, job, result, error, latency):
+    if error is not None:
+        log(f"  ! group {job[0]} failed: {error}")
+    elif (i + 1) % 50 == 0:
+        log(f"  {i + 1} groups done")
+
+
+def report_split(group_name, status, sections, error):
+    if status == "failed":
+        log(f"  ! group {group_name} failed: {error}")
+
+
+def report_stats(stats):
+    if stats.get("reused"):
+        log(f"  {stats['reused']} unchanged groups carried over from the previous output")
+    if stats.get("shared"):
+        log(f"  {stats['shared']} groups shared the request of a group with identical input")
+    log(f"  {stats['items']} groups in {stats['elapsed_sec']}s · {stats['items_per_sec']} groups/sec · "
+        f"p50 {stats['p50_latency_sec']}s · p95 {stats['p95_latency_sec']}s")
+
+
+def split_journal(args, stage_input, model_name):
+    """Run journal for the split stage, keyed on the input file (hashed in blocks) or an in-memory frame."""
+    if isinstance(stage_input, str):
+        digest = hashlib.sha256()
+        with open(stage_input, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        key = digest.hexdigest().encode("ascii")
+    else:
+        key = stage_input.to_csv(index=False).encode("utf-8")
+    journal = RunJournal(journal_path("cli-split", key, model_name))
+    if args.no_resume:
+        journal.clear()
+    return journal
+
+
+def output_manifest(args):
+    """Fingerprint manifest beside the output, shared with the UI stages that write the same kind of output."""
+    if not args.incremental:
+        return None
+    return FingerprintManifest(args.output, "combined_enrichment" if args.stages[0] == "enrich" else "improvement3")
+
+
+def request_plan(args):
+    """Plan that shares one request among the groups of a stage with identical input, unless --no-dedupe."""
+    return None if args.no_dedupe else RequestPlan()
+
+
+def segment_tokens(args):
+    """Segment size for long commentary in the split stage, None with --no-segment."""
+    return None if args.no_segment else config.SPLIT_SEGMENT_TOKENS
+
+
+def report_plan(plan):
+    if plan:
+        log(f"  {plan.summary_line()}")
+
+
+def run_streaming(args, model_name, api_url, headers, request_options, recorder):
+    stage = args.stages[0]
+    manifest = output_manifest(args)
+    with recorder.stage(stage):
+        stream_stage(args, stage, manifest, model_name, api_url, headers, request_options)
+
+
+def stream_stage(args, stage, manifest, model_name, api_url, headers, request_options):
+    plan = request_plan(args)
+    if stage == "enrich":
+        columns = read_columns(args.input).str.strip()
+        col_map = resolve_columns(columns)
+        rows, stats = enrich_csv_stream(
+            args.input, args.output, col_map, MODES[args.mode], model_name, api_url, headers,
+            on_result=report_group, manifest=manifest, plan=plan, **request_options
+        )
+        report_stats(stats)
+    else:
+        journal = split_journal(args, args.input, model_name)
+        rows, counts = split_csv_stream(
+            args.input, args.output, model_name, api_url, headers,
+            use_cache=request_options["use_cache"], journal=journal, on_group=report_split,
+            stream=args.stream_replies, manifest=manifest, plan=plan, segment_tokens=segment_tokens(args)
+        )
+        log(f"  groups: {counts}")
+    report_plan(plan)
+    if manifest:
+        manifest.save()
+    log(f"{rows} rows written to {args.output}")
+
+
+def run_stage(args, stage, df, manifest, model_name, api_url, headers, request_options):
+    """Runs one stage on df and returns the resulting frame."""
+    plan = request_plan(args)
+    if stage == "enrich":
+        df.columns = df.columns.str.strip()
+        col_map = resolve_columns(df.columns)
+        missing = [k for k, v in col_map.items() if v not in df.columns]
+        if missing:
+            raise SystemExit(f"Missing columns for enrich: {missing}")
+        df, stats = enrich_dataframe(
+            df, col_map, MODES[args.mode], model_name, api_url, headers, on_result=report_group,
+            manifest=manifest, plan=plan, **request_options
+        )
+        report_stats(stats)
+        report_plan(plan)
+    elif stage == "split":
+        stage_input = args.input if stage == args.stages[0] else df
+        journal = split_journal(args, stage_input, model_name)
+        df, counts = split_dataframe(
+            df, model_name, api_url, headers,
+            use_cache=request_options["use_cache"], journal=journal, on_group=report_split,
+            stream=args.stream_replies, manifest=manifest, plan=plan, segment_tokens=segment_tokens(args)
+        )
+        log(f"  groups: {counts}")
+        report_plan(plan)
+    elif stage == "embed":
+        if "ThemeText" not in df.columns:
+            raise SystemExit("The embed stage needs a 'ThemeText' column (run 'split' first)")
+        configure_openai(args.embedding_api_key or args.api_key, args.embedding_api_url)
+        df = add_embeddings(
+            df, config.EMBEDDING_MODELS[args.embedding_model], max_workers=args.embedding_workers,
+            on_batch=lambda done, total, latency: log(f"  batch {done}/{total} ({latency:.1f}s)"), on_error=log
+        )
+        if args.top_k > 0:
+            df, _ = add_relationships(df, top_k=args.top_k)
+    elif stage == "chapters":
+        df = enrich_chapters_and_chunks(
+            df, model_name, api_url, headers, use_cache=request_options["use_cache"],
+            batch_chunks=not args.no_chunk_batching, max_workers=request_options["max_workers"],
+            requests_per_minute=request_options["requests_per_minute"], on_error=log
+        )
+    return df
+
+
+def run_stages(args, model_name, api_url, headers, request_options, recorder):
+    manifest = output_manifest(args)
+    df = read_table(args.input)
+    log(f"Loaded {len(df)} rows from {args.input}")
+    for stage in args.stages:
+        started = time.perf_counter()
+        log(f"▶ {stage}")
+        with recorder.stage(stage):
+            df = run_stage(args, stage, df, manifest, model_name, api_url, headers, request_options)
+        log(f"  {stage} finished in {time.perf_counter() - started:.1f}s ({len(df)} rows)")
+    write_output(args, df, manifest)
+
+
+def run_fused(args, model_name, api_url, headers, request_options):
+    df = read_table(args.input)
+    log(f"Loaded {len(df)} rows from {args.input}")
+    df.columns = df.columns.str.strip()
+    if "embed" in args.stages:
+        configure_openai(args.embedding_api_key or args.api_key, args.embedding_api_url)
+    pipeline = Pipeline(
+        args.stages, model_name, api_url, headers, mode=MODES[args.mode],
+        embedding_model=config.EMBEDDING_MODELS[args.embedding_model], embedding_workers=args.embedding_workers,
+        top_k=args.top_k, batch_chunks=not args.no_chunk_batching, stream_replies=args.stream_replies,
+        on_warning=lambda message: log(f"  ! {message}"), dedupe=not args.no_dedupe,
+        segment_tokens=segment_tokens(args), **request_options
+    )
+    started = time.perf_counter()
+    finished = []
+
+    def report_frame(frame):
+        finished.append(len(frame))
+        if len(finished) % 50 == 0:
+            log("  " + " · ".join(f"{stage} {pipeline.progress[stage]} rows" for stage in args.stages))
+
+    log(f"▶ {' → '.join(args.stages)}")
+    try:
+        df = pipeline.run_frame(df, on_frame=report_frame)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    log(f"  pipeline finished in {time.perf_counter() - started:.1f}s ({len(df)} rows)")
+    for stage, plan in pipeline.plans.items():
+        log(f"  [{stage}] {plan.summary_line()}")
+    write_output(args, df)
+
+
+def write_output(args, df, manifest=None):
+    if "Embedding" in df.columns:
+        binary_output = EMBEDDING_FORMATS[args.embedding_format]
+        if binary_output:
+            fmt, dtype = binary_output
+            base_path = os.path.splitext(args.output)[0] + ".embeddings"
+            paths = save_embeddings(base_path, df["Embedding"].tolist(), row_ids_for(df), dtype=dtype, fmt=fmt)
+            log(f"Embeddings written to {', '.join(paths)}")
+            df = df.drop(columns=["Embedding"])
+        elif not is_parquet(args.output):
+            df = embeddings_to_json(df)
+
+    if is_parquet(args.output):
+        # Row groups by Commentary Group (or the verse group column when there is none)
+        group_col = "Commentary Group" if "Commentary Group" in df.columns else resolve_columns(df.columns)["Verse Group"]
+        write_parquet(df, args.output, group_col)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        df.to_csv(args.output, index=False)
+    if manifest:
+        manifest.save()
+    log(f"{len(df)} rows written to {args.output}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    model_name, api_url, headers, request_options = chat_settings(args)
+    cache_snapshot = get_cache().counters()
+    recorder = RunRecorder("cli-" + "-".join(args.stages))
+    router = Router.from_config(api_url, headers, model_name) if args.route else None
+    if router:
+        log(f"Routing across: {', '.join(provider.name for provider in router.providers)}")
+    with recorder.activate(), (router.activate() if router else nullcontext()):
+        if args.stream:
+            try:
+                run_streaming(args, model_name, api_url, headers, request_options, recorder)
+            except ValueError as e:
+                raise SystemExit(str(e))
+        elif args.fused:
+            run_fused(args, model_name, api_url, headers, request_options)
+        else:
+            run_stages(args, model_name, api_url, headers, request_options, recorder)
+    hits, misses = get_cache().counters_since(cache_snapshot)
+    log(f"Response cache: {hits} hits, {misses} misses")
+    for stage, metrics in recorder.summary().items():
+        log(f"  [{stage}] {metrics['requests']} requests ({metrics['errors']} errors, {metrics['retries']} retries, "
+            f"{metrics['parse_failures']} parse failures) · tokens {metrics['prompt_tokens']} in / "
+            f"{metrics['completion_tokens']} out · ${metrics['cost_usd']:.4f} · {metrics['items_per_sec']} items/sec")
+    if router:
+        routing = router.summary()
+        log(f"Routing: {routing['requests']} requests · {routing['hedges']} hedged ({routing['hedges_won']} won by the "
+            f"hedge) · {routing['failovers']} failovers")
+        for provider in routing["providers"]:
+            log(f"  [{provider['provider']}] {provider['attempts']} attempts ({provider['failed']} failed) · "
+                f"EWMA {provider['ewma_latency_sec']}s · p95 {provider['p95_latency_sec']}s · {provider['state']}")
+        router.close()
+    json_path, csv_path = recorder.write_report(args.report)
+    log(f"Run report written to {json_path} and {csv_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+Parquet input and output.
+
+The stages keep list-valued fields as text, the way they go into CSV ("a, b" for
+Keywords, JSON arrays for ChapterOutline, ...). Parquet files store those columns as
+native list<string> (list<float> for scores and embeddings) instead: frame_to_table()
+converts on the way out and table_to_frame() converts back on the way in, so every
+stage reads and writes Parquet the same way it handles CSV. Cells built from a reply's
+list (ListText) keep their items, so those are written as they came rather than split
+back out of the text. Files are compressed and
+written in row groups of whole Commentary Groups, so readers can fetch only the
+columns, or the groups, they need.
+"""
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import config
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet support is optional
+    pa = None
+    pc = None
+    pq = None
+
+# How each list column is written as text: a separator, or "json" for a JSON array
+LIST_COLUMNS = {
+    "Keywords": ", ",
+    "Outline": "; ",
+    "RelatedSections": "; ",
+    "CrossGroupLinks": "; ",
+    "ChapterOutline": "json",
+    "ChapterQuestions": "json",
+    "ChunkOutline": "json",
+    "ChunkQuestions": "json",
+}
+FLOAT_LIST_COLUMNS = {
+    "RelatedScores": "; ",
+    "Embedding": "json",
+}
+
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet support requires pyarrow (pip install pyarrow)")
+
+
+def is_parquet(source):
+    """Whether 'source' (a path or an uploaded file) is a Parquet file, judged by its name."""
+    name = source if isinstance(source, str) else getattr(source, "name", "")
+    return str(name).lower().endswith(PARQUET_EXTENSIONS)
+
+
+class ListText(str):
+    """
+    The text form of a list cell that keeps its items: CSV output and the stages see the
+    joined text, while the Parquet writer takes the items as they are (an item may
+    itself contain the separator).
+    """
+
+    def __new__(cls, items, separator):
+        items = list(items)
+        text = super().__new__(cls, list_to_text(items, separator))
+        text.items = items
+        text.separator = separator
+        return text
+
+    def __reduce__(self):
+        return ListText, (self.items, self.separator)
+
+
+def is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+def text_to_list(value, separator, cast=str):
+    """Parses one cell of a list column from its text form. Missing and empty cells become None."""
+    if isinstance(value, ListText):
+        return [cast(item) for item in value.items] or None
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [cast(item) for item in value]
+    if is_missing(value):
+        return None
+    value = str(value)
+    if not value:
+        return None
+    if separator == "json":
+        try:
+            items = json.loads(value)
+        except json.JSONDecodeError:
+            return [cast(value)]
+        return [cast(item) for item in items] if isinstance(items, list) else [cast(items)]
+    return [cast(item) for item in value.split(separator)]
+
+
+def list_to_text(values, separator):
+    if values is None:
+        return ""
+    values = list(values)
+    if separator == "json":
+        return json.dumps(values)
+    return separator.join(values)
+
+
+def column_array(series, arrow_type=None):
+    """One column as an Arrow array; list columns are parsed, other text columns stay strings."""
+    name = series.name
+    if name in LIST_COLUMNS and LIST_COLUMNS[name] != "json" and pd.api.types.is_string_dtype(series) \
+            and series.map(lambda v: is_missing(v) or (isinstance(v, str) and not isinstance(v, ListText))).all():
+        # Plain text cells are split by Arrow itself
+        text = pa.array(series.where(series != "", None), type=pa.string(), from_pandas=True)
+        return pc.split_pattern(text, LIST_COLUMNS[name])
+    if name in LIST_COLUMNS:
+        return pa.array([text_to_list(v, LIST_COLUMNS[name]) for v in series], type=pa.list_(pa.string()))
+    if name in FLOAT_LIST_COLUMNS:
+        return pa.array([text_to_list(v, FLOAT_LIST_COLUMNS[name], float) for v in series],
+                        type=pa.list_(pa.float32()))
+    if arrow_type is None and (pd.api.types.is_string_dtype(series) or series.isna().all()):
+        arrow_type = pa.string()
+    if arrow_type == pa.string():
+        series = series.where(series.isna(), series.astype(str))
+    return pa.array(series, type=arrow_type, from_pandas=True)
+
+
+def frame_to_table(df, schema=None):
+    """DataFrame (stage text form) to an Arrow table with typed list columns; 'schema' pins the column types."""
+    require_pyarrow()
+    arrays = [
+        column_array(df[col], schema.field(col).type if schema is not None else None)
+        for col in df.columns
+    ]
+    return pa.Table.from_arrays(arrays, names=[str(col) for col in df.columns])
+
+
+def table_to_frame(table):
+    """Arrow table to a DataFrame in the stage text form (embeddings become lists of floats)."""
+    for i, name in enumerate(table.column_names):
+        separator = LIST_COLUMNS.get(name)
+        if separator and separator != "json":
+            # Joined by Arrow, without a Python object per list
+            table = table.set_column(i, name, pc.fill_null(pc.binary_join(table.column(i), separator), ""))
+    frame = table.to_pandas()
+    for col in frame.columns:
+        if col == "Embedding":
+            frame[col] = [None if v is None else v.tolist() for v in frame[col]]
+        elif col == "RelatedScores":
+            frame[col] = ["" if v is None else "; ".join(f"{s:.3f}" for s in v) for v in frame[col]]
+        elif LIST_COLUMNS.get(col) == "json":
+            frame[col] = [list_to_text(v, "json") for v in frame[col]]
+    return frame
+
+
+def row_group_spans(keys, target_rows):
+    """(start, end) row ranges of about 'target_rows' rows that never cut a run of equal keys."""
+    starts = np.flatnonzero(keys.ne(keys.shift()).to_numpy())
+    spans = []
+    start = 0
+    for boundary in starts[1:]:
+        if boundary - start >= target_rows:
+            spans.append((start, int(boundary)))
+            start = int(boundary)
+    spans.append((start, len(keys)))
+    return spans
+
+
+class ParquetStreamWriter:
+    """
+    Parquet counterpart of streaming.CsvStreamWriter: frames are appended as they are
+    produced and buffered into compressed row groups of about 'row_group_rows' rows.
+    Row groups hold whole groups of 'group_col' (a group is only cut when it alone
+    exceeds the target), so filtering on that column skips all other row groups.
+    The column types are fixed by the first row group; later frames are aligned to it.
+    """
+
+    def __init__(self, path, group_col="Commentary Group", row_group_rows=config.PARQUET_ROW_GROUP_ROWS,
+                 compression=config.PARQUET_COMPRESSION):
+        require_pyarrow()
+        self.path = path
+        self.group_col = group_col
+        self.row_group_rows = row_group_rows
+        self.compression = compression
+        self.columns = None
+        self.rows = 0
+        self._schema = None
+        self._writer = None
+        self._pending = []
+        self._pending_rows = 0
+        if isinstance(path, str):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def write(self, frame):
+        if frame.empty:
+            return
+        if self.columns is None:
+            self.columns = list(frame.columns)
+        else:
+            frame = frame.reindex(columns=self.columns)
+        self._pending.append(frame)
+        self._pending_rows += len(frame)
+        if self._pending_rows >= self.row_group_rows:
+            self._flush(final=False)
+
+    def _flush(self, final):
+        frame = pd.concat(self._pending, ignore_index=True)
+        held = frame.iloc[0:0]
+        grouped = self.group_col in frame.columns
+        if not final and grouped:
+            # The last group may continue in the next frame, so it waits for the next row group
+            keys = frame[self.group_col]
+            runs = keys.ne(keys.shift()).cumsum()
+            start = int(np.argmax((runs == runs.iloc[-1]).to_numpy()))
+            if start > 0:
+                frame, held = frame.iloc[:start], frame.iloc[start:].reset_index(drop=True)
+
+        table = frame_to_table(frame, self._schema)
+        if self._writer is None:
+            self._schema = table.schema
+            self._writer = pq.ParquetWriter(self.path, self._schema, compression=self.compression)
+        spans = row_group_spans(frame[self.group_col], self.row_group_rows) if grouped else [(0, len(frame))]
+        for start, end in spans:
+            self._writer.write_table(table.slice(start, end - start), row_group_size=end - start)
+        self.rows += len(frame)
+        self._pending = [held] if len(held) else []
+        self._pending_rows = len(held)
+
+    def close(self):
+        if self._pending:
+            self._flush(final=True)
+        if self._writer is not None:
+            self._writer.close()
+        else:
+            # Nothing was written: still leave a valid (empty) file behind
+            pq.write_table(pa.table({col: pa.array([], type=pa.string()) for col in self.columns or []}), self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_parquet(df, path, group_col="Commentary Group"):
+    with ParquetStreamWriter(path, group_col) as writer:
+        writer.write(df)
+    return writer.rows
+
+
+def to_parquet_bytes(df, group_col="Commentary Group"):
+    """The frame as Parquet file contents, e.g. for a download button."""
+    buffer = io.BytesIO()
+    write_parquet(df, buffer, group_col)
+    return buffer.getvalue()
+
+
+def read_table(source, columns=None):
+    """
+    Reads a CSV or Parquet file (path or uploaded file) into a DataFrame. From Parquet
+    only 'columns' are read, if given, and list columns arrive in their text form.
+    """
+    if not is_parquet(source):
+        return pd.read_csv(source, usecols=columns)
+    require_pyarrow()
+    return table_to_frame(pq.read_table(source, columns=columns))
+
+
+def read_columns(source):
+    """Column names of a CSV or Parquet file; file objects are rewound afterwards."""
+    if is_parquet(source):
+        require_pyarrow()
+        columns = pd.Index(pq.ParquetFile(source).schema_arrow.names)
+    else:
+        columns = pd.read_csv(source, nrows=0).columns
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return columns
+
+
+def read_chunks(source, chunksize, usecols=None):
+    """
+    Yields DataFrames of up to 'chunksize' rows from a CSV or Parquet file. 'usecols'
+    is a list of names or a callable on each name, as for pandas.read_csv.
+    """
+    if not is_parquet(source):
+        yield from pd.read_csv(source, chunksize=chunksize, usecols=usecols)
+        return
+    require_pyarrow()
+    parquet_file = pq.ParquetFile(source)
+    columns = usecols
+    if callable(usecols):
+        columns = [name for name in parquet_file.schema_arrow.names if usecols(name)]
+    for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+        yield table_to_frame(pa.Table.from_batches([batch]))
+
+
+def show_parquet_download(df, label, file_name, group_col="Commentary Group"):
+    """Streamlit download button for df as Parquet; nothing is shown when pyarrow is missing."""
+    if pa is None:
+        return
+    import streamlit as st
+
+    st.download_button(label, to_parquet_bytes(df, group_col), file_name=file_name, mime="application/vnd.apache.parquet")
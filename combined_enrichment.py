@@ -1,30 +1,311 @@
 import streamlit as st
 import pandas as pd
 import json
-import requests
+import os
+import time
+from contextlib import nullcontext
+
+import config
+from columnar import read_chunks
+from chat_client import answered_by, chat_completion
+from dedupe import RequestPlan, input_key
+from dispatch import dispatch, dispatch_ordered, provider_limits, summarize_latencies
+from fingerprints import FingerprintManifest
+from instrumentation import RunRecorder, count, show_run_report
+from response_cache import get_cache
+from routing import PROVIDER_COLUMN, Router, provider_columns, show_routing_report
+from streaming import iter_csv_groups, open_output, verify_sorted
+from uploads import read_upload
+from utils import parse_json_reply, to_cell
+
+# Enrichment modes, keyed by the short names used on the command line
+MODES = {
+    "themes": "🔹 Only Themes, Wisdom, Reflections",
+    "outline": "🔸 Only Outline & Contextual Questions",
+    "both": "🧩 Run Both Together",
+}
+
+
+def resolve_columns(columns):
+    """Maps the logical column names to the ones present in the CSV (fallback names included)."""
+    return {
+        "Verse Group": "Verse Group" if "Verse Group" in columns else "Commentary Group",
+        "translation": "translation" if "translation" in columns else "Latest (English) Translation",
+        "English Commentary": "English Commentary" if "English Commentary" in columns else "commentary"
+    }
+
+
+def enrich_fields_for_mode(mode):
+    enrich_fields_part1 = ["themes", "wisdom_points", "real_life_reflections", "revelation_context"]
+    enrich_fields_part2 = ["outline_of_commentary", "contextual_questions"]
+    enrich_fields = []
+
+    if "Only Themes" in mode or "Both" in mode:
+        enrich_fields += enrich_fields_part1
+    if "Only Outline" in mode or "Both" in mode:
+        enrich_fields += enrich_fields_part2
+    return enrich_fields
+
+
+def build_prompt(translation, commentary, mode):
+    prompt_parts = []
+    if "Only Themes" in mode or "Both" in mode:
+        prompt_parts.append("1. themes\n2. wisdom_points\n3. real_life_reflections\n4. revelation_context")
+    if "Only Outline" in mode or "Both" in mode:
+        prompt_parts.append("5. outline_of_commentary – bullet summary\n6. contextual_questions – 4–6 explanations")
+
+    return f"""
+Given this Quranic translation: "{translation}"  
+and commentary: "{commentary}", extract:
+
+{chr(10).join(prompt_parts)}
+
+Return result as valid JSON including only the fields requested.
+"""
+
+
+def enrich_group(model_name, api_url, headers, prompt, use_cache=True):
+    """
+    Sends one group's prompt and returns the parsed JSON result, with list/dict values
+    already turned into JSON text so results can be written to any output as they are.
+    While routing, the provider that answered is added under PROVIDER_COLUMN.
+    Safe to call from worker threads.
+    """
+    payload = {
+        "model": model_name,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.4,
+        "max_tokens": 1000
+    }
+    result = chat_completion(api_url, headers, payload, timeout=90, use_cache=use_cache, parse=parse_json_reply)
+    fields = {field: to_cell(value) for field, value in result.items()}
+    if answered_by() is not None:
+        fields[PROVIDER_COLUMN] = answered_by()
+    return fields
+
+
+def make_jobs(groups, col_map, mode):
+    """Yields (group_name, prompt, group_df) for every group."""
+    for group_name, group_df in groups:
+        translation = " | ".join(group_df[col_map["translation"]].dropna().astype(str).tolist())
+        commentary_series = group_df[col_map["English Commentary"]].dropna().astype(str)
+        commentary = commentary_series.iloc[0] if not commentary_series.empty else "No commentary provided."
+        yield group_name, build_prompt(translation, commentary, mode), group_df
+
+
+class ReusedResults:
+    """
+    Looks up the previous output of groups whose fingerprint is unchanged since the run
+    that wrote it, and records the fingerprints of this run in 'manifest'.
+    """
+
+    def __init__(self, manifest, group_col, enrich_fields, model_name):
+        self.manifest = manifest
+        self.previous = manifest.previous_output(group_col)
+        self.enrich_fields = enrich_fields
+        self.model_name = model_name
+        self.fingerprints = {}
+        self.reused = set()
+
+    def __call__(self, job):
+        """The previous fields of job's group, or None when it has to be requested."""
+        group_name, prompt = job[0], job[1]
+        group_fingerprint = self.manifest.fingerprint(self.model_name, prompt)
+        self.fingerprints[group_name] = group_fingerprint
+        previous = self.previous
+        if previous is None or not self.manifest.unchanged(group_name, group_fingerprint) or group_name not in previous:
+            return None
+        row = previous.rows(group_name).iloc[0]
+        if not all(field in row.index for field in self.enrich_fields):
+            return None
+        self.manifest.record(group_name, group_fingerprint)
+        self.reused.add(group_name)
+        fields = {field: row[field] for field in self.enrich_fields}
+        if PROVIDER_COLUMN in row.index:
+            fields[PROVIDER_COLUMN] = row[PROVIDER_COLUMN]
+        return fields
+
+    def record(self, group_name):
+        self.manifest.record(group_name, self.fingerprints[group_name])
+
+
+def enrich_dataframe(df, col_map, mode, model_name, api_url, headers, max_workers=1,
+                     requests_per_minute=None, use_cache=True, on_result=None, manifest=None, plan=None):
+    """
+    Enriches every group of an in-memory DataFrame and writes the fields back onto
+    its rows. Returns (df, stats). 'on_result(i, job, result, error, latency)' is
+    called from the calling thread as each requested group finishes.
+
+    With a FingerprintManifest, groups unchanged since the previous output are copied
+    from it instead of being requested ('reused' in stats); the caller saves the manifest.
+    With a dedupe.RequestPlan, groups whose prompt matches an earlier group's (after
+    normalization) get that group's result instead of a request of their own.
+    """
+    enrich_fields = enrich_fields_for_mode(mode)
+    output_fields = provider_columns(enrich_fields, api_url)
+    for field in output_fields:
+        if field not in df.columns:
+            df[field] = ""
+
+    jobs = list(make_jobs(df.groupby(col_map["Verse Group"]), col_map, mode))
+
+    results = {}
+    reuse = ReusedResults(manifest, col_map["Verse Group"], enrich_fields, model_name) if manifest else None
+    if reuse:
+        todo = []
+        for job in jobs:
+            previous = reuse(job)
+            if previous is None:
+                todo.append(job)
+            else:
+                results[job[0]] = previous
+        jobs = todo
+    requested = plan.plan(jobs, key=lambda job: input_key(job[1])) if plan else jobs
+
+    outcomes, stats = dispatch(
+        requested,
+        lambda job: enrich_group(model_name, api_url, headers, job[1], use_cache),
+        max_workers=max_workers,
+        requests_per_minute=requests_per_minute,
+        on_result=on_result,
+    )
+    stats["reused"] = len(reuse.reused) if reuse else 0
+    stats["shared"] = len(jobs) - len(requested)
+    count("items", len(jobs) + stats["reused"])
+
+    # Results are collected in group order, independent of completion order
+    outcomes = {job[0]: outcome for job, outcome in zip(requested, outcomes)}
+    if plan:
+        plan.fan_out(outcomes)
+    for group_name, _, _ in jobs:
+        result, error = outcomes[group_name]
+        results[group_name] = result if error is None else {}
+        if error is None and reuse:
+            reuse.record(group_name)
+
+    return apply_results(df, col_map["Verse Group"], results, output_fields), stats
+
+
+def apply_results(df, group_col, results, enrich_fields):
+    """
+    Writes per-group results onto every row of df: the results become one frame indexed
+    by group, and each field is mapped onto the group column in a single vectorized pass.
+    Rows of groups without a result get "".
+    """
+    results_frame = pd.DataFrame.from_dict(results, orient="index", columns=enrich_fields, dtype=object)
+    for field in enrich_fields:
+        df[field] = df[group_col].map(results_frame[field]).fillna("")
+    return df
+
+
+def enrich_csv_stream(source, out_path, col_map, mode, model_name, api_url, headers, max_workers=1,
+                      requests_per_minute=None, use_cache=True, on_result=None, manifest=None, plan=None):
+    """
+    Streaming counterpart of enrich_dataframe: reads 'source' group by group (it must be
+    sorted by the group column) and appends enriched rows to 'out_path' (CSV, or Parquet
+    for a .parquet path) in input order.
+    Returns (rows_written, stats). Raises ValueError for unsorted input before any request.
+    A manifest for 'out_path' is read before the file is overwritten. With a RequestPlan,
+    a group whose prompt matches a recent group's waits for that group's request.
+    """
+    verify_sorted(source, col_map["Verse Group"])
+    enrich_fields = enrich_fields_for_mode(mode)
+    output_fields = provider_columns(enrich_fields, api_url)
+    reuse = ReusedResults(manifest, col_map["Verse Group"], enrich_fields, model_name) if manifest else None
+    groups = iter_csv_groups(source, col_map["Verse Group"], chunksize=config.STREAM_CHUNK_ROWS, strip_columns=True)
+    latencies = []
+    started = time.perf_counter()
+
+    def resolve(job):
+        previous = reuse(job) if reuse else None
+        if previous is not None or plan is None:
+            return previous
+        return plan.share(input_key(job[1]), job[0])
+
+    def request(job):
+        if plan is None:
+            return enrich_group(model_name, api_url, headers, job[1], use_cache)
+        return plan.run(input_key(job[1]), lambda: enrich_group(model_name, api_url, headers, job[1], use_cache))
+
+    with open_output(out_path, col_map["Verse Group"]) as writer:
+        outcomes = dispatch_ordered(
+            make_jobs(groups, col_map, mode),
+            request,
+            max_workers=max_workers,
+            requests_per_minute=requests_per_minute,
+            resolve=resolve,
+        )
+        for i, job, result, error, latency in outcomes:
+            count("items")
+            enriched = result if error is None else {}
+            group_df = job[2].copy()
+            for field in output_fields:
+                group_df[field] = [enriched.get(field, "")] * len(group_df)
+            writer.write(group_df)
+            if reuse and job[0] in reuse.reused:
+                continue
+            if error is None and reuse:
+                reuse.record(job[0])
+            if not (plan and job[0] in plan.shared):
+                latencies.append(latency)
+            if on_result:
+                on_result(i, job, result, error, latency)
+    stats = summarize_latencies(latencies, time.perf_counter() - started)
+    stats["reused"] = len(reuse.reused) if reuse else 0
+    stats["shared"] = len(plan.shared) if plan else 0
+    return writer.rows, stats
+
 
 def run_combined_enrichment(model_name, api_url, api_key, headers):
     st.header("📚 Combined Enrichment Tool")
 
-    uploaded_file = st.file_uploader("📂 Upload Tafsir CSV", type="csv", key="combined")
+    uploaded_file = st.file_uploader("📂 Upload Tafsir CSV (or Parquet)", type=["csv", "parquet"], key="combined")
 
     # 🔘 Choose mode
-    mode = st.radio("Select what to run:", [
-        "🔹 Only Themes, Wisdom, Reflections",
-        "🔸 Only Outline & Contextual Questions",
-        "🧩 Run Both Together"
-    ])
+    mode = st.radio("Select what to run:", list(MODES.values()))
+
+    # ⚡ Concurrency (bounded by the provider limits in config.DEFAULT_CHAT_MODELS)
+    limits = provider_limits(api_url)
+    max_in_flight = st.number_input(
+        "⚡ Max requests in flight",
+        min_value=1,
+        max_value=limits["max_concurrency"],
+        value=limits["max_concurrency"],
+        key="combined_max_in_flight"
+    )
+    use_cache = st.checkbox("💾 Reuse cached responses", value=True, key="combined_use_cache")
+    streaming = st.checkbox(
+        "🌊 Streaming mode for very large files (input must be sorted by Verse/Commentary Group)",
+        value=False,
+        key="combined_streaming"
+    )
+    incremental = st.checkbox(
+        "🔁 Only re-enrich groups that changed since the last output of this file",
+        value=True,
+        key="combined_incremental"
+    )
+    route = st.checkbox(
+        "🔀 Route across the configured providers (hedge slow requests, fail over on errors)",
+        value=False,
+        key="combined_route"
+    )
+    dedupe = st.checkbox(
+        "🧬 One request per distinct translation & commentary (identical groups share the result)",
+        value=True,
+        key="combined_dedupe"
+    )
 
     if uploaded_file and st.button("🚀 Run Enrichment"):
-        df = pd.read_csv(uploaded_file)
+        if streaming:
+            # Only peek at the header and first rows; groups are read chunk by chunk below
+            df = next(read_chunks(uploaded_file, 5))
+            uploaded_file.seek(0)
+        else:
+            df = read_upload(uploaded_file)
         df.columns = df.columns.str.strip()
 
         # 💡 Column mapping fallback
-        col_map = {
-            "Verse Group": "Verse Group" if "Verse Group" in df.columns else "Commentary Group",
-            "translation": "translation" if "translation" in df.columns else "Latest (English) Translation",
-            "English Commentary": "English Commentary" if "English Commentary" in df.columns else "commentary"
-        }
+        col_map = resolve_columns(df.columns)
 
         missing = [k for k, v in col_map.items() if v not in df.columns]
         if missing:
@@ -34,70 +315,82 @@ def run_combined_enrichment(model_name, api_url, api_key, headers):
         st.success("✅ File loaded!")
         st.dataframe(df.head())
 
-        enrich_fields_part1 = ["themes", "wisdom_points", "real_life_reflections", "revelation_context"]
-        enrich_fields_part2 = ["outline_of_commentary", "contextual_questions"]
-        enrich_fields = []
+        status = st.empty()
+        counters = st.empty()
+        recorder = RunRecorder("combined_enrichment")
+        done = []
 
-        if "Only Themes" in mode or "Both" in mode:
-            enrich_fields += enrich_fields_part1
-        if "Only Outline" in mode or "Both" in mode:
-            enrich_fields += enrich_fields_part2
+        def show_result(i, job, result, error, latency):
+            group_name = job[0]
+            st.markdown(f"### 🧠 Processed Group: `{group_name}` ({latency:.1f}s)")
+            if error is None:
+                st.code(json.dumps(result, indent=2), language="json")
+            else:
+                st.warning(f"⚠️ Failed for group '{group_name}': {error}")
+            done.append(group_name)
+            status.text(f"Processed {len(done)} groups")
+            counters.caption(recorder.counters_line())
 
-        for field in enrich_fields:
-            if field not in df.columns:
-                df[field] = ""
+        request_options = dict(
+            max_workers=max_in_flight,
+            requests_per_minute=limits["requests_per_minute"],
+            use_cache=use_cache,
+            on_result=show_result,
+        )
+        cache_snapshot = get_cache().counters()
+        # 🔀 Other providers are used when their API key is set in the environment (see config.DEFAULT_CHAT_MODELS)
+        router = Router.from_config(api_url, headers, model_name) if route else None
+        routing = router.activate() if router else nullcontext()
 
-        grouped = df.groupby(col_map["Verse Group"])
-        results = {}
-
-        for group_name, group_df in grouped:
-            st.markdown(f"### 🧠 Processing Group: `{group_name}`")
-
-            translation = " | ".join(group_df[col_map["translation"]].dropna().astype(str).tolist())
-            commentary_series = group_df[col_map["English Commentary"]].dropna().astype(str)
-            commentary = commentary_series.iloc[0] if not commentary_series.empty else "No commentary provided."
-
-            # Prompt creation
-            prompt_parts = []
-            if "Only Themes" in mode or "Both" in mode:
-                prompt_parts.append("1. themes\n2. wisdom_points\n3. real_life_reflections\n4. revelation_context")
-            if "Only Outline" in mode or "Both" in mode:
-                prompt_parts.append("5. outline_of_commentary – bullet summary\n6. contextual_questions – 4–6 explanations")
-
-            prompt = f"""
-Given this Quranic translation: "{translation}"  
-and commentary: "{commentary}", extract:
-
-{chr(10).join(prompt_parts)}
-
-Return result as valid JSON including only the fields requested.
-"""
-
-            payload = {
-                "model": model_name,
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.4,
-                "max_tokens": 1000
-            }
+        # 🔁 Outputs are kept on disk with a fingerprint manifest beside them, so the next run
+        # of the same file only requests groups whose translation/commentary/mode/model changed
+        out_name = f"{os.path.splitext(uploaded_file.name)[0]}_enriched_combined.csv"
+        out_path = os.path.join(config.OUTPUT_DIR, out_name)
+        manifest = FingerprintManifest(out_path, "combined_enrichment") if incremental else None
+        request_options["manifest"] = manifest
+        plan = RequestPlan() if dedupe else None
+        request_options["plan"] = plan
 
+        if streaming:
+            # 🌊 Groups are enriched as they are read and appended to a file on disk in input order
             try:
-                with st.spinner(f"Processing group: {group_name}..."):
-                    response = requests.post(api_url, headers=headers, json=payload, timeout=90)
-                    content = response.json()["choices"][0]["message"]["content"]
-                    cleaned = content.strip().replace("```json", "").replace("```", "").strip()
-                    result = json.loads(cleaned)
-                    st.code(json.dumps(result, indent=2), language="json")
-                    results[group_name] = result
-            except Exception as e:
-                st.warning(f"⚠️ Failed for group '{group_name}': {e}")
-                results[group_name] = {field: "" for field in enrich_fields}
-
-        # Apply results
-        for idx, row in df.iterrows():
-            enriched = results.get(row[col_map["Verse Group"]], {})
-            for field in enrich_fields:
-                df.at[idx, field] = enriched.get(field, "")
+                with st.spinner(f"Streaming groups ({max_in_flight} in flight)..."), recorder.activate(), recorder.stage("enrich"), routing:
+                    rows, stats = enrich_csv_stream(
+                        uploaded_file, out_path, col_map, mode, model_name, api_url, headers, **request_options
+                    )
+            except ValueError as e:
+                st.error(f"❌ {e}")
+                if router:
+                    router.close()
+                return
+            st.caption(f"🌊 {rows} rows written to `{out_path}`")
+        else:
+            with st.spinner(f"Processing groups ({max_in_flight} in flight)..."), recorder.activate(), recorder.stage("enrich"), routing:
+                df, stats = enrich_dataframe(df, col_map, mode, model_name, api_url, headers, **request_options)
+            if manifest:
+                os.makedirs(config.OUTPUT_DIR, exist_ok=True)
+                df.to_csv(out_path, index=False)
+        if manifest:
+            manifest.save()
+            st.caption(f"🔁 {stats['reused']} unchanged groups carried over from `{out_path}`")
 
         st.success("🎉 Enrichment Complete!")
+        st.markdown(
+            f"**Throughput:** {stats['items_per_sec']} groups/sec over {stats['elapsed_sec']}s · "
+            f"p50 latency {stats['p50_latency_sec']}s · p95 latency {stats['p95_latency_sec']}s"
+        )
+        if plan:
+            st.caption(f"🧬 {plan.summary_line()}")
+        hits, misses = get_cache().counters_since(cache_snapshot)
+        st.caption(f"💾 Response cache: {hits} hits, {misses} misses")
+        show_run_report(recorder)
+        if router:
+            show_routing_report(router)
+            router.close()
+
+        if streaming:
+            with open(out_path, "rb") as f:
+                st.download_button("⬇️ Download Enriched CSV", f, file_name="enriched_combined.csv", mime="text/csv")
+            return
         enriched_csv = df.to_csv(index=False).encode("utf-8")
         st.download_button("⬇️ Download Enriched CSV", enriched_csv, file_name="enriched_combined.csv", mime="text/csv")
@@ -1,7 +1,33 @@
 import streamlit as st
-import pandas as pd
 import json
-import requests
+
+import config
+from columnar import show_parquet_download
+from dedupe import RequestPlan
+from instrumentation import RunRecorder, show_run_report
+from response_cache import get_cache
+from run_journal import RunJournal, journal_path
+from sections import SectionBuilder, split_groups
+from uploads import read_upload
+
+
+def build_split_prompt(commentary):
+    return f"""
+Split the following commentary into thematic sections (150–200 words each). For each section, extract:
+- SectionNumber (e.g., 1, 2, 3, …)
+- ThemeTitle (short, descriptive)
+- ThemeText (exact substring from the commentary, 150–200 words)
+- ContextualQuestion (a deep, open-ended question)
+- ThemeSummary (2–3 sentence overview)
+- Keywords (5–7 key terms)
+- Outline (3–5 bullet points)
+
+Return the result as a JSON array where each item represents one section.
+
+Commentary:
+{commentary}
+"""
+
 
 def run_combined_improvement(model_name, api_url, api_key, headers):
     st.header("🕌 Combined Enrichment & Thematic Splitting")
@@ -11,12 +37,27 @@ def run_combined_improvement(model_name, api_url, api_key, headers):
     )
     
     # --- Upload CSV ---
-    uploaded_file = st.file_uploader("📂 Upload CSV for Combined Processing", type=["csv"], key="combined_improvement")
+    uploaded_file = st.file_uploader("📂 Upload CSV (or Parquet) for Combined Processing", type=["csv", "parquet"], key="combined_improvement")
+    use_cache = st.checkbox("💾 Reuse cached responses", value=True, key="combined_improvement_use_cache")
+    resume = st.checkbox("♻️ Resume from run journal (skip groups already split)", value=True, key="combined_improvement_resume")
+    stream_replies = st.checkbox(
+        "⚡ Stream model replies (show each section as soon as it arrives)", value=False, key="combined_improvement_stream_replies"
+    )
+    dedupe = st.checkbox(
+        "🧬 One request per distinct commentary (identical groups share the sections)",
+        value=True,
+        key="combined_improvement_dedupe"
+    )
+    segment = st.checkbox(
+        "✂️ Cut long commentary into segments that are split in parallel (no sections lost to cut-off replies)",
+        value=True,
+        key="combined_improvement_segment"
+    )
     if not uploaded_file:
         st.info("Please upload a CSV file.")
         return
     
-    df = pd.read_csv(uploaded_file)
+    df = read_upload(uploaded_file)
     st.subheader("📄 Uploaded Data")
     st.dataframe(df.head())
     
@@ -37,77 +78,54 @@ def run_combined_improvement(model_name, api_url, api_key, headers):
         st.error("❌ 'Commentary Group' column not found in the CSV!")
         return
     
-    grouped = df.groupby("Commentary Group")
-    result_df = pd.DataFrame()  # to store new rows (one per thematic section)
+    cache_snapshot = get_cache().counters()
+    builder = SectionBuilder(df.columns)  # collects new rows (one per thematic section)
+    
+    # Every completed group is journaled, so a rerun or refresh resumes instead of starting over
+    journal = RunJournal(journal_path("combined_improvement", uploaded_file.getvalue(), model_name))
+    if not resume:
+        journal.clear()
+    completed = journal.completed()
+    if completed:
+        st.info(f"♻️ Resuming: {len(completed)} groups restored from `{journal.path}`")
+    
+    counters = st.empty()
+    recorder = RunRecorder("combined_improvement")
     
-    for group_name, group_df in grouped:
-        st.markdown(f"### Processing Group: `{group_name}`")
-        # Get the commentary text from the first non-empty row in the group
-        commentary_series = group_df["English Commentary"].dropna().astype(str)
-        commentary = commentary_series.iloc[0] if not commentary_series.empty else ""
-        if not commentary:
+    def show_group(group_name, status, sections, error):
+        counters.caption(recorder.counters_line())
+        if status == "split":
+            st.markdown(f"### Processed Group: `{group_name}`")
+            st.code(json.dumps(sections, indent=2), language="json")
+        elif status == "empty":
             st.warning(f"No commentary found for group: {group_name}")
-            continue
-        
-        # Build the prompt for thematic splitting
-        prompt = f"""
-Split the following commentary into thematic sections (150–200 words each). For each section, extract:
-- SectionNumber (e.g., 1, 2, 3, …)
-- ThemeTitle (short, descriptive)
-- ThemeText (exact substring from the commentary, 150–200 words)
-- ContextualQuestion (a deep, open-ended question)
-- ThemeSummary (2–3 sentence overview)
-- Keywords (5–7 key terms)
-- Outline (3–5 bullet points)
-
-Return the result as a JSON array where each item represents one section.
-
-Commentary:
-{commentary}
-"""
-        payload = {
-            "model": model_name,
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.4,
-            "max_tokens": 1200
-        }
-        
-        try:
-            with st.spinner(f"Splitting group {group_name}..."):
-                response = requests.post(api_url, headers=headers, json=payload, timeout=90)
-                reply = response.json()
-                raw_content = reply["choices"][0]["message"]["content"]
-                st.code(raw_content, language="json")
-                
-                # Clean up response (remove any markdown code fences)
-                cleaned = raw_content.strip().replace("```json", "").replace("```", "").strip()
-                data = json.loads(cleaned)
-                
-                # For each section returned, create a new row in result_df
-                for section in data:
-                    new_row = {}
-                    # Copy all base columns from the first row of the group
-                    for col in df.columns:
-                        new_row[col] = group_df.iloc[0][col]
-                    section_num = section.get("SectionNumber", "")
-                    new_row["SectionNumber"] = f"{group_name} - Section {section_num}"
-                    new_row["ThemeTitle"] = section.get("ThemeTitle", "")
-                    new_row["ThemeText"] = section.get("ThemeText", "")
-                    new_row["ContextualQuestion"] = section.get("ContextualQuestion", "")
-                    new_row["ThemeSummary"] = section.get("ThemeSummary", "")
-                    kw = section.get("Keywords", [])
-                    new_row["Keywords"] = ", ".join(kw) if isinstance(kw, list) else str(kw)
-                    ol = section.get("Outline", [])
-                    new_row["Outline"] = "; ".join(ol) if isinstance(ol, list) else str(ol)
-                    
-                    result_df = pd.concat([result_df, pd.DataFrame([new_row])], ignore_index=True)
-        except Exception as e:
-            st.warning(f"Failed for group {group_name}: {e}")
+        elif status == "failed":
+            st.warning(f"Failed for group {group_name}: {error}")
+    
+    def show_section(group_name, section):
+        st.markdown(f"⚡ `{group_name}` · Section {section.get('SectionNumber', '')}: {section.get('ThemeTitle', '')}")
+    
+    plan = RequestPlan() if dedupe else None
+    with st.spinner("Splitting commentary groups..."), recorder.activate(), recorder.stage("split"):
+        split_groups(
+            df.groupby("Commentary Group"), builder, build_split_prompt, model_name, api_url, headers,
+            use_cache=use_cache, journal=journal, on_group=show_group,
+            stream=stream_replies, on_section=show_section, plan=plan,
+            segment_tokens=config.SPLIT_SEGMENT_TOKENS if segment else None
+        )
     
+    result_df = builder.to_frame()
     st.success("Thematic splitting completed!")
+    if plan:
+        st.caption(f"🧬 {plan.summary_line()}")
+    hits, misses = get_cache().counters_since(cache_snapshot)
+    st.caption(f"💾 Response cache: {hits} hits, {misses} misses")
+    st.caption(f"📝 Run journal: `{journal.path}`")
+    show_run_report(recorder)
     st.subheader("Preview of Combined Output:")
     st.dataframe(result_df.head())
     
     # Provide a download button for the final CSV
     csv_data = result_df.to_csv(index=False).encode("utf-8")
     st.download_button("⬇️ Download Combined Enriched CSV", csv_data, file_name="combined_enrichment_and_split.csv", mime="text/csv")
+    show_parquet_download(result_df, "⬇️ Download Parquet (Keywords/Outline as lists)", "combined_enrichment_and_split.parquet")
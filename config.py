@@ -1,17 +1,31 @@
 # 
 
 # Default Chat Models for commentary enrichment
+# 'max_concurrency' caps in-flight requests and 'requests_per_minute' paces request starts;
+# 'api_key_env' names the environment variable holding the key when the model is used as a fallback (routing)
 DEFAULT_CHAT_MODELS = {
     "DeepSeek Reasoner": {
         "api_url": "https://api.deepseek.com/v1/chat/completions",
-        "model_name": "deepseek-reasoner"
+        "model_name": "deepseek-reasoner",
+        "max_concurrency": 8,
+        "requests_per_minute": 120,
+        "api_key_env": "DEEPSEEK_API_KEY"
     },
     "Claude 3.5 Sonnet (via OpenRouter)": {
         "api_url": "https://openrouter.ai/api/v1/chat/completions",
-        "model_name": "anthropic/claude-3-sonnet"
+        "model_name": "anthropic/claude-3-sonnet",
+        "max_concurrency": 4,
+        "requests_per_minute": 60,
+        "api_key_env": "OPENROUTER_API_KEY"
     }
 }
 
+# Limits used for custom endpoints that are not listed above
+DEFAULT_PROVIDER_LIMITS = {
+    "max_concurrency": 2,
+    "requests_per_minute": 30
+}
+
 # Embedding models available via OpenAI
 EMBEDDING_MODELS = {
     "Small": "text-embedding-3-small",
@@ -20,3 +34,98 @@ EMBEDDING_MODELS = {
 
 # Embedding API endpoint (OpenAI)
 EMBEDDING_API_URL = "https://api.openai.com/v1"
+
+# Parsed uploads the Streamlit apps keep in memory (st.cache_data entries, one per distinct file)
+UPLOAD_CACHE_ENTRIES = 8
+
+# On-disk response cache shared by all chat-completion calls
+# (set CSVIMPROVE_CACHE=off in the environment to bypass it entirely)
+CACHE_PATH = ".cache/responses.sqlite"
+CACHE_MAX_MB = 512
+CACHE_MAX_AGE_DAYS = 30
+
+# Run journals (one JSONL per stage run) used to resume interrupted runs
+RUNS_DIR = ".runs"
+
+# Embedding batching: OpenAI accepts up to 2048 inputs per request and caps tokens per request
+EMBEDDING_MAX_BATCH_TOKENS = 100000
+EMBEDDING_MAX_BATCH_ITEMS = 2048
+EMBEDDING_MAX_WORKERS = 4
+EMBEDDING_MAX_RETRIES = 5
+# Longer texts are cut to this many (estimated) tokens before they are sent; the models accept 8191
+EMBEDDING_MAX_INPUT_TOKENS = 8000
+
+# Where binary embedding matrices (.npy / .parquet) are written
+EMBEDDINGS_DIR = ".embeddings"
+
+# Relationship mapping switches to an approximate (FAISS) index above this many rows, if faiss is installed
+RELATED_APPROX_MIN_ROWS = 1000000
+
+# Streaming mode: rows read per CSV chunk and where incrementally written outputs go
+STREAM_CHUNK_ROWS = 50000
+OUTPUT_DIR = ".outputs"
+
+# Chat requests: retries on 429/5xx/timeouts with exponential backoff (seconds), honoring Retry-After
+CHAT_MAX_RETRIES = 4
+CHAT_BACKOFF_BASE = 1.0
+CHAT_BACKOFF_MAX = 60
+
+# Chapter & chunk enrichment: several text chunks are packed into one request up to these limits
+CHUNK_BATCH_MAX_TOKENS = 6000
+CHUNK_BATCH_MAX_ITEMS = 20
+
+# Streamed thematic splitting: how often a cut-off reply is continued before giving up on its tail
+STREAM_MAX_CONTINUATIONS = 2
+
+# Thematic splitting of long commentary: commentary over this many (estimated) tokens is cut on
+# paragraph boundaries into segments of at most this size, so the sections of each segment fit in
+# one reply (max_tokens 1200); the segments are split in parallel and their sections merged in order
+SPLIT_SEGMENT_TOKENS = 700
+# Segments of one commentary requested at the same time (also capped by the provider's max_concurrency)
+SPLIT_SEGMENT_WORKERS = 4
+
+# Prices in USD per 1M tokens, used for the cost column of run reports (models not listed count as 0)
+MODEL_PRICING = {
+    "deepseek-reasoner": {"prompt": 0.55, "completion": 2.19},
+    "anthropic/claude-3-sonnet": {"prompt": 3.00, "completion": 15.00},
+    "text-embedding-3-small": {"prompt": 0.02},
+    "text-embedding-ada-002": {"prompt": 0.10},
+}
+
+# Fused pipeline: commentary groups queued between two stages, and rows gathered before a batched stage
+# (embeddings, chapter & chunk enrichment) runs, so its requests are still packed into full batches
+PIPELINE_QUEUE_UNITS = 32
+PIPELINE_FLUSH_ROWS = 500
+
+# Background jobs: job table, per-job directories (input, output, report, log) and how many jobs run at once
+JOBS_DB = ".runs/jobs.sqlite"
+JOBS_DIR = ".runs/jobs"
+JOBS_MAX_RUNNING = 2
+JOBS_POLL_SECONDS = 2
+# A running job whose worker has not written its heartbeat for this many seconds is marked failed
+JOBS_HEARTBEAT_TIMEOUT = 60
+
+# Parquet outputs: target rows per row group (row groups hold whole Commentary Groups) and compression codec
+PARQUET_ROW_GROUP_ROWS = 20000
+PARQUET_COMPRESSION = "zstd"
+
+# Pipeline benchmark (benchmarks.py pipeline): results it is compared with, saved by --save-baseline
+BENCHMARK_BASELINE = "benchmark_baseline.json"
+
+# Groups with identical (normalized) prompt input share one request; streamed and sequential runs
+# remember the results of this many recent inputs
+DEDUPE_WINDOW = 100000
+
+# Routing across DEFAULT_CHAT_MODELS (cli.py --route): a hedged duplicate goes to the next provider when a
+# reply takes longer than the provider's recent ROUTING_HEDGE_PERCENTILE latency (ROUTING_HEDGE_DEFAULT_DELAY
+# until it has ROUTING_MIN_SAMPLES of them), for at most ROUTING_HEDGE_MAX_RATIO of requests. After
+# ROUTING_FAILURE_THRESHOLD consecutive failures a provider is tried last for ROUTING_COOLDOWN_SECONDS.
+ROUTING_EWMA_ALPHA = 0.2
+ROUTING_LATENCY_WINDOW = 200
+ROUTING_MIN_SAMPLES = 20
+ROUTING_HEDGE_PERCENTILE = 90
+ROUTING_HEDGE_MIN_DELAY = 2.0
+ROUTING_HEDGE_DEFAULT_DELAY = 20.0
+ROUTING_HEDGE_MAX_RATIO = 0.1
+ROUTING_FAILURE_THRESHOLD = 3
+ROUTING_COOLDOWN_SECONDS = 30
@@ -0,0 +1,123 @@
+"""
+One request per distinct prompt input.
+
+Many groups share the same commentary, often differing only in whitespace, and each
+used to trigger its own request. A RequestPlan keys every group on its normalized,
+hashed prompt input and sends one request per key; the parsed result is fanned out
+to every group with that key. Its report says how many calls were saved.
+
+In memory the jobs are planned up front (plan() + fan_out()). When groups arrive one
+by one (streaming, sequential splitting), share() tells whether an earlier group with
+the same key already made, or is making, the request; only the most recent
+config.DEDUPE_WINDOW keys are remembered there.
+"""
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import pandas as pd
+
+import config
+from instrumentation import count
+
+
+def normalize_input(text):
+    """Unicode-normalized text with whitespace collapsed ('' for missing values)."""
+    if text is None or (not isinstance(text, str) and pd.isna(text)):
+        return ""
+    return " ".join(unicodedata.normalize("NFKC", str(text)).split())
+
+
+def input_key(*parts):
+    """Hash of the normalized prompt inputs; equal keys get the same request."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(normalize_input(part).encode("utf-8"))
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+
+class RequestPlan:
+    """Shares one request among groups whose prompt inputs normalize to the same key. Thread-safe."""
+
+    def __init__(self, window=config.DEDUPE_WINDOW):
+        self.window = window
+        self.groups = 0
+        self.requests = 0
+        self.shared = set()
+        self._followers = {}
+        self._running = {}
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def plan(self, jobs, key):
+        """
+        Returns the jobs that need a request: the first job of every key(job). The others
+        are remembered as followers of that job (by job[0], the group name) for fan_out().
+        """
+        leaders = {}
+        requested = []
+        for job in jobs:
+            job_key = key(job)
+            leader = leaders.get(job_key)
+            if leader is None:
+                leaders[job_key] = job[0]
+                requested.append(job)
+            else:
+                self._followers.setdefault(leader, []).append(job[0])
+                self.shared.add(job[0])
+        self.groups += len(jobs)
+        self.requests += len(requested)
+        count("calls_saved", len(jobs) - len(requested))
+        return requested
+
+    def fan_out(self, outcomes):
+        """Copies every leader's entry in 'outcomes' ({group name: outcome}) to its followers."""
+        for leader, followers in self._followers.items():
+            if leader in outcomes:
+                for group_name in followers:
+                    outcomes[group_name] = outcomes[leader]
+        return outcomes
+
+    def share(self, key, group_name):
+        """
+        None when this group has to make the request for 'key' (then report it through run());
+        otherwise a Future with the result, or the error, of the group that made it.
+        """
+        with self._lock:
+            self.groups += 1
+            future = self._running.get(key) or self._recent.get(key)
+            if future is None:
+                self._running[key] = Future()
+                self.requests += 1
+                return None
+            self.shared.add(group_name)
+        count("calls_saved")
+        return future
+
+    def run(self, key, fn):
+        """Calls fn() for the group that share() chose for 'key' and hands the outcome to the groups sharing it."""
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                future = self._running.pop(key)  # later groups with this key try again
+            future.set_exception(e)
+            raise
+        with self._lock:
+            future = self._running.pop(key)
+            self._recent[key] = future
+            while len(self._recent) > self.window:
+                self._recent.popitem(last=False)
+        future.set_result(result)
+        return result
+
+    def report(self):
+        return {"groups": self.groups, "requests": self.requests, "calls_saved": self.groups - self.requests}
+
+    def summary_line(self):
+        r = self.report()
+        return (f"{r['calls_saved']} requests saved: {r['requests']} requests for {r['groups']} groups "
+                f"(groups with identical input share one request)")
@@ -0,0 +1,161 @@
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+import config
+
+
+def provider_limits(api_url):
+    """
+    Looks up the concurrency and rate limits configured for the provider behind
+    'api_url' in config.DEFAULT_CHAT_MODELS, falling back to config.DEFAULT_PROVIDER_LIMITS.
+    """
+    limits = dict(config.DEFAULT_PROVIDER_LIMITS)
+    for chat_model in config.DEFAULT_CHAT_MODELS.values():
+        if chat_model["api_url"] == api_url:
+            for key in limits:
+                if key in chat_model:
+                    limits[key] = chat_model[key]
+            break
+    return limits
+
+
+class RateLimiter:
+    """
+    Spaces out request starts so that no more than 'requests_per_minute'
+    requests begin in any minute. Shared by all worker threads.
+    """
+
+    def __init__(self, requests_per_minute=None):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of 'values' (pct in 0–100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize_latencies(latencies, elapsed):
+    """Throughput and latency summary for a finished dispatch run."""
+    count = len(latencies)
+    return {
+        "items": count,
+        "elapsed_sec": round(elapsed, 3),
+        "items_per_sec": round(count / elapsed, 3) if elapsed > 0 else 0.0,
+        "p50_latency_sec": round(percentile(latencies, 50), 3),
+        "p95_latency_sec": round(percentile(latencies, 95), 3),
+    }
+
+
+def timed_call(fn, item, limiter):
+    """Runs fn(item) after waiting on the rate limiter; returns (value, error, latency)."""
+    limiter.wait()
+    started = time.perf_counter()
+    try:
+        return fn(item), None, time.perf_counter() - started
+    except Exception as e:
+        return None, e, time.perf_counter() - started
+
+
+def submit(pool, fn, item, limiter):
+    """Submits timed_call in a copy of the caller's context, so context variables (e.g. the active run recorder) carry over."""
+    return pool.submit(contextvars.copy_context().run, timed_call, fn, item, limiter)
+
+
+def dispatch(items, fn, max_workers=1, requests_per_minute=None, on_result=None):
+    """
+    Calls fn(item) for every item using up to 'max_workers' threads.
+
+    Returns (results, stats) where results[i] is a (value, error) tuple for items[i],
+    so callers get deterministic input ordering regardless of completion order.
+    'on_result(index, item, value, error, latency)' is invoked from the calling
+    thread as each item finishes, which keeps Streamlit calls off the worker threads.
+    """
+    items = list(items)
+    limiter = RateLimiter(requests_per_minute)
+    results = [None] * len(items)
+    latencies = []
+
+    run_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+        futures = {submit(pool, fn, item, limiter): i for i, item in enumerate(items)}
+        for future in as_completed(futures):
+            i = futures[future]
+            value, error, latency = future.result()
+            results[i] = (value, error)
+            latencies.append(latency)
+            if on_result:
+                on_result(i, items[i], value, error, latency)
+
+    stats = summarize_latencies(latencies, time.perf_counter() - run_started)
+    return results, stats
+
+
+def waiting_on(shared):
+    """A (value, error, latency) future that completes along with 'shared'."""
+    future = Future()
+
+    def done(f):
+        error = f.exception()
+        future.set_result((None if error else f.result(), error, 0.0))
+
+    shared.add_done_callback(done)
+    return future
+
+
+def dispatch_ordered(items, fn, max_workers=1, requests_per_minute=None, resolve=None):
+    """
+    Streaming counterpart of dispatch(): yields (index, item, value, error, latency) in input
+    order, each as soon as it and every item before it have finished. At most
+    'max_workers' * 2 items are submitted ahead of the one being waited on, which
+    keeps memory bounded on very long inputs. When 'resolve(item)' returns a value
+    other than None, that value is used as is: fn is not called and no rate-limit
+    slot is spent on the item. When it returns a Future (e.g. the call of an earlier
+    item with the same input), the item takes that future's result or exception.
+    """
+    limiter = RateLimiter(requests_per_minute)
+    max_workers = max(1, int(max_workers))
+    iterator = enumerate(items)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        def submit_next():
+            for i, item in iterator:
+                ready = resolve(item) if resolve else None
+                if isinstance(ready, Future):
+                    future = waiting_on(ready)
+                elif ready is not None:
+                    future = Future()
+                    future.set_result((ready, None, 0.0))
+                else:
+                    future = submit(pool, fn, item, limiter)
+                pending.append((i, item, future))
+                return True
+            return False
+
+        while len(pending) < max_workers * 2 and submit_next():
+            pass
+        while pending:
+            i, item, future = pending.popleft()
+            value, error, latency = future.result()
+            submit_next()
+            yield i, item, value, error, latency
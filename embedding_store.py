@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is optional
+    pa = None
+    pq = None
+
+FORMATS = ["npy", "parquet"]
+
+
+def vectors_to_matrix(vectors, dtype="float32"):
+    """
+    Packs a list of vectors (None for rows without an embedding) into one contiguous
+    (rows × dims) matrix. Missing rows are left as zero vectors; the returned mask
+    says which rows have a real embedding.
+    """
+    mask = np.array([v is not None for v in vectors], dtype=bool)
+    dims = len(next((v for v in vectors if v is not None), []))
+    matrix = np.zeros((len(vectors), dims), dtype=dtype)
+    for i, vector in enumerate(vectors):
+        if vector is not None:
+            matrix[i] = vector
+    return matrix, mask
+
+
+def save_embeddings(base_path, vectors, row_ids, dtype="float32", fmt="npy"):
+    """
+    Writes embeddings next to a row-id index and returns the paths written.
+
+    - "npy":     <base>.npy matrix (row i == input row i) plus <base>.index.csv
+    - "parquet": <base>.parquet with row_id, has_embedding and a fixed-size-list embedding column
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown embedding format '{fmt}', expected one of {FORMATS}")
+    os.makedirs(os.path.dirname(os.path.abspath(base_path)), exist_ok=True)
+    matrix, mask = vectors_to_matrix(vectors, dtype)
+    index = pd.DataFrame({"row_id": [str(r) for r in row_ids], "has_embedding": mask})
+
+    if fmt == "npy":
+        np.save(f"{base_path}.npy", matrix)
+        index.to_csv(f"{base_path}.index.csv", index=False)
+        return [f"{base_path}.npy", f"{base_path}.index.csv"]
+
+    if pa is None:
+        raise ImportError("Parquet output requires pyarrow (pip install pyarrow)")
+    flat = pa.array(matrix.reshape(-1))
+    table = pa.table({
+        "row_id": pa.array(index["row_id"].tolist(), type=pa.string()),
+        "has_embedding": pa.array(mask),
+        "embedding": pa.FixedSizeListArray.from_arrays(flat, matrix.shape[1]),
+    })
+    pq.write_table(table, f"{base_path}.parquet", compression="zstd")
+    return [f"{base_path}.parquet"]
+
+
+def load_embeddings(base_path):
+    """
+    Returns (matrix, index) for embeddings written by save_embeddings.
+
+    .npy matrices are memory-mapped read-only, so nothing is copied until rows are
+    touched. Parquet is decoded once into a single contiguous buffer and viewed as
+    a matrix without a further copy.
+    """
+    if os.path.exists(f"{base_path}.npy"):
+        matrix = np.load(f"{base_path}.npy", mmap_mode="r")
+        index = pd.read_csv(f"{base_path}.index.csv", dtype={"row_id": str})
+        return matrix, index
+
+    if pq is None:
+        raise ImportError("Reading Parquet embeddings requires pyarrow (pip install pyarrow)")
+    table = pq.read_table(f"{base_path}.parquet", memory_map=True)
+    column = table.column("embedding").combine_chunks()
+    dims = column.type.list_size
+    matrix = column.values.to_numpy(zero_copy_only=True).reshape(-1, dims)
+    index = table.select(["row_id", "has_embedding"]).to_pandas()
+    return matrix, index
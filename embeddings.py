@@ -0,0 +1,154 @@
+import random
+import time
+
+import openai
+
+import config
+from dispatch import dispatch_ordered
+from instrumentation import count, current_recorder
+from utils import estimate_tokens
+
+# Errors worth retrying; anything else (e.g. InvalidRequestError) fails the batch immediately
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+)
+
+
+def truncate_input(text, max_tokens=config.EMBEDDING_MAX_INPUT_TOKENS):
+    """'text' cut at a word boundary to about 'max_tokens' (estimated), so one long row cannot fail its batch."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    cut = text[:max_tokens * 4]
+    return cut[:cut.rfind(" ")] if " " in cut else cut
+
+
+def pack_batches(texts, max_tokens=config.EMBEDDING_MAX_BATCH_TOKENS, max_items=config.EMBEDDING_MAX_BATCH_ITEMS):
+    """
+    Packs consecutive texts into batches bounded by an estimated token budget and an
+    item count. Returns a list of (start, end) index ranges into 'texts'.
+    """
+    batches = []
+    start = 0
+    tokens = 0
+    for i, text in enumerate(texts):
+        cost = estimate_tokens(text)
+        if i > start and (tokens + cost > max_tokens or i - start >= max_items):
+            batches.append((start, i))
+            start, tokens = i, 0
+        tokens += cost
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+def embed_batch(texts, embedding_model, max_retries=config.EMBEDDING_MAX_RETRIES):
+    """Embeds one batch, retrying transient failures with exponential backoff and jitter."""
+    for attempt in range(max_retries + 1):
+        started = time.perf_counter()
+        try:
+            response = openai.Embedding.create(model=embedding_model, input=texts)
+            items = sorted(response["data"], key=lambda item: item["index"])
+            usage = response.get("usage") or {}
+            current_recorder().record_request(
+                embedding_model, time.perf_counter() - started, 200, usage.get("prompt_tokens", 0), 0, attempt
+            )
+            count("items", len(texts))
+            return [item["embedding"] for item in items]
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                current_recorder().record_request(
+                    embedding_model, time.perf_counter() - started, type(e).__name__, retries=attempt
+                )
+                raise
+            time.sleep(min(60.0, 2 ** attempt) + random.uniform(0, 1))
+        except Exception as e:
+            current_recorder().record_request(
+                embedding_model, time.perf_counter() - started, type(e).__name__, retries=attempt
+            )
+            raise
+
+
+def embed_halving(texts, embedding_model):
+    """
+    embed_batch, splitting the batch in half on a non-retryable error (e.g. an input the
+    model rejects) and again down to single texts, so only the texts that fail are lost.
+    Returns (vectors, failures): None for each failed text, and its (offset, error).
+    """
+    try:
+        return embed_batch(texts, embedding_model), []
+    except RETRYABLE_ERRORS:
+        raise
+    except Exception as e:
+        if len(texts) == 1:
+            return [None], [(0, e)]
+    middle = len(texts) // 2
+    head, head_failures = embed_halving(texts[:middle], embedding_model)
+    tail, tail_failures = embed_halving(texts[middle:], embedding_model)
+    return head + tail, head_failures + [(middle + offset, error) for offset, error in tail_failures]
+
+
+def iter_embeddings(texts, embedding_model, max_workers=config.EMBEDDING_MAX_WORKERS, on_batch=None, on_error=None):
+    """
+    Embeds 'texts' and yields (row_index, vector) in row order.
+
+    Identical texts are sent once, empty texts are skipped (their vector is None),
+    and batches run concurrently. Rows are yielded as soon as every batch they depend
+    on has finished, so callers see progress long before the last batch returns.
+    'on_batch(done, total, latency)' is called after each batch. A batch that still
+    fails after its retries leaves its rows' vectors as None and is reported to
+    'on_error(message)'; the other batches are kept. A batch rejected outright is
+    halved until only the texts that fail are left empty, and each is reported. Texts
+    are cut to config.EMBEDDING_MAX_INPUT_TOKENS before they are sent.
+    """
+    # Deduplicate in order of first appearance, so rows can be released batch by batch
+    unique_pos = {}
+    row_pos = []
+    first_rows = []
+    for row, text in enumerate(texts):
+        if not text:
+            row_pos.append(None)
+            continue
+        if text not in unique_pos:
+            unique_pos[text] = len(unique_pos)
+            first_rows.append(row)
+        row_pos.append(unique_pos[text])
+    unique = [truncate_input(text) for text in unique_pos]
+
+    batches = pack_batches(unique)
+    vectors = [None] * len(unique)
+    ready = 0
+    next_row = 0
+
+    results = dispatch_ordered(
+        batches,
+        lambda span: embed_halving(unique[span[0]:span[1]], embedding_model),
+        max_workers=max_workers,
+    )
+    for done, (_, (start, end), result, error, latency) in enumerate(results, start=1):
+        if error is None:
+            batch_vectors, failures = result
+            vectors[start:end] = batch_vectors
+            for offset, text_error in failures:
+                count("failed_embeddings")
+                if on_error:
+                    on_error(f"Embedding failed for row {first_rows[start + offset]} (left empty): {text_error}")
+        else:
+            count("failed_embeddings", end - start)
+            if on_error:
+                on_error(f"Embedding batch {done}/{len(batches)} failed ({end - start} texts left empty): {error}")
+        ready = end
+        if on_batch:
+            on_batch(done, len(batches), latency)
+        while next_row < len(row_pos) and (row_pos[next_row] is None or row_pos[next_row] < ready):
+            pos = row_pos[next_row]
+            yield next_row, None if pos is None else vectors[pos]
+            next_row += 1
+
+    # Trailing rows with empty text
+    while next_row < len(row_pos):
+        yield next_row, None
+        next_row += 1
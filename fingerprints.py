@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+import pandas as pd
+
+import config
+from columnar import is_parquet, read_chunks
+
+
+def fingerprint(stage, model_name, prompt):
+    """
+    Content hash of one group's request. The prompt already carries everything from the
+    group that shapes the output (translation, commentary, mode), so an edit to any of
+    them, or a different model, changes the fingerprint.
+    """
+    material = json.dumps([stage, model_name, prompt], ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def manifest_path(output_path):
+    return output_path + ".manifest.json"
+
+
+class PreviousOutput:
+    """
+    Rows of a previous output (CSV or Parquet), looked up by group key (as str).
+
+    The file is read once, chunk by chunk, into a temporary SQLite table of each group's
+    rows, so only one chunk and the groups being reused are ever held in memory.
+    """
+
+    def __init__(self, output_path, group_col, chunksize=config.STREAM_CHUNK_ROWS):
+        self._dir = tempfile.TemporaryDirectory(prefix="previous-output-")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(self._dir.name, "rows.sqlite"), check_same_thread=False)
+        self._conn.execute("CREATE TABLE rows (grp TEXT NOT NULL, records TEXT NOT NULL)")
+        self.columns = pd.Index([])
+        for chunk in self._read_chunks(output_path, group_col, chunksize):
+            self.columns = chunk.columns
+            if group_col not in chunk.columns:
+                break
+            self._conn.executemany(
+                "INSERT INTO rows (grp, records) VALUES (?, ?)",
+                (
+                    (group_name, json.dumps(rows.to_dict("records"), ensure_ascii=False, default=str))
+                    for group_name, rows in chunk.groupby(group_col, sort=False)
+                )
+            )
+        self._conn.execute("CREATE INDEX rows_grp ON rows (grp)")
+        self._conn.commit()
+
+    @staticmethod
+    def _read_chunks(output_path, group_col, chunksize):
+        if not is_parquet(output_path):
+            yield from pd.read_csv(output_path, dtype={group_col: str}, keep_default_na=False, chunksize=chunksize)
+            return
+        for chunk in read_chunks(output_path, chunksize):
+            chunk = chunk.fillna("")
+            if group_col in chunk.columns:
+                chunk[group_col] = chunk[group_col].astype(str)
+            yield chunk
+
+    def __contains__(self, group_name):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM rows WHERE grp = ? LIMIT 1", (str(group_name),)).fetchone() is not None
+
+    def rows(self, group_name):
+        with self._lock:
+            parts = self._conn.execute("SELECT records FROM rows WHERE grp = ? ORDER BY rowid", (str(group_name),)).fetchall()
+        return pd.DataFrame([record for (records,) in parts for record in json.loads(records)], columns=self.columns)
+
+
+class FingerprintManifest:
+    """
+    Per-group fingerprints of the inputs behind an output CSV, stored beside it as
+    '<output>.manifest.json'. Groups whose fingerprint matches the previous run (and
+    that are present in the previous output) can be carried over instead of being
+    re-requested. Only groups that were recorded as successfully produced are saved,
+    so a failed group is retried on the next run.
+    """
+
+    def __init__(self, output_path, stage):
+        self.output_path = output_path
+        self.stage = stage
+        self.path = manifest_path(output_path)
+        self.previous = {}
+        self.current = {}
+        self._previous_output = None
+        if os.path.exists(self.path) and os.path.exists(output_path):
+            with open(self.path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("stage") == stage:
+                self.previous = manifest.get("groups", {})
+
+    def previous_output(self, group_col):
+        """
+        The previous output, read once (into a temporary on-disk index), so it must first
+        be called before a new run overwrites the file. None when there is nothing to reuse.
+        """
+        if not self.previous:
+            return None
+        if self._previous_output is None:
+            self._previous_output = PreviousOutput(self.output_path, group_col)
+        return self._previous_output
+
+    def fingerprint(self, model_name, prompt):
+        return fingerprint(self.stage, model_name, prompt)
+
+    def unchanged(self, group_name, group_fingerprint):
+        return self.previous.get(str(group_name)) == group_fingerprint
+
+    def record(self, group_name, group_fingerprint):
+        self.current[str(group_name)] = group_fingerprint
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"stage": self.stage, "groups": self.current}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
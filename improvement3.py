@@ -1,41 +1,26 @@
 import streamlit as st
 import pandas as pd
 import json
-import requests
+import os
 import textwrap
+from contextlib import nullcontext
+
+import config
+from columnar import read_chunks, read_columns, show_parquet_download
+from dedupe import RequestPlan
+from fingerprints import FingerprintManifest
+from instrumentation import RunRecorder, show_run_report
+from response_cache import get_cache
+from routing import Router, provider_columns, show_routing_report
+from run_journal import RunJournal, journal_path
+from sections import SectionBuilder, split_groups
+from streaming import iter_csv_groups, open_output, verify_sorted
+from uploads import read_upload
 
 # Improvement 3: Thematic Splitting, each new section => new row
 
-def run_improvement3(model_name, api_url, api_key, headers):
-    st.header("🧠 Improvement 3: Thematic Splitting into Sections (150–200 words)")
-    improvement3_file = st.file_uploader("📂 Upload CSV from Improvement 2", type="csv", key="improvement3")
-
-    if improvement3_file and st.button("🚀 Split Commentary into Thematic Sections"):
-        df = pd.read_csv(improvement3_file)
-        st.success("✅ File loaded!")
-        st.dataframe(df.head())
-
-        # We'll create a new DataFrame to store the results (one row per section)
-        columns_needed = list(df.columns) + [
-            "SectionNumber", "ThemeTitle", "ThemeText", "ContextualQuestion",
-            "ThemeSummary", "Keywords", "Outline"
-        ]
-
-        result_df = pd.DataFrame(columns=columns_needed)
-
-        # Group by 'Commentary Group' as usual
-        grouped = df.groupby("Commentary Group")
-
-        for group_name, group_df in grouped:
-            st.markdown(f"### 📘 Processing Group: `{group_name}` for thematic sections")
-
-            commentary_series = group_df["English Commentary"].dropna().astype(str)
-            commentary = commentary_series.iloc[0] if not commentary_series.empty else ""
-
-            if not commentary:
-                continue
-
-            prompt = f"""
+def build_split_prompt(commentary):
+    return f"""
 Split the following commentary into thematic sections (150–200 words each). For each section, extract:
 - SectionNumber (1, 2, 3,...)
 - ThemeTitle (short, descriptive)
@@ -51,54 +36,167 @@ Commentary:
 {commentary}
 """
 
-            payload = {
-                "model": model_name,
-                "messages": [
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.4,
-                "max_tokens": 1200
-            }
-
-            try:
-                with st.spinner(f"Splitting group {group_name}..."):
-                    response = requests.post(api_url, headers=headers, json=payload, timeout=90)
-                    reply = response.json()
-                    raw_content = reply["choices"][0]["message"]["content"]
-                    st.code(raw_content, language="json")
-
-                    cleaned = raw_content.strip().replace("```json", "").replace("```", "").strip()
-                    data = json.loads(cleaned)
-
-                    for section in data:
-                        new_row = {}
-                        for col in df.columns:
-                            new_row[col] = group_df.iloc[0][col]
-
-                        section_num = section.get("SectionNumber", "")
-                        new_row["SectionNumber"] = f"{group_name} - Section {section_num}"
-                        new_row["ThemeTitle"] = section.get("ThemeTitle", "")
-                        new_row["ThemeText"] = section.get("ThemeText", "")
-                        new_row["ContextualQuestion"] = section.get("ContextualQuestion", "")
-                        new_row["ThemeSummary"] = section.get("ThemeSummary", "")
-                        new_row["Keywords"] = ", ".join(section.get("Keywords", []))
-                        new_row["Outline"] = "; ".join(section.get("Outline", []))
-
-                        result_df = pd.concat([result_df, pd.DataFrame([new_row])], ignore_index=True)
-
-            except Exception as e:
-                st.warning(f"❌ Failed for group {group_name}: {e}")
+
+def split_dataframe(df, model_name, api_url, headers, use_cache=True, journal=None, on_group=None,
+                    stream=False, on_section=None, manifest=None, plan=None, segment_tokens=None):
+    """Splits every Commentary Group of an in-memory DataFrame. Returns (result_df, counts)."""
+    # Sections are accumulated column-wise and turned into one DataFrame at the end (one row per section)
+    builder = SectionBuilder(provider_columns(df.columns, api_url))
+    counts = split_groups(
+        df.groupby("Commentary Group"), builder, build_split_prompt, model_name, api_url, headers,
+        use_cache=use_cache, journal=journal, on_group=on_group, stream=stream, on_section=on_section,
+        manifest=manifest, plan=plan, segment_tokens=segment_tokens
+    )
+    return builder.to_frame(), counts
+
+
+def split_csv_stream(source, out_path, model_name, api_url, headers, use_cache=True, journal=None, on_group=None,
+                     stream=False, on_section=None, manifest=None, plan=None, segment_tokens=None):
+    """
+    Streaming counterpart of split_dataframe: reads 'source' (sorted by Commentary Group)
+    in chunks and appends section rows to 'out_path' (CSV, or Parquet for a .parquet path)
+    group by group. Returns (rows, counts).
+    """
+    if manifest:
+        manifest.previous_output("Commentary Group")  # read before out_path is overwritten
+    verify_sorted(source, "Commentary Group")
+    columns = read_columns(source)
+    builder = SectionBuilder(provider_columns(columns, api_url))
+    groups = iter_csv_groups(source, "Commentary Group", chunksize=config.STREAM_CHUNK_ROWS)
+    with open_output(out_path) as writer:
+        counts = split_groups(
+            groups, builder, build_split_prompt, model_name, api_url, headers,
+            use_cache=use_cache, journal=journal, writer=writer, on_group=on_group,
+            stream=stream, on_section=on_section, manifest=manifest, plan=plan, segment_tokens=segment_tokens
+        )
+    return writer.rows, counts
+
+
+def run_improvement3(model_name, api_url, api_key, headers):
+    st.header("🧠 Improvement 3: Thematic Splitting into Sections (150–200 words)")
+    improvement3_file = st.file_uploader("📂 Upload CSV (or Parquet) from Improvement 2", type=["csv", "parquet"], key="improvement3")
+    use_cache = st.checkbox("💾 Reuse cached responses", value=True, key="improvement3_use_cache")
+    resume = st.checkbox("♻️ Resume from run journal (skip groups already split)", value=True, key="improvement3_resume")
+    streaming = st.checkbox(
+        "🌊 Streaming mode for very large files (input must be sorted by Commentary Group)",
+        value=False,
+        key="improvement3_streaming"
+    )
+    stream_replies = st.checkbox(
+        "⚡ Stream model replies (show each section as soon as it arrives)", value=False, key="improvement3_stream_replies"
+    )
+    incremental = st.checkbox(
+        "🔁 Only re-split groups whose commentary changed since the last output of this file",
+        value=True,
+        key="improvement3_incremental"
+    )
+    route = st.checkbox(
+        "🔀 Route across the configured providers (hedge slow requests, fail over on errors)",
+        value=False,
+        key="improvement3_route"
+    )
+    dedupe = st.checkbox(
+        "🧬 One request per distinct commentary (identical groups share the sections)",
+        value=True,
+        key="improvement3_dedupe"
+    )
+    segment = st.checkbox(
+        "✂️ Cut long commentary into segments that are split in parallel (no sections lost to cut-off replies)",
+        value=True,
+        key="improvement3_segment"
+    )
+
+    if improvement3_file and st.button("🚀 Split Commentary into Thematic Sections"):
+        if streaming:
+            # Only the first rows are loaded here; groups are read chunk by chunk and sections written to disk
+            df = next(read_chunks(improvement3_file, 5))
+            improvement3_file.seek(0)
+        else:
+            df = read_upload(improvement3_file)
+        st.success("✅ File loaded!")
+        st.dataframe(df.head())
+
+        cache_snapshot = get_cache().counters()
+
+        # Completed groups are journaled to disk so an interrupted run can pick up where it stopped
+        journal = RunJournal(journal_path("improvement3", improvement3_file.getvalue(), model_name))
+        if not resume:
+            journal.clear()
+        completed = journal.completed()
+        if completed:
+            st.info(f"♻️ Resuming: {len(completed)} groups restored from `{journal.path}`")
+
+        counters = st.empty()
+        recorder = RunRecorder("improvement3")
+
+        def show_group(group_name, status, sections, error):
+            if status == "split":
+                st.markdown(f"### 📘 Processed Group: `{group_name}` for thematic sections")
+                st.code(json.dumps(sections, indent=2), language="json")
+            elif status == "failed":
+                st.warning(f"❌ Failed for group {group_name}: {error}")
+            counters.caption(recorder.counters_line())
+
+        def show_section(group_name, section):
+            st.markdown(f"⚡ `{group_name}` · Section {section.get('SectionNumber', '')}: {section.get('ThemeTitle', '')}")
+
+        stream_options = dict(stream=stream_replies, on_section=show_section,
+                              segment_tokens=config.SPLIT_SEGMENT_TOKENS if segment else None)
+
+        # 🔁 The output stays on disk with a fingerprint manifest beside it; unchanged groups are carried over next time
+        out_path = os.path.join(config.OUTPUT_DIR, f"{os.path.splitext(improvement3_file.name)[0]}_step3_newrows.csv")
+        manifest = FingerprintManifest(out_path, "improvement3") if incremental else None
+        stream_options["manifest"] = manifest
+        plan = RequestPlan() if dedupe else None
+        stream_options["plan"] = plan
+        router = Router.from_config(api_url, headers, model_name) if route else None
+
+        with st.spinner("Splitting commentary groups..."), recorder.activate(), recorder.stage("split"), \
+                (router.activate() if router else nullcontext()):
+            if streaming:
+                try:
+                    rows, counts = split_csv_stream(
+                        improvement3_file, out_path, model_name, api_url, headers,
+                        use_cache=use_cache, journal=journal, on_group=show_group, **stream_options
+                    )
+                except ValueError as e:
+                    st.error(f"❌ {e}")
+                    if router:
+                        router.close()
+                    return
+                result_df = pd.read_csv(out_path, nrows=5) if rows else pd.DataFrame()
+            else:
+                result_df, counts = split_dataframe(
+                    df, model_name, api_url, headers, use_cache=use_cache, journal=journal, on_group=show_group,
+                    **stream_options
+                )
+                if manifest:
+                    os.makedirs(config.OUTPUT_DIR, exist_ok=True)
+                    result_df.to_csv(out_path, index=False)
+        if manifest:
+            manifest.save()
+            st.caption(f"🔁 {counts['reused']} unchanged groups carried over from `{out_path}`")
 
         st.success("🎉 Commentary successfully split into new rows!")
+        if plan:
+            st.caption(f"🧬 {plan.summary_line()}")
+        hits, misses = get_cache().counters_since(cache_snapshot)
+        st.caption(f"💾 Response cache: {hits} hits, {misses} misses")
+        st.caption(f"📝 Run journal: `{journal.path}`")
+        show_run_report(recorder)
+        if router:
+            show_routing_report(router)
+            router.close()
         st.write("Preview:")
+        # Section values are flattened to text when parsed (sections.section_fields), so the frame is Arrow-safe as is
+        st.dataframe(result_df.head())
 
-        # Fix for Arrow error: convert lists/dicts to strings before showing
-        preview_df = result_df.copy()
-        for col in preview_df.columns:
-            if preview_df[col].apply(lambda x: isinstance(x, (list, dict))).any():
-                preview_df[col] = preview_df[col].apply(lambda x: json.dumps(x) if pd.notnull(x) else "")
-
-        st.dataframe(preview_df.head())
+        if streaming:
+            st.caption(f"🌊 {rows} section rows written to `{out_path}`")
+            with open(out_path, "rb") as f:
+                st.download_button("⬇️ Download CSV with Thematic Sections (New Rows)", f, file_name="enriched_step3_newrows.csv", mime="text/csv")
+            return
 
         csv = result_df.to_csv(index=False).encode("utf-8")
         st.download_button("⬇️ Download CSV with Thematic Sections (New Rows)", csv, file_name="enriched_step3_newrows.csv", mime="text/csv")
+        show_parquet_download(result_df, "⬇️ Download Parquet (Keywords/Outline as lists)", "enriched_step3_newrows.parquet")
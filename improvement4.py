@@ -2,22 +2,83 @@ import streamlit as st
 import pandas as pd
 import openai
 import json
+import os
+
+import config
+import relationships
+from embedding_store import save_embeddings, vectors_to_matrix
+from embeddings import iter_embeddings
+from instrumentation import RunRecorder, show_run_report
+from uploads import read_upload
+
+EMBEDDING_OUTPUTS = {
+    "CSV (JSON 'Embedding' column)": None,
+    "NumPy .npy matrix (float32)": ("npy", "float32"),
+    "NumPy .npy matrix (float16)": ("npy", "float16"),
+    "Parquet fixed-size list (float32)": ("parquet", "float32"),
+}
+
+def configure_openai(api_key, api_base=config.EMBEDDING_API_URL):
+    # Set OpenAI API key and base (OpenAI by default; e.g. mock_provider for offline runs)
+    openai.api_key = api_key
+    openai.api_base = api_base
+
+
+def row_ids_for(df):
+    return df["SectionNumber"] if "SectionNumber" in df.columns else df.index
+
+
+def add_embeddings(df, embedding_model, max_workers=config.EMBEDDING_MAX_WORKERS, on_batch=None, on_error=None):
+    """Adds an 'Embedding' column (a vector per row, None for empty ThemeText or a failed batch)."""
+    texts = df["ThemeText"].fillna("").astype(str).tolist()
+    # Texts are deduplicated and packed into token-budgeted batches; vectors come back in row order
+    vectors = [None] * len(texts)
+    for row, vector in iter_embeddings(texts, embedding_model, max_workers=max_workers, on_batch=on_batch, on_error=on_error):
+        vectors[row] = vector
+    df["Embedding"] = vectors
+    return df
+
+
+def add_relationships(df, top_k=5, on_block=None):
+    """
+    Adds RelatedSections/RelatedScores (and CrossGroupLinks when there is a Commentary Group)
+    from the 'Embedding' column. Returns (df, approximate) where approximate says whether
+    the FAISS index was used instead of exact search.
+    """
+    matrix, mask = vectors_to_matrix(df["Embedding"].tolist())
+    use_approx = len(df) > config.RELATED_APPROX_MIN_ROWS and relationships.faiss is not None
+    search = relationships.approximate_top_k if use_approx else relationships.top_k_related
+    indices, scores = search(matrix, k=top_k, mask=mask, on_block=on_block)
+    groups = df["Commentary Group"].tolist() if "Commentary Group" in df.columns else None
+    for col, values in relationships.relationship_columns(indices, scores, row_ids_for(df), groups).items():
+        df[col] = values
+    return df, use_approx
+
+
+def embeddings_to_json(df):
+    """Converts embedding vectors to JSON strings for CSV export."""
+    df["Embedding"] = df["Embedding"].apply(
+        lambda x: json.dumps(x.tolist()) if hasattr(x, "tolist") 
+                  else json.dumps(x) if isinstance(x, (list, tuple))
+                  else ""
+    )
+    return df
+
 
 def run_improvement4(embedding_model, embedding_api_url, api_key, headers):
     st.header("🔎 Improvement 4: Embeddings for ThemeText")
     st.markdown(
         "This step adds an 'Embedding' column to your CSV using OpenAI's Embeddings API. "
-        "It supports models like `text-embedding-3-small` or `text-embedding-ada-002`."
+        "It supports models like `text-embedding-3-small` or `text-embedding-ada-002`. "
+        "Optionally, each row is then linked to its most similar sections ('RelatedSections')."
     )
 
-    # Set OpenAI API key and base (use the default base)
-    openai.api_key = api_key
-    openai.api_base = "https://api.openai.com/v1"
+    configure_openai(api_key, embedding_api_url)
 
     # --- File Upload ---
-    uploaded_file = st.file_uploader("📂 Upload your CSV file (must include 'ThemeText' column)", type=["csv"], key="improvement4")
+    uploaded_file = st.file_uploader("📂 Upload your CSV or Parquet file (must include 'ThemeText' column)", type=["csv", "parquet"], key="improvement4")
     if uploaded_file:
-        df = pd.read_csv(uploaded_file)
+        df = read_upload(uploaded_file)
         st.subheader("📄 Uploaded Data")
         st.dataframe(df.head())
 
@@ -27,29 +88,78 @@ def run_improvement4(embedding_model, embedding_api_url, api_key, headers):
 
         # --- Step 1: Generate Embeddings for ThemeText ---
         st.markdown("## 1) Generate Embeddings for 'ThemeText'")
+        max_workers = st.number_input(
+            "⚡ Parallel embedding batches",
+            min_value=1,
+            max_value=16,
+            value=config.EMBEDDING_MAX_WORKERS,
+            key="improvement4_workers"
+        )
+        map_relationships = st.checkbox("🔗 Map relationships (top-k related sections per row)", value=True, key="improvement4_related")
+        top_k = st.number_input("Related sections per row", min_value=1, max_value=50, value=5, key="improvement4_top_k")
+        output_choice = st.radio("💽 Embedding output", list(EMBEDDING_OUTPUTS.keys()), key="improvement4_output")
         if st.button("🔮 Start Embedding"):
-            with st.spinner("Generating embeddings..."):
+            texts = df["ThemeText"].fillna("").astype(str).tolist()
+            progress = st.progress(0.0, text="Embedding batches...")
+            counters = st.empty()
+            recorder = RunRecorder("improvement4")
+            errors = []
+
+            def show_batch(done, total, latency):
+                progress.progress(done / total, text=f"Embedded batch {done}/{total} ({latency:.1f}s)")
+                counters.caption(recorder.counters_line())
+
+            with st.spinner(f"Generating embeddings for {len(texts)} rows..."), recorder.activate(), recorder.stage("embed"):
                 try:
-                    texts = df["ThemeText"].fillna("").tolist()
-                    response = openai.Embedding.create(
-                        model=embedding_model,
-                        input=texts
-                    )
-                    vectors = [item["embedding"] for item in response["data"]]
-                    df["Embedding"] = vectors
-                    st.success("✅ Embeddings added to 'Embedding' column")
+                    df = add_embeddings(df, embedding_model, max_workers=max_workers, on_batch=show_batch, on_error=errors.append)
+                    for error in errors:
+                        st.warning(f"⚠️ {error}")
+                    st.success(f"✅ Embeddings added to 'Embedding' column ({len(set(filter(None, texts)))} unique texts sent)")
                     st.dataframe(df.head())
                 except Exception as e:
                     st.error(f"Embedding failed: {e}")
                     return
 
+            # --- Step 2: Relationship Mapping over normalized embeddings ---
+            if map_relationships:
+                st.markdown("## 2) Relationship Mapping")
+                timings = []
+                with st.spinner(f"Finding {top_k} related sections per row..."), recorder.activate(), recorder.stage("relationships"):
+                    df, use_approx = add_relationships(
+                        df, top_k=top_k,
+                        on_block=lambda start, end, seconds: timings.append((start, end, round(seconds, 3)))
+                    )
+                st.success(f"✅ Added 'RelatedSections' and 'RelatedScores' columns ({'approximate' if use_approx else 'exact'} search)")
+                st.caption(f"⏱️ Similarity search: {len(timings)} blocks, {sum(t[2] for t in timings):.2f}s total")
+                st.dataframe(pd.DataFrame(timings, columns=["First row", "Last row (excl.)", "Seconds"]))
+            show_run_report(recorder)
+
+            binary_output = EMBEDDING_OUTPUTS[output_choice]
+            if binary_output:
+                # Vectors go to a contiguous matrix on disk (row i == CSV row i); the CSV keeps only text columns
+                fmt, dtype = binary_output
+                base_path = os.path.join(config.EMBEDDINGS_DIR, os.path.splitext(uploaded_file.name)[0])
+                try:
+                    paths = save_embeddings(base_path, df["Embedding"].tolist(), row_ids_for(df), dtype=dtype, fmt=fmt)
+                except Exception as e:
+                    st.error(f"Failed to save embeddings: {e}")
+                    return
+                st.success(f"✅ Embeddings saved to {', '.join(f'`{p}`' for p in paths)}")
+                for path in paths:
+                    with open(path, "rb") as f:
+                        st.download_button(f"⬇️ Download {os.path.basename(path)}", f.read(), file_name=os.path.basename(path))
+                csv_without_embeddings = df.drop(columns=["Embedding"]).to_csv(index=False).encode("utf-8")
+                st.download_button(
+                    "⬇️ Download CSV (rows aligned with the embedding matrix)",
+                    csv_without_embeddings,
+                    file_name="csv_for_embeddings.csv",
+                    mime="text/csv"
+                )
+                return
+
             # Convert embedding vectors to JSON strings for CSV export
             try:
-                df["Embedding"] = df["Embedding"].apply(
-                    lambda x: json.dumps(x.tolist()) if hasattr(x, "tolist") 
-                              else json.dumps(x) if isinstance(x, (list, tuple))
-                              else ""
-                )
+                df = embeddings_to_json(df)
                 csv_with_embeddings = df.to_csv(index=False).encode("utf-8")
                 st.download_button(
                     "⬇️ Download CSV with Embeddings",
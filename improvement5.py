@@ -1,7 +1,245 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
 import json
+import unicodedata
+from itertools import zip_longest
+
+import config
+from chat_client import chat_completion
+from columnar import show_parquet_download
+from dispatch import dispatch, provider_limits
+from embeddings import pack_batches
+from instrumentation import RunRecorder, count, show_run_report
+from response_cache import get_cache
+from uploads import read_upload
+from utils import parse_json_reply
+
+CHUNK_FIELDS = ["Wisdom", "Reflections", "ChunkOutline", "ChunkQuestions"]
+
+
+def parse_json_object(content):
+    """Parses a reply that should be one JSON object; anything else raises, so it is neither cached nor written back."""
+    obj = parse_json_reply(content)
+    if not isinstance(obj, dict):
+        raise ValueError(f"Expected a JSON object, got {type(obj).__name__}")
+    return obj
+
+
+def request_json(model_name, api_url, headers, prompt, use_cache=True, parse=parse_json_object):
+    return chat_completion(
+        api_url,
+        headers,
+        {"model": model_name,
+         "messages": [{"role": "user", "content": prompt}]},
+        timeout=120,
+        use_cache=use_cache,
+        parse=parse
+    )
+
+
+def build_chunk_prompt(chunk):
+    return (
+        f"For the following text chunk, generate Wisdom, Reflections, "
+        "an outline (3-5 bullets), and 1 contextual question. "
+        f"Text Chunk: {chunk}"
+        "Return JSON with keys: Wisdom, Reflections, ChunkOutline, ChunkQuestions."
+    )
+
+
+def build_chunk_batch_prompt(batch):
+    """Prompt for several chunks at once; 'batch' is a list of (row_id, chunk)."""
+    chunks = "\n\n".join(f"### Chunk {row_id}\n{chunk}" for row_id, chunk in batch)
+    return (
+        "For each of the following text chunks, generate Wisdom, Reflections, "
+        "an outline (3-5 bullets), and 1 contextual question.\n"
+        "Return a JSON array with one object per chunk, each with keys: "
+        "id (the chunk number as given), Wisdom, Reflections, ChunkOutline, ChunkQuestions.\n\n"
+        f"{chunks}"
+    )
+
+
+def parse_chunk_batch(content, row_ids):
+    """
+    Parses a batch reply into {row_id: result}. Objects with an unknown id or missing
+    keys are dropped, so their rows can be retried on their own; raises when the reply
+    is not a JSON array at all.
+    """
+    items = parse_json_reply(content)
+    if not isinstance(items, list):
+        raise ValueError(f"Expected a JSON array, got {type(items).__name__}")
+    wanted = set(row_ids)
+    results = {}
+    for item in items:
+        if not isinstance(item, dict) or not all(field in item for field in CHUNK_FIELDS):
+            continue
+        try:
+            row_id = int(item.get("id"))
+        except (TypeError, ValueError):
+            continue
+        if row_id in wanted:
+            results[row_id] = item
+    return results
+
+
+def normalize_title(title):
+    """Canonical chapter title: Unicode-normalized with whitespace collapsed ('' for missing titles)."""
+    if pd.isna(title):
+        return ""
+    return " ".join(unicodedata.normalize("NFKC", str(title)).split())
+
+
+def build_chapter_prompt(title):
+    return (
+        f"Summarize the chapter titled '{title}' in 50 words. "
+        "Provide an outline of 3-5 bullet points, and 2 contextual questions. "
+        "Return the output as JSON with keys: ChapterSummary, ChapterOutline, ChapterQuestions."
+    )
+
+
+def chapter_index(titles):
+    """
+    Groups rows by normalized title. Returns (prompt_titles, row_positions): for every
+    distinct title (compared case-insensitively) the spelling sent to the model and
+    the positions of its rows, built in one pass over the column.
+    """
+    canonical = [normalize_title(title) for title in titles]
+    keys = pd.Series([title.casefold() for title in canonical])
+    prompt_titles = {}
+    for key, title in zip(keys, canonical):
+        prompt_titles.setdefault(key, title)
+    return prompt_titles, keys.groupby(keys, sort=False).indices
+
+
+def chunk_batches(chunks, batch_chunks=True):
+    """Row positions per chunk request: packed by token budget, or one row per request."""
+    if not batch_chunks:
+        return [[i] for i in range(len(chunks))]
+    return [list(range(start, end))
+            for start, end in pack_batches(chunks, config.CHUNK_BATCH_MAX_TOKENS, config.CHUNK_BATCH_MAX_ITEMS)]
+
+
+def enrich_chunk_batch(rows, chunks, model_name, api_url, headers, use_cache=True):
+    """
+    Enriches the chunks at positions 'rows'. Returns ({row: result}, errors).
+
+    Several rows go out as one packed request; only rows whose batch reply could
+    not be parsed or matched are sent again with the single-chunk prompt, and all of
+    them are when the packed request itself fails (HTTP error, timeout, a prompt too
+    long for the model). A row whose own request fails is reported in 'errors' without
+    losing the rows that succeeded.
+    """
+    results = {}
+    pending = rows
+    if len(rows) > 1:
+        batch = [(i, chunks[i]) for i in rows]
+        try:
+            results = request_json(
+                model_name, api_url, headers, build_chunk_batch_prompt(batch), use_cache,
+                parse=lambda content: parse_chunk_batch(content, rows)
+            )
+        except (ValueError, requests.RequestException):
+            results = {}
+        pending = [i for i in rows if i not in results]
+
+    errors = []
+    for i in pending:
+        try:
+            results[i] = request_json(model_name, api_url, headers, build_chunk_prompt(chunks[i]), use_cache)
+        except json.JSONDecodeError as e:
+            errors.append(f"Invalid JSON for chunk idx {i}: {e.doc}")
+        except Exception as e:
+            errors.append(f"Request failed for chunk idx {i}: {e}")
+    return results, errors
+
+
+def interleave(*lanes):
+    """Round-robin merge of several job lists, so every lane makes progress from the start."""
+    return [job for jobs in zip_longest(*lanes) for job in jobs if job is not None]
+
+
+def enrich_chapters_and_chunks(df, model_name, api_url, headers, use_cache=True, batch_chunks=True,
+                               max_workers=None, requests_per_minute=None, on_error=None, on_progress=None,
+                               chapter_results=None):
+    """
+    Adds chapter-level columns (per 'Detected Title') and chunk-level columns (per 'TEXT CHUNK')
+    to df. Replies that are not valid JSON are skipped and reported via on_error(message).
+
+    Chapter and chunk requests are interleaved on one worker pool (sized from the provider
+    limits by default). Titles are normalized and deduplicated before any request, and
+    results are written back through a title -> row-positions map in one pass per column.
+    'on_progress(done, total)' is called from the calling thread after each request.
+
+    'chapter_results' ({title key: result}) can be shared between calls on successive
+    parts of one dataset: titles already in it are not requested again, and new ones
+    are added to it.
+    """
+    limits = provider_limits(api_url)
+    if max_workers is None:
+        max_workers = limits["max_concurrency"]
+    if requests_per_minute is None:
+        requests_per_minute = limits["requests_per_minute"]
+
+    prompt_titles, title_rows = chapter_index(df["Detected Title"])
+    if chapter_results is None:
+        chapter_results = {}
+    chunks = ["" if pd.isna(chunk) else str(chunk) for chunk in df.get("TEXT CHUNK", pd.Series("", index=df.index))]
+
+    jobs = interleave(
+        [("chapter", key) for key in prompt_titles if key not in chapter_results],
+        [("chunks", rows) for rows in chunk_batches(chunks, batch_chunks)],
+    )
+
+    def run_job(job):
+        lane, target = job
+        if lane == "chapter":
+            return request_json(model_name, api_url, headers, build_chapter_prompt(prompt_titles[target]), use_cache)
+        return enrich_chunk_batch(target, chunks, model_name, api_url, headers, use_cache)
+
+    chapter_cols = {col: np.full(len(df), "", dtype=object) for col in ["ChapterSummary", "ChapterOutline", "ChapterQuestions"]}
+    chunk_results = [None] * len(df)
+
+    def collect(i, job, result, error, latency):
+        lane, target = job
+        count("items")
+        if error is not None:
+            if on_error:
+                label = f"chapter '{prompt_titles[target]}'" if lane == "chapter" else f"chunks {target[0]}–{target[-1]}"
+                if isinstance(error, json.JSONDecodeError):
+                    on_error(f"Invalid JSON for {label}: {error.doc}")
+                else:
+                    on_error(f"Request failed for {label}: {error}")
+        elif lane == "chapter":
+            chapter_results[target] = result
+        else:
+            results, errors = result
+            for row, obj in results.items():
+                chunk_results[row] = obj
+            for message in errors:
+                if on_error:
+                    on_error(message)
+        if on_progress:
+            on_progress(i + 1, len(jobs))
+
+    dispatch(jobs, run_job, max_workers=max_workers, requests_per_minute=requests_per_minute, on_result=collect)
+
+    for key, rows in title_rows.items():
+        result = chapter_results.get(key)
+        if result is None:
+            continue
+        chapter_cols["ChapterSummary"][rows] = result.get("ChapterSummary", "")
+        chapter_cols["ChapterOutline"][rows] = json.dumps(result.get("ChapterOutline", []))
+        chapter_cols["ChapterQuestions"][rows] = json.dumps(result.get("ChapterQuestions", []))
+
+    for col, values in chapter_cols.items():
+        df[col] = values
+    df["Wisdom"] = [obj.get("Wisdom", "") if obj else "" for obj in chunk_results]
+    df["Reflections"] = [obj.get("Reflections", "") if obj else "" for obj in chunk_results]
+    df["ChunkOutline"] = [json.dumps(obj.get("ChunkOutline", [])) if obj else "" for obj in chunk_results]
+    df["ChunkQuestions"] = [json.dumps(obj.get("ChunkQuestions", [])) if obj else "" for obj in chunk_results]
+    return df
+
 
 def run_improvement5(model_name, api_url, api_key, headers):
     """
@@ -10,70 +248,43 @@ def run_improvement5(model_name, api_url, api_key, headers):
     2) Chunk-level: wisdom, reflections, outline, contextual questions for each 'TEXT CHUNK'.
     """
     st.header("📖 Improvement 5: Chapter & Chunk Enrichment")
-    uploaded = st.file_uploader("📂 Upload your CSV", type="csv", key="improve5")
+    uploaded = st.file_uploader("📂 Upload your CSV (or Parquet)", type=["csv", "parquet"], key="improve5")
     if not uploaded:
         return
+    use_cache = st.checkbox("💾 Reuse cached responses", value=True, key="improve5_use_cache")
+    batch_chunks = st.checkbox("📦 Pack several chunks into each request", value=True, key="improve5_batch_chunks")
+
+    # ⚡ Chapter and chunk requests share one pool, bounded by the provider limits
+    limits = provider_limits(api_url)
+    max_in_flight = st.number_input(
+        "⚡ Max requests in flight",
+        min_value=1,
+        max_value=limits["max_concurrency"],
+        value=limits["max_concurrency"],
+        key="improve5_max_in_flight"
+    )
     if st.button("🚀 Enrich Chapters & Chunks"):
-        df = pd.read_csv(uploaded)
+        df = read_upload(uploaded)
         st.success("✅ CSV loaded!")
-        # Initialize new columns
-        df["ChapterSummary"] = ""
-        df["ChapterOutline"] = ""
-        df["ChapterQuestions"] = ""
-        df["Wisdom"] = ""
-        df["Reflections"] = ""
-        df["ChunkOutline"] = ""
-        df["ChunkQuestions"] = ""
-
-        # Chapter-level enrichment
-        for title in df["Detected Title"].unique():
-            prompt = (
-                f"Summarize the chapter titled '{title}' in 50 words. "
-                "Provide an outline of 3-5 bullet points, and 2 contextual questions. "
-                "Return the output as JSON with keys: ChapterSummary, ChapterOutline, ChapterQuestions."
-            )
-            res = requests.post(
-                api_url,
-                headers=headers,
-                json={"model": model_name,
-                      "messages": [{"role": "user", "content": prompt}]}
-            )
-            data = res.json()["choices"][0]["message"]["content"]
-            try:
-                obj = json.loads(data)
-            except json.JSONDecodeError:
-                st.error(f"Invalid JSON for chapter '{title}': {data}")
-                continue
-            mask = df["Detected Title"] == title
-            df.loc[mask, "ChapterSummary"] = obj.get("ChapterSummary", "")
-            df.loc[mask, "ChapterOutline"] = json.dumps(obj.get("ChapterOutline", []))
-            df.loc[mask, "ChapterQuestions"] = json.dumps(obj.get("ChapterQuestions", []))
-
-        # Chunk-level enrichment
-        for idx, row in df.iterrows():
-            chunk = row.get("TEXT CHUNK", "")
-            prompt = (
-                f"For the following text chunk, generate Wisdom, Reflections, "
-                "an outline (3-5 bullets), and 1 contextual question. "
-                f"Text Chunk: {chunk}" 
-                "Return JSON with keys: Wisdom, Reflections, ChunkOutline, ChunkQuestions."
-            )
-            res = requests.post(
-                api_url,
-                headers=headers,
-                json={"model": model_name,
-                      "messages": [{"role": "user", "content": prompt}]}
+        cache_snapshot = get_cache().counters()
+        progress = st.progress(0.0)
+        counters = st.empty()
+        recorder = RunRecorder("improvement5")
+
+        def show_progress(done, total):
+            progress.progress(done / total)
+            counters.caption(recorder.counters_line())
+
+        with st.spinner(f"Enriching chapters and chunks ({max_in_flight} in flight)..."), \
+                recorder.activate(), recorder.stage("chapters"):
+            df = enrich_chapters_and_chunks(
+                df, model_name, api_url, headers, use_cache=use_cache, batch_chunks=batch_chunks,
+                max_workers=max_in_flight, on_error=st.error, on_progress=show_progress
             )
-            data = res.json()["choices"][0]["message"]["content"]
-            try:
-                obj = json.loads(data)
-            except json.JSONDecodeError:
-                st.error(f"Invalid JSON for chunk idx {idx}: {data}")
-                continue
-            df.at[idx, "Wisdom"] = obj.get("Wisdom", "")
-            df.at[idx, "Reflections"] = obj.get("Reflections", "")
-            df.at[idx, "ChunkOutline"] = json.dumps(obj.get("ChunkOutline", []))
-            df.at[idx, "ChunkQuestions"] = json.dumps(obj.get("ChunkQuestions", []))
+
+        hits, misses = get_cache().counters_since(cache_snapshot)
+        st.caption(f"💾 Response cache: {hits} hits, {misses} misses")
+        show_run_report(recorder)
 
         # Download enriched CSV
         csv_data = df.to_csv(index=False).encode("utf-8")
@@ -83,3 +294,7 @@ def run_improvement5(model_name, api_url, api_key, headers):
             file_name="enriched_full.csv",
             mime="text/csv"
         )
+        show_parquet_download(
+            df, "⬇️ Download Parquet (outlines and questions as lists)", "enriched_full.parquet",
+            group_col="Commentary Group" if "Commentary Group" in df.columns else "Detected Title"
+        )
@@ -0,0 +1,189 @@
+"""
+Run instrumentation shared by all stages.
+
+A RunRecorder collects every model request (latency, status, prompt/completion tokens,
+retries) and event counters (cache hits/misses, parse failures, work items), attributed
+to the stage that was active when they happened. The active recorder and stage live in
+context variables; dispatch() copies the context into its worker threads, so requests
+made from a pool are attributed like those made inline.
+"""
+import contextvars
+import csv
+import io
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import config
+from dispatch import percentile
+
+CURRENT_RECORDER = contextvars.ContextVar("csvimprove_recorder", default=None)
+CURRENT_STAGE = contextvars.ContextVar("csvimprove_stage", default="unstaged")
+
+EVENTS = ["items", "cache_hits", "cache_misses", "parse_failures", "hedges", "failovers", "calls_saved", "segments", "failed_segments", "failed_embeddings"]
+
+
+def request_cost(model, prompt_tokens, completion_tokens):
+    """USD cost of one request from config.MODEL_PRICING; 0.0 for models without a price."""
+    price = config.MODEL_PRICING.get(model)
+    if not price:
+        return 0.0
+    return (prompt_tokens * price.get("prompt", 0.0) + completion_tokens * price.get("completion", 0.0)) / 1_000_000
+
+
+class RunRecorder:
+    """Thread-safe collector of requests and events for one run, grouped by stage."""
+
+    def __init__(self, name="run"):
+        self.name = name
+        self.started_at = time.time()
+        self.requests = []
+        self.events = defaultdict(Counter)
+        self.stage_seconds = Counter()
+        # Running totals for counters_line(), so the live view never walks the request list
+        self.totals = Counter()
+        self.cost_usd = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        """Makes this the recorder that requests and events in this context are reported to."""
+        token = CURRENT_RECORDER.set(self)
+        try:
+            yield self
+        finally:
+            CURRENT_RECORDER.reset(token)
+
+    @contextmanager
+    def stage(self, name):
+        """Attributes everything inside the block to stage 'name' and times it."""
+        token = CURRENT_STAGE.set(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stage_seconds[name] += time.perf_counter() - started
+                self.events[name]  # stages without events still show up in the report
+            CURRENT_STAGE.reset(token)
+
+    def record_request(self, model, latency, status, prompt_tokens=0, completion_tokens=0, retries=0):
+        with self._lock:
+            self.requests.append({
+                "stage": CURRENT_STAGE.get(),
+                "model": model,
+                "latency_sec": round(latency, 3),
+                "status": status,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "retries": retries,
+            })
+            self.totals.update(requests=1, errors=int(status != 200), retries=retries,
+                               prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            self.cost_usd += request_cost(model, prompt_tokens, completion_tokens)
+
+    def count(self, event, n=1):
+        with self._lock:
+            self.events[CURRENT_STAGE.get()][event] += n
+            self.totals[event] += n
+
+    def summary(self):
+        """Per-stage metrics: {stage: {...}}, plus a "total" entry across stages."""
+        with self._lock:
+            requests = list(self.requests)
+            events = {stage: Counter(counter) for stage, counter in self.events.items()}
+            seconds = Counter(self.stage_seconds)
+        stages = list(events) + [r["stage"] for r in requests if r["stage"] not in events]
+        result = {}
+        for stage in dict.fromkeys(stages):
+            result[stage] = self._summarize([r for r in requests if r["stage"] == stage], events.get(stage, Counter()),
+                                            seconds.get(stage, 0.0))
+        total_events = sum(events.values(), Counter())
+        result["total"] = self._summarize(requests, total_events, time.time() - self.started_at)
+        return result
+
+    @staticmethod
+    def _summarize(requests, events, elapsed):
+        latencies = [r["latency_sec"] for r in requests]
+        summary = {
+            "requests": len(requests),
+            "errors": sum(1 for r in requests if r["status"] != 200),
+            "retries": sum(r["retries"] for r in requests),
+            "prompt_tokens": sum(r["prompt_tokens"] for r in requests),
+            "completion_tokens": sum(r["completion_tokens"] for r in requests),
+            "p50_latency_sec": round(percentile(latencies, 50), 3),
+            "p95_latency_sec": round(percentile(latencies, 95), 3),
+            "elapsed_sec": round(elapsed, 3),
+            "cost_usd": round(sum(request_cost(r["model"], r["prompt_tokens"], r["completion_tokens"]) for r in requests), 6),
+        }
+        summary.update({event: events.get(event, 0) for event in EVENTS})
+        summary["requests_per_sec"] = round(len(requests) / elapsed, 3) if elapsed > 0 else 0.0
+        summary["items_per_sec"] = round(summary["items"] / elapsed, 3) if elapsed > 0 else 0.0
+        return summary
+
+    def counters_line(self):
+        """One-line live view of the run so far, from the running totals (percentiles are left to summary())."""
+        with self._lock:
+            t = Counter(self.totals)
+            cost = self.cost_usd
+        return (f"🌐 {t['requests']} requests · {t['errors']} errors · {t['retries']} retries · "
+                f"💾 {t['cache_hits']} cache hits · ⚠️ {t['parse_failures']} parse failures · "
+                f"🔤 {t['prompt_tokens']} in / {t['completion_tokens']} out tokens · 💲{cost:.4f}")
+
+    def report(self):
+        return {"run": self.name, "started_at": self.started_at, "stages": self.summary()}
+
+    def report_csv(self):
+        stages = self.summary()
+        out = io.StringIO()
+        fields = ["stage"] + list(stages["total"])
+        writer = csv.DictWriter(out, fieldnames=fields)
+        writer.writeheader()
+        for stage, metrics in stages.items():
+            writer.writerow(dict(metrics, stage=stage))
+        return out.getvalue()
+
+    def write_report(self, base_path=None):
+        """Writes <base_path>.json and <base_path>.csv (default: under config.RUNS_DIR). Returns both paths."""
+        if base_path is None:
+            stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at))
+            base_path = os.path.join(config.RUNS_DIR, "reports", f"{self.name}-{stamp}")
+        os.makedirs(os.path.dirname(os.path.abspath(base_path)), exist_ok=True)
+        json_path, csv_path = base_path + ".json", base_path + ".csv"
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            f.write(self.report_csv())
+        return json_path, csv_path
+
+
+_default_recorder = RunRecorder("default")
+
+
+def current_recorder():
+    """The recorder activated in this context, or a process-wide default one."""
+    return CURRENT_RECORDER.get() or _default_recorder
+
+
+def count(event, n=1):
+    current_recorder().count(event, n)
+
+
+def show_run_report(recorder):
+    """Streamlit summary of a finished run: per-stage table, report files and download."""
+    import streamlit as st
+
+    json_path, csv_path = recorder.write_report()
+    st.markdown("#### 📊 Run report")
+    st.dataframe([dict(metrics, stage=stage) for stage, metrics in recorder.summary().items()])
+    st.caption(f"Report written to `{json_path}` and `{csv_path}`")
+    st.download_button(
+        "⬇️ Download run report (JSON)",
+        json.dumps(recorder.report(), indent=2).encode("utf-8"),
+        file_name=os.path.basename(json_path),
+        mime="application/json",
+        key=f"report_{recorder.name}",
+    )
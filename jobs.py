@@ -0,0 +1,411 @@
+"""
+Background jobs: pipeline runs that outlive the Streamlit script run that started them.
+
+Each submitted job gets a directory under config.JOBS_DIR (input, output, report, log)
+and a row in a SQLite job table, and runs in its own worker process:
+
+    python jobs.py <job_id>
+
+A job waits while config.JOBS_MAX_RUNNING others are running, then runs its stages
+with pipeline.Pipeline, writing progress to the table about once a second. The UI
+only submits and polls, so widget interactions, reruns and closed browser tabs no
+longer abort work. API keys reach the worker through its environment and are never
+stored in the table.
+"""
+import _thread
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import streamlit as st
+
+import config
+from columnar import is_parquet, read_table
+from combined_enrichment import MODES
+from dispatch import provider_limits
+from improvement4 import configure_openai, embeddings_to_json
+from instrumentation import RunRecorder
+from pipeline import STAGES, Pipeline
+
+ACTIVE = ("queued", "running")
+STATUS_ICONS = {"queued": "⏳", "running": "⚙️", "done": "✅", "failed": "❌", "cancelled": "🛑"}
+
+COLUMNS = (
+    "id TEXT PRIMARY KEY, name TEXT NOT NULL, params TEXT NOT NULL, status TEXT NOT NULL, "
+    "progress REAL NOT NULL DEFAULT 0, detail TEXT NOT NULL DEFAULT '', message TEXT NOT NULL DEFAULT '', "
+    "output_path TEXT, report_path TEXT, pid INTEGER, cancel_requested INTEGER NOT NULL DEFAULT 0, "
+    "created_at REAL NOT NULL, started_at REAL, finished_at REAL, heartbeat_at REAL"
+)
+
+
+def job_dir(job_id):
+    return os.path.join(config.JOBS_DIR, job_id)
+
+
+def input_path(job_id, file_name):
+    # The upload keeps its format, so read_table can tell CSV from Parquet by the name
+    return os.path.join(job_dir(job_id), "input.parquet" if is_parquet(file_name) else "input.csv")
+
+
+def pid_alive(pid):
+    """
+    Whether process 'pid' is running. A worker started by this process that has exited is
+    reaped here first: until then it is a zombie, which os.kill(pid, 0) still finds.
+    """
+    if not pid:
+        return False
+    if hasattr(os, "WNOHANG"):
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                return False
+        except ChildProcessError:
+            pass  # not a child of this process
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+class JobStore:
+    """
+    The persistent job table. Every method opens its own short-lived connection, so the
+    store can be used from the UI and from any number of worker processes at once.
+    """
+
+    def __init__(self, path=config.JOBS_DB):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS jobs ({COLUMNS})")
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def create(self, name, params):
+        job_id = uuid.uuid4().hex[:12]
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, name, params, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, name, json.dumps(params), time.time())
+            )
+        return job_id
+
+    def get(self, job_id):
+        with self.connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def list(self, limit=50):
+        with self.connect() as conn:
+            rows = conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [self._job(row) for row in rows]
+
+    @staticmethod
+    def _job(row):
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        return job
+
+    def update(self, job_id, **fields):
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self.connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def claim(self, job_id, max_running=config.JOBS_MAX_RUNNING):
+        """Moves a queued job to running if fewer than 'max_running' jobs are running. Returns whether it did."""
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                running = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+                claimed = running < max_running and conn.execute(
+                    "UPDATE jobs SET status = 'running', started_at = ?, heartbeat_at = ? "
+                    "WHERE id = ? AND status = 'queued' AND cancel_requested = 0",
+                    (time.time(), time.time(), job_id)
+                ).rowcount == 1
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return claimed
+
+    def finish(self, job_id, status, expected=("running",), **fields):
+        """
+        Moves the job to its final 'status' in one compare-and-set, only while it is still
+        in one of the 'expected' states. Returns whether it did.
+        """
+        fields = dict(status=status, finished_at=time.time(), **fields)
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        placeholders = ", ".join("?" for _ in expected)
+        with self.connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND status IN ({placeholders})",
+                (*fields.values(), job_id, *expected)
+            )
+        return cursor.rowcount > 0
+
+    def heartbeat(self, job_id, progress, detail):
+        """Records a running job's progress; a job that has finished is left as it is."""
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ?, detail = ?, heartbeat_at = ? WHERE id = ? AND status = 'running'",
+                (progress, detail, time.time(), job_id)
+            )
+
+    def cancel(self, job_id):
+        """Asks the job's worker to stop; it marks the job cancelled once it has."""
+        self.update(job_id, cancel_requested=1)
+
+    def reap(self, heartbeat_timeout=config.JOBS_HEARTBEAT_TIMEOUT):
+        """
+        Marks active jobs as failed when their worker process is gone (crash, OOM kill,
+        reboot) or, while running, has not written a heartbeat for 'heartbeat_timeout' seconds.
+        """
+        now = time.time()
+        for job in self.list(limit=1000):
+            if job["status"] not in ACTIVE:
+                continue
+            if job["pid"] and not pid_alive(job["pid"]):
+                self.fail_active(job["id"], "Worker process exited unexpectedly")
+            elif job["status"] == "running" and job["heartbeat_at"] and now - job["heartbeat_at"] > heartbeat_timeout:
+                self.fail_active(job["id"], f"Worker stopped responding (no heartbeat for {now - job['heartbeat_at']:.0f}s)")
+
+    def fail_active(self, job_id, message):
+        """Marks the job failed unless it has finished in the meantime."""
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, message = ? "
+                "WHERE id = ? AND status IN ('queued', 'running')",
+                (time.time(), message, job_id)
+            )
+
+
+def submit(file_bytes, file_name, params, api_key, embedding_api_key=None, store=None):
+    """
+    Stores the input and the job's settings, then starts its worker process, detached
+    from the calling process. 'params' holds the Pipeline settings (stages, model_name,
+    api_url, mode, ...). Returns the job id.
+    """
+    store = store or JobStore()
+    job_id = store.create(file_name, params)
+    directory = job_dir(job_id)
+    os.makedirs(directory, exist_ok=True)
+    with open(input_path(job_id, file_name), "wb") as f:
+        f.write(file_bytes)
+
+    env = dict(os.environ, CSVIMPROVE_API_KEY=api_key or "")
+    if embedding_api_key:
+        env["OPENAI_API_KEY"] = embedding_api_key
+    with open(os.path.join(directory, "worker.log"), "ab") as log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), job_id],
+            stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, env=env,
+            cwd=os.getcwd(), start_new_session=True,
+        )
+    store.update(job_id, pid=process.pid)
+    return job_id
+
+
+class JobMonitor:
+    """
+    Worker-side thread that writes the job's progress and a heartbeat to the table once
+    a second, and interrupts the main thread when the job is cancelled. Once the job's
+    output is committed (commit()), a cancel no longer interrupts it.
+    """
+
+    def __init__(self, store, job_id, interval=1.0):
+        self.store = store
+        self.job_id = job_id
+        self.interval = interval
+        self.progress = 0.0
+        self.detail = ""
+        self.cancelled = False
+        self.committed = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if threading.current_thread() is threading.main_thread():
+            # interrupt_main() runs this handler; it stays installed, so an interrupt
+            # still pending when the output is committed is dropped rather than raised
+            signal.signal(signal.SIGINT, self.on_interrupt)
+        self._thread.start()
+        return self
+
+    def commit(self):
+        self.committed = True
+
+    def on_interrupt(self, signum, frame):
+        if not self.committed:
+            raise KeyboardInterrupt
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.store.heartbeat(self.job_id, self.progress, self.detail)
+            if self.store.get(self.job_id)["cancel_requested"] and not self.cancelled and not self.committed:
+                self.cancelled = True
+                _thread.interrupt_main()
+
+
+def run_job(job_id, store=None):
+    """Worker process entry point: waits for a free slot, runs the job and records how it ended."""
+    store = store or JobStore()
+    store.update(job_id, pid=os.getpid())
+    while not store.claim(job_id):
+        job = store.get(job_id)
+        if job["cancel_requested"]:
+            store.finish(job_id, "cancelled", expected=("queued",))
+            return
+        time.sleep(config.JOBS_POLL_SECONDS)
+
+    job = store.get(job_id)
+    params = dict(job["params"])
+    stages = params.pop("stages")
+    directory = job_dir(job_id)
+    api_key = os.environ.get("CSVIMPROVE_API_KEY", "")
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+    recorder = RunRecorder(f"job-{job_id}")
+    monitor = JobMonitor(store, job_id).start()
+    try:
+        df = read_table(input_path(job_id, job["name"]))
+        df.columns = df.columns.str.strip()
+        if "embed" in stages:
+            configure_openai(os.environ.get("OPENAI_API_KEY") or api_key)
+        pipeline = Pipeline(stages, headers=headers, **params)
+        unit_col = pipeline.unit_column(df.columns)
+        total_units = max(1, df[unit_col].nunique())
+        done_units = set()
+
+        def track(frame):
+            done_units.update(frame[unit_col].unique())
+            monitor.progress = len(done_units) / total_units
+            monitor.detail = " · ".join(f"{stage} {pipeline.progress[stage]} rows" for stage in stages)
+
+        with recorder.activate():
+            result = pipeline.run_frame(df, on_frame=track)
+        if "Embedding" in result.columns:
+            result = embeddings_to_json(result)
+        output_path = os.path.join(directory, "output.csv")
+        result.to_csv(output_path + ".tmp", index=False)
+        os.replace(output_path + ".tmp", output_path)
+        # The output is complete: a cancel arriving from here on is ignored
+        monitor.commit()
+        report_path, _ = recorder.write_report(os.path.join(directory, "report"))
+        # The heartbeat keeps going while the output and report are written, and stops
+        # before the final status, so no late tick lands on a finished job
+        monitor.stop()
+        store.finish(job_id, "done", progress=1.0, detail=monitor.detail, output_path=output_path,
+                     report_path=report_path, message=f"{len(result)} rows")
+    except KeyboardInterrupt:
+        monitor.stop()
+        report_path, _ = recorder.write_report(os.path.join(directory, "report"))
+        store.finish(job_id, "cancelled", report_path=report_path)
+    except Exception as e:
+        monitor.stop()
+        store.finish(job_id, "failed", message=str(e))
+        raise
+    finally:
+        monitor.stop()
+
+
+def show_job(store, job):
+    icon = STATUS_ICONS.get(job["status"], "")
+    created = time.strftime("%Y-%m-%d %H:%M", time.localtime(job["created_at"]))
+    st.markdown(f"**{icon} `{job['id']}` · {job['name']}** · {' → '.join(job['params']['stages'])} · {created}")
+    if job["status"] in ACTIVE:
+        text = "Waiting for a free worker slot" if job["status"] == "queued" else job["detail"] or "Starting..."
+        st.progress(min(1.0, job["progress"]), text=text)
+        if job["cancel_requested"]:
+            st.caption("🛑 Cancelling...")
+        elif st.button("🛑 Cancel", key=f"cancel_{job['id']}"):
+            store.cancel(job["id"])
+    elif job["status"] == "done":
+        st.caption(f"{job['message']} · {job['detail']}")
+        with open(job["output_path"], "rb") as f:
+            st.download_button("⬇️ Download Result CSV", f, file_name=f"{job['id']}_output.csv", mime="text/csv",
+                               key=f"output_{job['id']}")
+    elif job["status"] == "failed":
+        st.error(f"❌ {job['message']}")
+    if job["report_path"] and os.path.exists(job["report_path"]):
+        with open(job["report_path"], "rb") as f:
+            st.download_button("⬇️ Download Run Report (JSON)", f, file_name=os.path.basename(job["report_path"]),
+                               mime="application/json", key=f"report_{job['id']}")
+
+
+def show_jobs():
+    store = JobStore()
+    store.reap()
+    jobs = store.list()
+    if not jobs:
+        st.info("No jobs yet.")
+    for job in jobs:
+        show_job(store, job)
+
+
+def run_jobs(model_name, api_url, api_key, headers, embedding_model):
+    st.header("📨 Background Jobs")
+    st.markdown(
+        "Jobs run in worker processes on this machine: they keep running when you change settings, "
+        "start other jobs or close the browser, and their results stay available for download here."
+    )
+    uploaded_file = st.file_uploader("📂 Upload Tafsir CSV (or Parquet)", type=["csv", "parquet"], key="jobs")
+    stages = st.multiselect("Steps to run (in this order)", STAGES, default=["enrich", "split"], key="jobs_stages")
+    stages = [stage for stage in STAGES if stage in stages]
+    mode = st.radio("Combined enrichment extracts:", list(MODES.values()), key="jobs_mode")
+    limits = provider_limits(api_url)
+    max_in_flight = st.number_input(
+        "⚡ Max requests in flight per step",
+        min_value=1,
+        max_value=limits["max_concurrency"],
+        value=limits["max_concurrency"],
+        key="jobs_max_in_flight"
+    )
+    use_cache = st.checkbox("💾 Reuse cached responses", value=True, key="jobs_use_cache")
+
+    if uploaded_file and stages and st.button("📨 Submit Job"):
+        params = dict(
+            stages=stages, model_name=model_name, api_url=api_url, mode=mode, use_cache=use_cache,
+            max_workers=max_in_flight, requests_per_minute=limits["requests_per_minute"],
+            embedding_model=embedding_model,
+        )
+        job_id = submit(uploaded_file.getvalue(), uploaded_file.name, params, api_key)
+        st.success(f"✅ Job `{job_id}` submitted")
+
+    st.markdown("#### Jobs")
+    auto_refresh = st.checkbox("🔄 Refresh automatically", value=True, key="jobs_auto_refresh")
+    fragment = getattr(st, "fragment", None)
+    if auto_refresh and fragment:
+        # Only this part of the page reruns on each poll
+        fragment(run_every=config.JOBS_POLL_SECONDS)(show_jobs)()
+    else:
+        st.button("🔄 Refresh", key="jobs_refresh")
+        show_jobs()
+
+
+if __name__ == "__main__":
+    run_job(sys.argv[1])
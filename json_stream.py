@@ -0,0 +1,115 @@
+import json
+
+from utils import strip_code_fences
+
+CLOSERS = {"[": "]", "{": "}"}
+
+
+class ArrayItemParser:
+    """
+    Incremental parser for a model reply containing a JSON array of objects.
+
+    feed() takes the reply piece by piece and returns every array item completed by
+    that piece, so items can be used long before the reply ends. Text before the
+    first '[' (code fences, prose, or a wrapping object key) is skipped. Each
+    character is scanned once; only finished items are handed to json.loads.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.complete = False
+        self.item_start = None
+        self.items = []
+        self.bad_items = 0
+
+    def feed(self, delta):
+        self.text += delta
+        text = self.text
+        found = []
+        for i in range(self.pos, len(text)):
+            ch = text[i]
+            if self.complete:
+                break
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif not self.started:
+                if ch == "[":
+                    self.started = True
+                    self.depth = 1
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "[{":
+                if self.depth == 1:
+                    self.item_start = i
+                self.depth += 1
+            elif ch in "]}":
+                self.depth -= 1
+                if self.depth == 1 and self.item_start is not None:
+                    try:
+                        found.append(json.loads(text[self.item_start:i + 1]))
+                    except json.JSONDecodeError:
+                        self.bad_items += 1
+                    self.item_start = None
+                elif self.depth == 0:
+                    self.complete = True
+        self.pos = len(text)
+        self.items.extend(found)
+        return found
+
+    def partial_item(self):
+        """Text of the array item still being received, if any."""
+        return self.text[self.item_start:] if self.item_start is not None else ""
+
+
+def repair_json(text):
+    """
+    Best-effort parse of a JSON reply that was cut off (e.g. at max_tokens).
+
+    Closes an open string and every open container; if that is not valid JSON,
+    backs off to each earlier comma in turn, dropping the incomplete trailing
+    member. Raises json.JSONDecodeError when nothing parseable is left.
+    """
+    cleaned = strip_code_fences(text)
+    try:
+        return json.loads(cleaned)
+    except json.JSONDecodeError as e:
+        error = e
+
+    stack = []
+    commas = []  # (position, open containers at that point)
+    in_string = escape = False
+    for i, ch in enumerate(cleaned):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in CLOSERS:
+            stack.append(CLOSERS[ch])
+        elif ch in "]}" and stack:
+            stack.pop()
+        elif ch == "," and stack:
+            commas.append((i, "".join(reversed(stack))))
+
+    candidates = [(cleaned.rstrip() + ('"' if in_string else ""), "".join(reversed(stack)))]
+    candidates += [(cleaned[:pos], closers) for pos, closers in reversed(commas)]
+    for head, closers in candidates:
+        try:
+            return json.loads(head + closers)
+        except json.JSONDecodeError:
+            continue
+    raise error
@@ -0,0 +1,309 @@
+"""
+Local stand-in for the chat-completion and embedding APIs, for offline benchmarks.
+
+Serves /v1/chat/completions (plain and streamed) and /v1/embeddings on localhost.
+Replies are canned JSON shaped like what each stage asks for (enrichment fields,
+thematic sections, chapter and chunk fields), so every stage runs end to end without
+an API key. Latency, 5xx errors, 429s (with Retry-After) and cut-off replies are
+drawn at random per request:
+
+    python mock_provider.py --port 8700 --latency lognormal:0.8:0.5 --error-rate 0.01 --rate-limit-rate 0.05
+    python cli.py data.csv -o out.csv --stages enrich split embed \\
+        --api-url http://127.0.0.1:8700/v1/chat/completions --model-name mock \\
+        --embedding-api-url http://127.0.0.1:8700/v1
+
+Latency specs: "fixed:SECONDS", "uniform:LOW:HIGH" or "lognormal:MEDIAN:SIGMA".
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from utils import estimate_tokens
+
+ENRICH_LIST_FIELDS = {"themes", "wisdom_points", "outline_of_commentary", "contextual_questions"}
+SECTION_WORDS = 170
+MAX_SECTIONS = 8
+STREAM_PIECE_CHARS = 24
+
+
+def parse_latency(spec):
+    """Turns a latency spec into a function returning one sampled delay in seconds."""
+    kind, _, params = (spec or "fixed:0").partition(":")
+    try:
+        values = [float(v) for v in params.split(":")] if params else []
+    except ValueError:
+        raise ValueError(f"Bad latency spec: {spec!r}")
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Bad latency spec: {spec!r} (use fixed:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA)")
+
+
+def enrich_reply(prompt):
+    fields = re.findall(r"^\d+\. (\w+)", prompt, flags=re.MULTILINE)
+    return {
+        field: [f"{field} {i + 1}" for i in range(3)] if field in ENRICH_LIST_FIELDS else f"Mock {field}."
+        for field in fields
+    }
+
+
+def split_reply(prompt):
+    """Sections of about SECTION_WORDS words cut from the commentary; continuations return the rest."""
+    commentary = prompt.split("Commentary:\n", 1)[-1].split("\nYou already returned", 1)[0]
+    words = commentary.split()
+    total = max(1, min(MAX_SECTIONS, len(words) // SECTION_WORDS))
+    done = re.search(r"You already returned sections 1 to (\d+)", prompt)
+    first = int(done.group(1)) if done else 0
+    per_section = max(1, math.ceil(len(words) / total))
+    return [
+        {
+            "SectionNumber": i + 1,
+            "ThemeTitle": f"Theme {i + 1}",
+            "ThemeText": " ".join(words[i * per_section:(i + 1) * per_section]) or "Mock section text.",
+            "ContextualQuestion": f"What does theme {i + 1} ask of the reader?",
+            "ThemeSummary": f"Summary of theme {i + 1}.",
+            "Keywords": ["mercy", "guidance", "patience", "gratitude", "trust"],
+            "Outline": ["First point", "Second point", "Third point"],
+        }
+        for i in range(first, total)
+    ]
+
+
+def chunk_fields():
+    return {
+        "Wisdom": "Mock wisdom.",
+        "Reflections": "Mock reflections.",
+        "ChunkOutline": ["First point", "Second point", "Third point"],
+        "ChunkQuestions": ["What does this chunk ask of the reader?"],
+    }
+
+
+def canned_reply(prompt):
+    """The reply content for a prompt, recognized by the wording each stage uses."""
+    if "### Chunk " in prompt:
+        ids = re.findall(r"^### Chunk (\S+)$", prompt, flags=re.MULTILINE)
+        result = [dict(chunk_fields(), id=int(i) if i.isdigit() else i) for i in ids]
+    elif "Text Chunk:" in prompt:
+        result = chunk_fields()
+    elif "Summarize the chapter" in prompt:
+        result = {
+            "ChapterSummary": "Mock chapter summary.",
+            "ChapterOutline": ["First point", "Second point", "Third point"],
+            "ChapterQuestions": ["First question?", "Second question?"],
+        }
+    elif "Split the following commentary" in prompt:
+        result = split_reply(prompt)
+    else:
+        result = enrich_reply(prompt)
+    return json.dumps(result, ensure_ascii=False)
+
+
+def embedding_vector(text, dim):
+    """Deterministic unit vector for a text, so related-section results are stable across runs."""
+    seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    provider = None  # set on the per-server subclass
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = self.path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            kind = "chat"
+        elif path.endswith("/embeddings"):
+            kind = "embeddings"
+        else:
+            return self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        outcome, delay = self.provider.draw(kind)
+        time.sleep(delay)
+        if outcome == "rate_limited":
+            return self.send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                                  {"Retry-After": str(self.provider.retry_after)})
+        if outcome == "error":
+            return self.send_json(500, {"error": {"message": "Mock server error", "type": "server_error"}})
+        if kind == "embeddings":
+            return self.send_embeddings(body)
+        self.send_chat(body, truncated=outcome == "truncated")
+
+    def send_json(self, status, data, headers=None):
+        out = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(out)
+
+    def send_chat(self, body, truncated=False):
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        content = canned_reply(prompt)
+        finish_reason = "stop"
+        if truncated:
+            content, finish_reason = content[:len(content) * 2 // 3], "length"
+        max_tokens = body.get("max_tokens")
+        if max_tokens and estimate_tokens(content) > max_tokens:
+            # Like a real model, a reply over the request's budget is cut off
+            content, finish_reason = content[:max_tokens * 4], "length"
+        usage = {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": estimate_tokens(content)}
+        if not body.get("stream"):
+            return self.send_json(200, {
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        events = [{"choices": [{"index": 0, "delta": {"content": content[i:i + STREAM_PIECE_CHARS]},
+                                "finish_reason": None}]}
+                  for i in range(0, len(content), STREAM_PIECE_CHARS)]
+        events.append({"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            events.append({"choices": [], "usage": usage})
+        for event in events:
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def send_embeddings(self, body):
+        texts = body.get("input", [])
+        if isinstance(texts, str):
+            texts = [texts]
+        as_base64 = body.get("encoding_format") == "base64"
+        data = []
+        for i, text in enumerate(texts):
+            vector = embedding_vector(str(text), self.provider.embedding_dim)
+            embedding = base64.b64encode(vector.tobytes()).decode("ascii") if as_base64 else vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(estimate_tokens(str(text)) for text in texts)
+        self.send_json(200, {"object": "list", "data": data, "model": body.get("model"),
+                             "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+
+class MockProvider:
+    """
+    Mock chat/embedding server on a background thread. Each request first waits a
+    delay drawn from the latency spec, then fails with 429 ('rate_limit_rate'), 500
+    ('error_rate') or, for chat, is cut off with finish_reason "length"
+    ('truncate_rate'). Chat replies longer than the request's max_tokens are cut off
+    the same way. 'stats' counts requests per kind and outcome.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency="fixed:0", embedding_latency=None, error_rate=0.0,
+                 rate_limit_rate=0.0, truncate_rate=0.0, retry_after=0.1, embedding_dim=256, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = parse_latency(latency)
+        self.embedding_latency = parse_latency(embedding_latency or latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.truncate_rate = truncate_rate
+        self.retry_after = retry_after
+        self.embedding_dim = embedding_dim
+        self.stats = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    @property
+    def chat_url(self):
+        return self.base_url + "/chat/completions"
+
+    def draw(self, kind):
+        """(outcome, delay) for one request: outcome is ok, rate_limited, error or truncated."""
+        with self._lock:
+            delay = max(0.0, (self.latency if kind == "chat" else self.embedding_latency)(self._rng))
+            roll = self._rng.random()
+            if roll < self.rate_limit_rate:
+                outcome = "rate_limited"
+            elif roll < self.rate_limit_rate + self.error_rate:
+                outcome = "error"
+            elif kind == "chat" and self._rng.random() < self.truncate_rate:
+                outcome = "truncated"
+            else:
+                outcome = "ok"
+            self.stats[kind] += 1
+            self.stats[f"{kind}_{outcome}"] += 1
+        return outcome, delay
+
+    def start(self):
+        handler = type("Handler", (MockHandler,), {"provider": self})
+        self._server = ThreadingHTTPServer((self.host, self.port), handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8700)
+    parser.add_argument("--latency", default="lognormal:0.8:0.5", help="chat latency spec")
+    parser.add_argument("--embedding-latency", help="embedding latency spec (default: --latency)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--truncate-rate", type=float, default=0.0,
+                        help="share of chat replies cut off with finish_reason 'length'")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--embedding-dim", type=int, default=256)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    provider = MockProvider(
+        args.host, args.port, args.latency, args.embedding_latency, args.error_rate, args.rate_limit_rate,
+        args.truncate_rate, args.retry_after, args.embedding_dim, args.seed
+    ).start()
+    print(f"Chat:       {provider.chat_url}")
+    print(f"Embeddings: {provider.base_url}/embeddings")
+    try:
+        while True:
+            time.sleep(10)
+            print(" · ".join(f"{key} {value}" for key, value in sorted(provider.stats.items())), flush=True)
+    except KeyboardInterrupt:
+        provider.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""
+Fused pipeline: runs several stages over a dataset in one pass, without intermediate CSVs.
+
+Every stage runs in its own thread and hands each finished unit (the rows of one
+Commentary Group) to the next stage through a bounded queue, so embedding starts on
+the first split groups while splitting is still running. Chat requests of all stages
+share the provider limits of the pooled chat client. Relationship mapping needs every
+vector, so it runs once the last unit has been embedded.
+"""
+import contextvars
+import itertools
+import queue
+import threading
+import time
+from collections import Counter
+
+import pandas as pd
+import streamlit as st
+
+import config
+from columnar import show_parquet_download
+from combined_enrichment import MODES, apply_results, enrich_fields_for_mode, enrich_group, make_jobs, resolve_columns
+from dedupe import RequestPlan, input_key
+from dispatch import dispatch_ordered, provider_limits
+from improvement3 import build_split_prompt
+from improvement4 import add_embeddings, add_relationships, configure_openai, embeddings_to_json
+from improvement5 import enrich_chapters_and_chunks
+from instrumentation import RunRecorder, current_recorder, count, show_run_report
+from response_cache import get_cache
+from routing import provider_columns
+from sections import SectionBuilder, split_groups
+from uploads import read_upload
+
+STAGES = ["enrich", "split", "embed", "chapters"]
+
+# Marks the end of a channel
+_DONE = object()
+
+
+class PipelineStopped(Exception):
+    """Raised in place of a request that would start after the pipeline was stopped."""
+
+
+class Channel:
+    """Bounded queue between two stage threads; put() and iteration give up once 'stop' is set."""
+
+    def __init__(self, stop, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.stop = stop
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        self.put(_DONE)
+
+    def __iter__(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return
+                continue
+            if item is _DONE or self.stop.is_set():
+                return
+            yield item
+
+
+class FrameWriter:
+    """Writer for split_groups() that hands each group's section rows to the next stage."""
+
+    def __init__(self, emit):
+        self.emit = emit
+
+    def write(self, frame):
+        if not frame.empty:
+            self.emit(frame)
+
+
+class Pipeline:
+    """
+    Chains 'stages' (a subset of STAGES, in the order given) over one dataset.
+
+    run() takes (group_name, group_df) units and yields the frames coming out of the
+    last stage as they finish; run_frame() does the same for an in-memory DataFrame
+    and returns the combined result. 'progress' holds the rows each stage has passed
+    on so far. 'on_warning(message)' is called from the stage threads for groups or
+    chunks that failed without stopping the run; any other error stops every stage
+    and is raised from run(). Once stopped, stages take no new units and start no new
+    requests.
+    """
+
+    def __init__(self, stages, model_name, api_url, headers, mode=MODES["both"], use_cache=True,
+                 max_workers=1, requests_per_minute=None, embedding_model=None,
+                 embedding_workers=config.EMBEDDING_MAX_WORKERS, top_k=5, batch_chunks=True,
+                 stream_replies=False, flush_rows=config.PIPELINE_FLUSH_ROWS,
+                 queue_size=config.PIPELINE_QUEUE_UNITS, on_warning=None, dedupe=True,
+                 segment_tokens=config.SPLIT_SEGMENT_TOKENS):
+        unknown = [stage for stage in stages if stage not in STAGES]
+        if unknown:
+            raise ValueError(f"Unknown stages: {unknown}")
+        if "embed" in stages and not embedding_model:
+            raise ValueError("The embed stage needs an embedding model")
+        self.stages = list(stages)
+        self.model_name = model_name
+        self.api_url = api_url
+        self.headers = headers
+        self.mode = mode
+        self.use_cache = use_cache
+        self.max_workers = max_workers
+        self.requests_per_minute = requests_per_minute
+        self.embedding_model = embedding_model
+        self.embedding_workers = embedding_workers
+        self.top_k = top_k
+        self.batch_chunks = batch_chunks
+        self.stream_replies = stream_replies
+        self.segment_tokens = segment_tokens
+        self.flush_rows = flush_rows
+        self.queue_size = queue_size
+        self.on_warning = on_warning
+        self.progress = Counter()
+        self.stop = threading.Event()
+        # One dedupe.RequestPlan per chat stage: groups with identical input share a request
+        self.plans = {stage: RequestPlan() for stage in ("enrich", "split") if stage in self.stages} if dedupe else {}
+
+    def unit_column(self, columns):
+        """Column whose groups travel through the pipeline as units."""
+        if "Commentary Group" in columns:
+            return "Commentary Group"
+        if "split" in self.stages:
+            raise ValueError("The split stage needs a 'Commentary Group' column")
+        return resolve_columns(columns)["Verse Group"]
+
+    def warn(self, message):
+        if self.on_warning:
+            self.on_warning(message)
+
+    def run(self, units):
+        """Runs every stage over the (group_name, group_df) pairs in 'units'; yields finished frames in order."""
+        stop = self.stop = threading.Event()
+        errors = []
+        channels = [Channel(stop, self.queue_size) for _ in range(len(self.stages) + 1)]
+        transforms = {"enrich": self.enrich, "split": self.split, "embed": self.embed, "chapters": self.chapters}
+        self.progress = Counter()
+
+        def feed():
+            try:
+                for _, frame in units:
+                    if stop.is_set():
+                        break
+                    channels[0].put(frame)
+            except Exception as e:
+                errors.append(("input", e))
+                stop.set()
+            finally:
+                channels[0].close()
+
+        def run_stage(name, source, sink):
+            def emit(frame):
+                self.progress[name] += len(frame)
+                sink.put(frame)
+
+            try:
+                with current_recorder().stage(name):
+                    transforms[name](source, emit)
+            except Exception as e:
+                errors.append((name, e))
+                stop.set()
+            finally:
+                sink.close()
+
+        # Threads run in copies of this context, so requests are reported to the active recorder
+        threads = [threading.Thread(target=contextvars.copy_context().run, args=(feed,), daemon=True)]
+        for name, source, sink in zip(self.stages, channels, channels[1:]):
+            threads.append(threading.Thread(
+                target=contextvars.copy_context().run, args=(run_stage, name, source, sink), daemon=True
+            ))
+        for thread in threads:
+            thread.start()
+        finished = False
+        try:
+            yield from channels[-1]
+            finished = True
+        finally:
+            if not finished:
+                stop.set()  # the caller stopped early: release every stage
+            for thread in threads:
+                thread.join()
+        if errors:
+            name, error = errors[0]
+            raise ValueError(f"{name} stage failed: {error}") from error
+
+    def run_frame(self, df, on_frame=None):
+        """
+        Runs the pipeline over an in-memory DataFrame and returns the result.
+        'on_frame(frame)' is called from the calling thread for each finished frame.
+        """
+        frames = []
+        for frame in self.run(df.groupby(self.unit_column(df.columns))):
+            frames.append(frame)
+            if on_frame:
+                on_frame(frame)
+        result = pd.concat(frames, ignore_index=True) if frames else df.iloc[0:0]
+        if "embed" in self.stages and self.top_k > 0 and len(result):
+            with current_recorder().stage("relationships"):
+                result, _ = add_relationships(result, top_k=self.top_k)
+        return result
+
+    def buffered(self, frames):
+        """Joins incoming units into frames of at least 'flush_rows' rows, so batched stages get full batches."""
+        pending, rows = [], 0
+        for frame in frames:
+            if self.stop.is_set():
+                return
+            pending.append(frame)
+            rows += len(frame)
+            if rows >= self.flush_rows:
+                yield pd.concat(pending, ignore_index=True)
+                pending, rows = [], 0
+        if pending:
+            yield pd.concat(pending, ignore_index=True)
+
+    def enrich(self, frames, emit):
+        """Combined enrichment; a unit is passed on once every verse group in it has its fields."""
+        enrich_fields = provider_columns(enrich_fields_for_mode(self.mode), self.api_url)
+        plan = self.plans.get("enrich")
+
+        def jobs():
+            for frame in frames:
+                col_map = resolve_columns(frame.columns)
+                groups = list(frame.groupby(col_map["Verse Group"], sort=False))
+                for n, job in enumerate(make_jobs(groups, col_map, self.mode), start=1):
+                    yield frame, col_map["Verse Group"], n == len(groups), job
+
+        def request(item):
+            if self.stop.is_set():
+                raise PipelineStopped()
+            prompt = item[3][1]
+            if plan is None:
+                return enrich_group(self.model_name, self.api_url, self.headers, prompt, self.use_cache)
+            return plan.run(input_key(prompt),
+                            lambda: enrich_group(self.model_name, self.api_url, self.headers, prompt, self.use_cache))
+
+        outcomes = dispatch_ordered(
+            jobs(),
+            request,
+            max_workers=self.max_workers,
+            requests_per_minute=self.requests_per_minute,
+            resolve=(lambda item: plan.share(input_key(item[3][1]), item[3][0])) if plan else None,
+        )
+        results = {}
+        for _, (frame, group_col, last, job), result, error, _ in outcomes:
+            if self.stop.is_set():
+                return
+            count("items")
+            if error is not None:
+                self.warn(f"enrich: group {job[0]} failed: {error}")
+            results[job[0]] = result if error is None else {}
+            if last:
+                emit(apply_results(frame.copy(), group_col, results, enrich_fields))
+                results = {}
+
+    def split(self, frames, emit):
+        """Thematic splitting; each group's section rows are passed on as soon as they are parsed."""
+        frames = iter(frames)
+        first = next(frames, None)
+        if first is None:
+            return
+
+        def report(group_name, status, sections, error):
+            if status == "failed":
+                self.warn(f"split: group {group_name} failed: {error}")
+
+        split_groups(
+            ((frame["Commentary Group"].iloc[0], frame) for frame in itertools.chain([first], frames)
+             if not self.stop.is_set()),
+            SectionBuilder(provider_columns(first.columns, self.api_url)), build_split_prompt, self.model_name, self.api_url, self.headers,
+            use_cache=self.use_cache, writer=FrameWriter(emit), on_group=report, stream=self.stream_replies,
+            plan=self.plans.get("split"), segment_tokens=self.segment_tokens
+        )
+
+    def embed(self, frames, emit):
+        for frame in self.buffered(frames):
+            if "ThemeText" not in frame.columns:
+                raise ValueError("The embed stage needs a 'ThemeText' column (run 'split' first)")
+            emit(add_embeddings(frame, self.embedding_model, max_workers=self.embedding_workers, on_error=self.warn))
+
+    def chapters(self, frames, emit):
+        # Shared across flushes, so every distinct title is requested once per run
+        chapter_results = {}
+        for frame in self.buffered(frames):
+            emit(enrich_chapters_and_chunks(
+                frame, self.model_name, self.api_url, self.headers, use_cache=self.use_cache,
+                batch_chunks=self.batch_chunks, max_workers=self.max_workers,
+                requests_per_minute=self.requests_per_minute, on_error=self.warn, chapter_results=chapter_results
+            ))
+
+
+def run_pipeline(model_name, api_url, api_key, headers, embedding_model):
+    st.header("🔗 Run All Steps in One Pass")
+    st.markdown(
+        "Runs the selected steps on one upload without downloading and re-uploading CSVs in between. "
+        "Each commentary group moves on to the next step as soon as it is done."
+    )
+    uploaded_file = st.file_uploader("📂 Upload Tafsir CSV (or Parquet)", type=["csv", "parquet"], key="pipeline")
+    stages = st.multiselect(
+        "Steps to run (in this order)",
+        STAGES,
+        default=["enrich", "split", "embed"],
+        format_func={
+            "enrich": "✨ Combined Enrichment",
+            "split": "🧠 Thematic Splitting",
+            "embed": "🔎 Embeddings & Relationships",
+            "chapters": "📖 Chapter & Chunk Enrichment",
+        }.get,
+        key="pipeline_stages"
+    )
+    stages = [stage for stage in STAGES if stage in stages]
+    mode = st.radio("Combined enrichment extracts:", list(MODES.values()), key="pipeline_mode")
+    limits = provider_limits(api_url)
+    max_in_flight = st.number_input(
+        "⚡ Max requests in flight per step",
+        min_value=1,
+        max_value=limits["max_concurrency"],
+        value=limits["max_concurrency"],
+        key="pipeline_max_in_flight"
+    )
+    use_cache = st.checkbox("💾 Reuse cached responses", value=True, key="pipeline_use_cache")
+
+    if uploaded_file and stages and st.button("🚀 Run Pipeline"):
+        df = read_upload(uploaded_file)
+        df.columns = df.columns.str.strip()
+        st.success(f"✅ File loaded! {len(df)} rows")
+        if "embed" in stages:
+            configure_openai(api_key)
+
+        warnings = []
+        pipeline = Pipeline(
+            stages, model_name, api_url, headers, mode=mode, use_cache=use_cache, max_workers=max_in_flight,
+            requests_per_minute=limits["requests_per_minute"], embedding_model=embedding_model,
+            on_warning=warnings.append
+        )
+        status = st.empty()
+        counters = st.empty()
+        recorder = RunRecorder("pipeline")
+        cache_snapshot = get_cache().counters()
+        started = time.perf_counter()
+
+        def show_progress(frame):
+            status.text(" · ".join(f"{stage}: {pipeline.progress[stage]} rows" for stage in stages))
+            counters.caption(recorder.counters_line())
+
+        with st.spinner(f"Running {' → '.join(stages)}..."), recorder.activate():
+            try:
+                result_df = pipeline.run_frame(df, on_frame=show_progress)
+            except ValueError as e:
+                st.error(f"❌ {e}")
+                return
+
+        for message in warnings:
+            st.warning(f"⚠️ {message}")
+        st.success(f"🎉 {len(result_df)} rows through {' → '.join(stages)} in {time.perf_counter() - started:.1f}s")
+        hits, misses = get_cache().counters_since(cache_snapshot)
+        st.caption(f"💾 Response cache: {hits} hits, {misses} misses")
+        show_run_report(recorder)
+        # Parquet keeps embeddings as float lists; the CSV gets them as JSON text
+        show_parquet_download(result_df, "⬇️ Download Pipeline Output Parquet", "enriched_pipeline.parquet",
+                              group_col=pipeline.unit_column(result_df.columns))
+        if "Embedding" in result_df.columns:
+            result_df = embeddings_to_json(result_df)
+        st.dataframe(result_df.head())
+        csv_data = result_df.to_csv(index=False).encode("utf-8")
+        st.download_button("⬇️ Download Pipeline Output CSV", csv_data, file_name="enriched_pipeline.csv", mime="text/csv")
@@ -0,0 +1,105 @@
+import time
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:  # the approximate index is optional
+    faiss = None
+
+
+def normalize_rows(matrix):
+    """Unit-normalizes rows as float32 so dot products are cosine similarities. Zero rows stay zero."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def top_k_related(matrix, k=5, mask=None, max_block_bytes=256 * 1024 * 1024, on_block=None):
+    """
+    Exact top-k cosine neighbours for every row, excluding the row itself.
+
+    Similarities are computed one block of rows at a time. The block's working set, about
+    16 bytes per (block row, row) pair for the float32 scores and the int64 partition
+    indices, is kept under 'max_block_bytes'. Rows where 'mask' is False neither get neighbours
+    nor appear as one. Returns (indices, scores) of shape (rows, k); unused slots hold
+    -1 and NaN. 'on_block(start, end, seconds)' reports the timing of each block.
+    """
+    vectors = normalize_rows(matrix)
+    n = len(vectors)
+    k = max(0, min(k, n - 1))
+    indices = np.full((n, k), -1, dtype=np.int64)
+    scores = np.full((n, k), np.nan, dtype=np.float32)
+    if k == 0:
+        return indices, scores
+    mask = np.ones(n, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+
+    block = max(1, min(n, max_block_bytes // (n * 16)))
+    for start in range(0, n, block):
+        end = min(n, start + block)
+        started = time.perf_counter()
+        sims = vectors[start:end] @ vectors.T
+        # Negated in place, so the smallest values are the nearest rows without a second copy
+        np.negative(sims, out=sims)
+        sims[:, ~mask] = np.inf
+        sims[np.arange(end - start), np.arange(start, end)] = np.inf
+        top = np.argpartition(sims, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = -np.take_along_axis(top_scores, order, axis=1)
+        valid = np.isfinite(top_scores) & mask[start:end, None]
+        indices[start:end] = np.where(valid, top, -1)
+        scores[start:end] = np.where(valid, top_scores, np.nan)
+        if on_block:
+            on_block(start, end, time.perf_counter() - started)
+    return indices, scores
+
+
+def approximate_top_k(matrix, k=5, mask=None, on_block=None, block=65536):
+    """
+    Approximate top-k neighbours via a FAISS HNSW inner-product index, for inputs too
+    large for exact search. Same return shape as top_k_related. Requires faiss.
+    """
+    if faiss is None:
+        raise ImportError("Approximate relationship mapping requires faiss (pip install faiss-cpu)")
+    vectors = normalize_rows(matrix)
+    n, dims = vectors.shape
+    mask = np.ones(n, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+    kept = np.flatnonzero(mask)
+    index = faiss.IndexHNSWFlat(dims, 32, faiss.METRIC_INNER_PRODUCT)
+    index.add(vectors[kept])
+
+    indices = np.full((n, k), -1, dtype=np.int64)
+    scores = np.full((n, k), np.nan, dtype=np.float32)
+    for start in range(0, len(kept), block):
+        rows = kept[start:start + block]
+        started = time.perf_counter()
+        found_scores, found = index.search(vectors[rows], k + 1)
+        for r, row in enumerate(rows):
+            hits = [(kept[j], s) for j, s in zip(found[r], found_scores[r]) if j >= 0 and kept[j] != row][:k]
+            for slot, (j, s) in enumerate(hits):
+                indices[row, slot] = j
+                scores[row, slot] = s
+        if on_block:
+            on_block(int(rows[0]), int(rows[-1]) + 1, time.perf_counter() - started)
+    return indices, scores
+
+
+def relationship_columns(indices, scores, row_ids, groups=None):
+    """
+    Turns neighbour arrays into CSV-friendly columns: RelatedSections, RelatedScores and,
+    when a group per row is given, CrossGroupLinks (related rows from other groups).
+    """
+    row_ids = [str(r) for r in row_ids]
+    related, related_scores, cross = [], [], []
+    for i in range(len(indices)):
+        hits = [(j, s) for j, s in zip(indices[i], scores[i]) if j >= 0]
+        related.append("; ".join(row_ids[j] for j, _ in hits))
+        related_scores.append("; ".join(f"{s:.3f}" for _, s in hits))
+        if groups is not None:
+            cross.append("; ".join(row_ids[j] for j, _ in hits if groups[j] != groups[i]))
+    columns = {"RelatedSections": related, "RelatedScores": related_scores}
+    if groups is not None:
+        columns["CrossGroupLinks"] = cross
+    return columns
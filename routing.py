@@ -0,0 +1,327 @@
+"""
+Routing of chat requests across the providers in config.DEFAULT_CHAT_MODELS.
+
+A Router sends each request to the healthy provider with the lowest latency EWMA.
+When no reply has arrived after that provider's recent latency percentile
+(config.ROUTING_HEDGE_PERCENTILE), a hedged duplicate goes to the next provider and
+the first reply wins. 429/5xx replies, auth errors, timeouts and connection errors
+fail over to the next provider at once instead of being retried in place; after
+config.ROUTING_FAILURE_THRESHOLD failures in a row a provider is tried last until
+config.ROUTING_COOLDOWN_SECONDS have passed.
+
+While a router is activated, chat_client.chat_completion() and StreamedReply send
+requests for any of its providers through it, so the stages need no changes beyond
+recording chat_client.answered_by() in the PROVIDER_COLUMN of their rows.
+"""
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import requests
+
+import config
+from chat_client import ANSWERED_BY, CURRENT_ROUTER, RETRY_STATUSES, current_router, get_client
+from dispatch import percentile, provider_limits
+from instrumentation import count
+
+# Which provider answered the request behind each row, written while routing is active
+PROVIDER_COLUMN = "Provider"
+
+# Replies that send a request to another provider: the same reasons as retries, plus auth/endpoint errors
+FAILOVER_STATUSES = RETRY_STATUSES | {401, 403, 404}
+
+
+class ProviderFailure(requests.RequestException):
+    """A provider could not answer (429/5xx, auth, timeout, connection); the request may go elsewhere."""
+
+
+class Provider:
+    """One chat endpoint with its latency history and failure state."""
+
+    def __init__(self, name, api_url, model_name, headers):
+        self.name = name
+        self.api_url = api_url
+        self.model_name = model_name
+        self.headers = headers
+        self.ewma = None
+        self.latencies = deque(maxlen=config.ROUTING_LATENCY_WINDOW)
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+        self.stats = Counter()
+
+    def update_ewma(self, latency):
+        alpha = config.ROUTING_EWMA_ALPHA
+        self.ewma = latency if self.ewma is None else alpha * latency + (1 - alpha) * self.ewma
+
+
+class Router:
+    """
+    Hedging, failover and latency-steered provider choice over 'providers' (the first
+    one is the configured model). Thread-safe; one router is shared by all stages of a run.
+    """
+
+    def __init__(self, providers, client=None, hedge_percentile=config.ROUTING_HEDGE_PERCENTILE,
+                 hedge_max_ratio=config.ROUTING_HEDGE_MAX_RATIO, max_rounds=config.CHAT_MAX_RETRIES):
+        self.providers = list(providers)
+        self.client = client or get_client()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_max_ratio = hedge_max_ratio
+        self.max_rounds = max_rounds
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        # Attempts run on this pool so the caller can wait for whichever answers first
+        workers = 2 * sum(provider_limits(p.api_url)["max_concurrency"] for p in self.providers) + 4
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="router")
+
+    @classmethod
+    def from_config(cls, api_url, headers, model_name=None):
+        """
+        Router with the provider at 'api_url' (sent 'headers') first, followed by every other
+        configured chat model whose 'api_key_env' variable holds a key.
+        """
+        providers = []
+        for name, chat_model in config.DEFAULT_CHAT_MODELS.items():
+            if chat_model["api_url"] == api_url:
+                providers.insert(0, Provider(name, api_url, model_name or chat_model["model_name"], headers))
+                continue
+            key = os.environ.get(chat_model.get("api_key_env") or "")
+            if key:
+                provider_headers = dict(headers, Authorization=f"Bearer {key}")
+                providers.append(Provider(name, chat_model["api_url"], chat_model["model_name"], provider_headers))
+        if not providers or providers[0].api_url != api_url:
+            providers.insert(0, Provider("Custom endpoint", api_url, model_name, headers))
+        return cls(providers)
+
+    @contextmanager
+    def activate(self):
+        """Routes the chat requests made in this context (and in pools it dispatches to) through this router."""
+        token = CURRENT_ROUTER.set(self)
+        try:
+            yield self
+        finally:
+            CURRENT_ROUTER.reset(token)
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+    def handles(self, api_url):
+        return any(p.api_url == api_url for p in self.providers)
+
+    def provider(self, name):
+        """The provider called 'name', or None."""
+        return next((p for p in self.providers if p.name == name), None)
+
+    def ranked(self, exclude=()):
+        """Providers in the order they should be tried: available before cooling down, then by latency EWMA."""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [p for p in self.providers if p.name not in exclude]
+            # Providers without a latency yet count as fastest, so each one gets tried
+            return sorted(candidates, key=lambda p: (p.down_until > now, p.consecutive_failures > 0, p.ewma or 0.0))
+
+    def hedge_delay(self, provider):
+        """Seconds to wait for 'provider' before hedging: its recent latency percentile, within bounds."""
+        with self._lock:
+            samples = list(provider.latencies)
+        if len(samples) < config.ROUTING_MIN_SAMPLES:
+            return config.ROUTING_HEDGE_DEFAULT_DELAY
+        return max(config.ROUTING_HEDGE_MIN_DELAY, percentile(samples, self.hedge_percentile))
+
+    def _take_hedge(self):
+        """Whether one more hedge fits in the budget of ROUTING_HEDGE_MAX_RATIO of all requests."""
+        with self._lock:
+            if self.stats["hedges"] + 1 > max(1.0, self.hedge_max_ratio * self.stats["requests"]):
+                return False
+            self.stats["hedges"] += 1
+            return True
+
+    def _succeeded(self, provider, latency):
+        with self._lock:
+            provider.update_ewma(latency)
+            provider.latencies.append(latency)
+            provider.consecutive_failures = 0
+            provider.down_until = 0.0
+            provider.stats["ok"] += 1
+
+    def _failed(self, provider, latency):
+        with self._lock:
+            # Slow failures (timeouts) count against the latency; fast error replies do not make it look faster
+            if provider.ewma is None or latency > provider.ewma:
+                provider.update_ewma(latency)
+            provider.consecutive_failures += 1
+            if provider.consecutive_failures >= config.ROUTING_FAILURE_THRESHOLD:
+                provider.down_until = time.monotonic() + config.ROUTING_COOLDOWN_SECONDS
+            provider.stats["failed"] += 1
+
+    def _failure(self, provider, error, started):
+        """Turns a transport or HTTP error into ProviderFailure (recording it), or returns None when it must propagate."""
+        if isinstance(error, requests.HTTPError):
+            status = error.response.status_code if error.response is not None else None
+            if status not in FAILOVER_STATUSES:
+                return None
+            reason = f"HTTP {status}"
+        elif isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            reason = type(error).__name__
+        else:
+            return None
+        self._failed(provider, time.perf_counter() - started)
+        return ProviderFailure(f"{provider.name}: {reason}")
+
+    def _attempt(self, provider, payload, timeout):
+        with self._lock:
+            provider.stats["attempts"] += 1
+        started = time.perf_counter()
+        try:
+            reply = self.client.post(provider.api_url, provider.headers, dict(payload, model=provider.model_name),
+                                     timeout=timeout, max_retries=0)
+        except requests.RequestException as e:
+            failure = self._failure(provider, e, started)
+            if failure is None:
+                raise
+            raise failure from e
+        self._succeeded(provider, time.perf_counter() - started)
+        return reply
+
+    def _race(self, payload, timeout):
+        """One round: the best provider, a hedge after its latency threshold, failover on failures."""
+        tried, pending, failures = set(), {}, []
+        hedged = False
+
+        def launch(provider):
+            tried.add(provider.name)
+            future = self._pool.submit(contextvars.copy_context().run, self._attempt, provider, payload, timeout)
+            pending[future] = provider
+            return time.monotonic() + self.hedge_delay(provider)
+
+        first = self.ranked()[0]
+        hedge_at = launch(first)
+        while pending:
+            wait_for = max(0.0, hedge_at - time.monotonic()) if hedge_at is not None else None
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            if not done:
+                # Still no reply at the threshold: duplicate the request on the next provider
+                hedge_at = None
+                backup = next(iter(self.ranked(exclude=tried)), None)
+                if backup is not None and self._take_hedge():
+                    count("hedges")
+                    launch(backup)
+                    hedged = True
+                continue
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    reply = future.result()
+                except ProviderFailure as e:
+                    failures.append(str(e))
+                    if pending:
+                        continue  # a hedge is still in flight
+                    backup = next(iter(self.ranked(exclude=tried)), None)
+                    if backup is not None:
+                        count("failovers")
+                        with self._lock:
+                            self.stats["failovers"] += 1
+                        hedge_at = launch(backup)
+                    continue
+                if provider is not first:
+                    with self._lock:
+                        provider.stats["won"] += 1
+                        if hedged and not failures:
+                            self.stats["hedges_won"] += 1
+                return reply, provider.name
+        raise ProviderFailure("all providers failed: " + "; ".join(failures))
+
+    def post(self, payload, timeout=90):
+        """
+        Sends a chat payload through the providers and returns (decoded reply, provider name).
+        When every provider fails, the round is repeated with backoff up to 'max_rounds' times.
+        """
+        with self._lock:
+            self.stats["requests"] += 1
+        for attempt in range(self.max_rounds + 1):
+            try:
+                return self._race(payload, timeout)
+            except ProviderFailure:
+                if attempt == self.max_rounds:
+                    raise
+            time.sleep(min(config.CHAT_BACKOFF_MAX,
+                           config.CHAT_BACKOFF_BASE * 2 ** attempt + random.uniform(0, config.CHAT_BACKOFF_BASE)))
+
+    def stream(self, payload, timeout=90):
+        """
+        Streaming counterpart of post(), yielding (content_delta, finish_reason). Fails over
+        while no event has arrived yet; streamed replies are not hedged.
+        """
+        with self._lock:
+            self.stats["requests"] += 1
+        failures = []
+        for n, provider in enumerate(self.ranked()):
+            if n:
+                count("failovers")
+                with self._lock:
+                    self.stats["failovers"] += 1
+            with self._lock:
+                provider.stats["attempts"] += 1
+            started = time.perf_counter()
+            events = self.client.stream(provider.api_url, provider.headers, dict(payload, model=provider.model_name),
+                                        timeout=timeout, max_retries=0)
+            try:
+                first = next(events, None)
+            except requests.RequestException as e:
+                failure = self._failure(provider, e, started)
+                if failure is None:
+                    raise
+                failures.append(str(failure))
+                continue
+            ANSWERED_BY.set(provider.name)
+            if first is not None:
+                yield first
+            yield from events
+            self._succeeded(provider, time.perf_counter() - started)
+            return
+        raise ProviderFailure("all providers failed: " + "; ".join(failures))
+
+    def summary(self):
+        """Router totals plus one row per provider (attempts, outcomes, latency EWMA and p95, state)."""
+        now = time.monotonic()
+        with self._lock:
+            providers = []
+            for p in self.providers:
+                state = "cooling down" if p.down_until > now else "failing" if p.consecutive_failures else "healthy"
+                providers.append({
+                    "provider": p.name,
+                    "model": p.model_name,
+                    "attempts": p.stats["attempts"],
+                    "ok": p.stats["ok"],
+                    "failed": p.stats["failed"],
+                    "answers_as_backup": p.stats["won"],
+                    "ewma_latency_sec": round(p.ewma or 0.0, 3),
+                    "p95_latency_sec": round(percentile(list(p.latencies), 95), 3),
+                    "state": state,
+                })
+            totals = {key: self.stats[key] for key in ["requests", "hedges", "hedges_won", "failovers"]}
+        return dict(totals, providers=providers)
+
+
+
+def provider_columns(columns, api_url):
+    """'columns' plus PROVIDER_COLUMN while requests to 'api_url' go through a router."""
+    columns = list(columns)
+    if current_router(api_url) is not None and PROVIDER_COLUMN not in columns:
+        columns.append(PROVIDER_COLUMN)
+    return columns
+
+
+def show_routing_report(router):
+    """Streamlit summary of a routed run: hedges, failovers and one row per provider."""
+    import streamlit as st
+
+    summary = router.summary()
+    st.markdown("#### 🔀 Provider routing")
+    st.caption(f"{summary['requests']} requests · {summary['hedges']} hedged ({summary['hedges_won']} won by the hedge) · "
+               f"{summary['failovers']} failovers")
+    st.dataframe(summary["providers"])
@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import config
+
+
+def journal_path(stage, file_bytes, model_name):
+    """
+    Journal file for one stage run. Re-uploading the same CSV with the same
+    model maps to the same journal, which is what makes a run resumable.
+    """
+    digest = hashlib.sha256(file_bytes + model_name.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(config.RUNS_DIR, f"{stage}-{digest}.jsonl")
+
+
+class RunJournal:
+    """
+    Append-only JSONL log of completed groups: one line per group holding the
+    parsed sections returned for it. Lines are flushed to disk as soon as a group
+    finishes, so a crash or Streamlit rerun loses at most the group in flight.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def completed(self):
+        """Maps group key (as str) to its recorded sections, in the order they were written."""
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from an interrupted write; that group simply reruns
+                    continue
+                done[entry["group"]] = entry["sections"]
+        return done
+
+    def record(self, group_name, sections):
+        line = json.dumps({"group": str(group_name), "sections": sections, "ts": time.time()}, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def clear(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,404 @@
+import json
+
+import pandas as pd
+import requests
+
+import config
+from columnar import ListText
+from chat_client import (ANSWERED_BY, StreamedReply, answered_by, answered_cache_key, chat_completion, current_router,
+                         mark_cached, request_cache_key)
+from dedupe import input_key
+from dispatch import dispatch, provider_limits
+from instrumentation import count
+from json_stream import ArrayItemParser, repair_json
+from response_cache import get_cache
+from routing import PROVIDER_COLUMN
+from utils import estimate_tokens, iter_sentences, parse_json_reply, split_oversized, to_cell
+
+# Columns added for every thematic section returned by the model
+SECTION_COLUMNS = [
+    "SectionNumber", "ThemeTitle", "ThemeText", "ContextualQuestion",
+    "ThemeSummary", "Keywords", "Outline"
+]
+
+
+def section_fields(group_name, section):
+    """
+    Flattens one parsed section into the values of SECTION_COLUMNS (strings, never lists or
+    dicts). Keywords and Outline lists become ListText, which keeps the items for Parquet.
+    """
+    kw = section.get("Keywords", [])
+    ol = section.get("Outline", [])
+    return {
+        "SectionNumber": f"{group_name} - Section {section.get('SectionNumber', '')}",
+        "ThemeTitle": to_cell(section.get("ThemeTitle", "")),
+        "ThemeText": to_cell(section.get("ThemeText", "")),
+        "ContextualQuestion": to_cell(section.get("ContextualQuestion", "")),
+        "ThemeSummary": to_cell(section.get("ThemeSummary", "")),
+        "Keywords": ListText(kw, ", ") if isinstance(kw, list) else str(kw),
+        "Outline": ListText(ol, "; ") if isinstance(ol, list) else str(ol),
+    }
+
+
+class SectionBuilder:
+    """
+    Accumulates thematic sections column by column and builds the output frame once.
+
+    The base columns of a group are stored a single time per group; each section only
+    records which group it belongs to, and to_frame() expands them with one take().
+    This replaces growing a DataFrame with pd.concat per section, which is quadratic.
+    """
+
+    def __init__(self, base_columns):
+        self.base_columns = list(base_columns)
+        self._base_rows = []
+        self._base_index = []
+        self._columns = {col: [] for col in SECTION_COLUMNS}
+
+    def __len__(self):
+        return len(self._base_index)
+
+    def add_group(self, group_name, base_row, sections):
+        """
+        Adds all sections of one group. 'base_row' is the group's first input row.
+        Sections are validated before anything is stored, so a malformed reply
+        never leaves a half-added group behind.
+        """
+        rows = [section_fields(group_name, section) for section in sections]
+        return self._append(base_row, len(rows), {col: [row[col] for row in rows] for col in SECTION_COLUMNS})
+
+    def add_rows(self, base_row, section_rows):
+        """Adds already flattened section rows of one group (e.g. carried over from a previous output)."""
+        return self._append(base_row, len(section_rows), {col: section_rows[col].tolist() for col in SECTION_COLUMNS})
+
+    def _append(self, base_row, count, section_values):
+        if not count:
+            return 0
+        self._base_rows.append(tuple(base_row[col] for col in self.base_columns))
+        base_pos = len(self._base_rows) - 1
+        self._base_index.extend([base_pos] * count)
+        for col, values in self._columns.items():
+            values.extend(section_values[col])
+        return count
+
+    def to_frame(self):
+        base = pd.DataFrame(self._base_rows, columns=self.base_columns)
+        frame = base.take(self._base_index).reset_index(drop=True)
+        for col in SECTION_COLUMNS:
+            frame[col] = pd.Series(self._columns[col], dtype=object)
+        return frame
+
+    def flush(self):
+        """Returns the frame built so far and starts over; used to write sections out group by group."""
+        frame = self.to_frame()
+        self._base_rows = []
+        self._base_index = []
+        self._columns = {col: [] for col in SECTION_COLUMNS}
+        return frame
+
+
+def sections_payload(model_name, prompt):
+    return {
+        "model": model_name,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.4,
+        "max_tokens": 1200
+    }
+
+
+def request_sections(model_name, api_url, headers, prompt, use_cache=True):
+    """Sends one thematic-splitting prompt and returns the parsed list of sections."""
+    payload = sections_payload(model_name, prompt)
+    return chat_completion(api_url, headers, payload, timeout=90, use_cache=use_cache, parse=parse_json_reply)
+
+
+def continuation_prompt(prompt, sections):
+    """Asks only for the sections after the ones already received."""
+    last = sections[-1]
+    return (
+        f"{prompt}\n"
+        f"You already returned sections 1 to {len(sections)}, the last one titled "
+        f"\"{last.get('ThemeTitle', '')}\". Continue from there: return ONLY the remaining sections, "
+        f"starting with SectionNumber {len(sections) + 1}, as a JSON list."
+    )
+
+
+def stream_sections(model_name, api_url, headers, prompt, use_cache=True, on_section=None,
+                    max_continuations=config.STREAM_MAX_CONTINUATIONS):
+    """
+    Streaming counterpart of request_sections.
+
+    The reply is parsed incrementally and 'on_section(section)' is called as soon as
+    each section is complete. If the reply is cut off (max_tokens, dropped connection)
+    or its tail is malformed, only the missing sections are requested again, up to
+    'max_continuations' times; as a last resort a truncated final section is repaired.
+    Complete results are cached under the same key as request_sections.
+    """
+    payload = sections_payload(model_name, prompt)
+    cache = get_cache()
+    key = request_cache_key(api_url, payload) if use_cache and cache.enabled else None
+    cached = cache.get(key) if key else None
+    if key:
+        count("cache_hits" if cached is not None else "cache_misses")
+    if cached is not None:
+        mark_cached(api_url)
+        sections = parse_json_reply(cached)
+        for section in sections:
+            if on_section:
+                on_section(section)
+        return sections
+
+    sections = []
+    request_prompt = prompt
+    for attempt in range(max_continuations + 1):
+        parser = ArrayItemParser()
+        reply = StreamedReply(api_url, headers, sections_payload(model_name, request_prompt), timeout=90)
+        try:
+            for delta in reply:
+                for section in parser.feed(delta):
+                    sections.append(section)
+                    if on_section:
+                        on_section(section)
+        except requests.RequestException:
+            pass  # keep what arrived; the tail is requested again below
+
+        if parser.bad_items or not parser.complete:
+            count("parse_failures")
+        if parser.complete:
+            if key and not parser.bad_items:
+                cache.set(answered_cache_key(api_url, payload), json.dumps(sections, ensure_ascii=False))
+            return sections
+        if not parser.started and not sections:
+            # Not a list at all: let the usual parser explain what came back
+            return parse_json_reply(reply.text)
+        if not sections:
+            break
+        request_prompt = continuation_prompt(prompt, sections)
+
+    # Out of continuations: salvage the section that was being received, if it parses
+    try:
+        tail = repair_json(parser.partial_item())
+        if isinstance(tail, dict) and tail.get("ThemeText"):
+            sections.append(tail)
+            if on_section:
+                on_section(tail)
+    except json.JSONDecodeError:
+        pass
+    if not sections:
+        raise ValueError("No complete section in the streamed reply")
+    return sections
+
+
+def request_or_continue(model_name, api_url, headers, prompt, use_cache=True):
+    """
+    request_sections, falling back to stream_sections when the reply does not parse (most
+    often because it was cut off at max_tokens): that continues from the last complete
+    section and repairs a truncated tail instead of losing the whole reply.
+    """
+    try:
+        return request_sections(model_name, api_url, headers, prompt, use_cache)
+    except ValueError:
+        return stream_sections(model_name, api_url, headers, prompt, use_cache)
+
+
+def segment_commentary(commentary, max_tokens=config.SPLIT_SEGMENT_TOKENS):
+    """
+    Cuts commentary longer than 'max_tokens' (estimated) into as few segments as that
+    allows, of about equal size. Whole sentences are packed in order and paragraph breaks
+    are kept in the text. Shorter commentary is a single segment.
+    """
+    total = estimate_tokens(commentary)
+    if total <= max_tokens:
+        return [commentary]
+    # (sentence, tokens, ends_paragraph), with sentences longer than a segment cut at word boundaries
+    parts = []
+    for sentence, ends_paragraph in iter_sentences([commentary]):
+        pieces = [sentence] if estimate_tokens(sentence) <= max_tokens else list(
+            split_oversized(sentence, max_tokens, estimate_tokens))
+        for i, piece in enumerate(pieces, start=1):
+            parts.append((piece, estimate_tokens(piece), ends_paragraph and i == len(pieces)))
+
+    def pack(limit, count=None):
+        """
+        Greedy cut points for segments of at most 'limit' tokens. With 'count', a segment
+        also ends once it holds an equal share of what is left for the remaining segments.
+        """
+        cuts, tokens, remaining = [], 0, total_parts
+        for i, (_, cost, _) in enumerate(parts):
+            share = -(-remaining // (count - len(cuts))) if count and count > len(cuts) else limit
+            if tokens and (tokens + cost > limit or tokens >= share):
+                cuts.append(i)
+                remaining -= tokens
+                tokens = 0
+            tokens += cost
+        return cuts
+
+    # The fewest segments 'max_tokens' allows, then the smallest limit that still needs no more
+    # of them, filled in equal shares: segments of about equal size rather than full ones
+    # followed by a short remainder
+    total_parts = sum(cost for _, cost, _ in parts)
+    fewest = len(pack(max_tokens)) + 1
+    low, high = max(cost for _, cost, _ in parts), max_tokens
+    while low < high:
+        middle = (low + high) // 2
+        if len(pack(middle)) + 1 > fewest:
+            low = middle + 1
+        else:
+            high = middle
+    cuts = pack(low, fewest)
+    if len(cuts) + 1 > fewest:
+        cuts = pack(low)
+    segments = []
+    bounds = [0, *cuts, len(parts)]
+    for start, end in zip(bounds, bounds[1:]):
+        paragraphs = [[]]
+        for part, _, ends_paragraph in parts[start:end]:
+            paragraphs[-1].append(part)
+            if ends_paragraph:
+                paragraphs.append([])
+        segments.append("\n\n".join(" ".join(sentences) for sentences in paragraphs if sentences))
+    return segments
+
+
+def merge_segments(segment_sections):
+    """The sections of consecutive segments as one list, renumbered 1, 2, 3, ... in segment order."""
+    merged = []
+    for sections in segment_sections:
+        for section in sections:
+            merged.append(dict(section, SectionNumber=len(merged) + 1))
+    return merged
+
+
+def request_segments(model_name, api_url, headers, segments, build_prompt, use_cache=True, stream=False,
+                     max_workers=config.SPLIT_SEGMENT_WORKERS):
+    """
+    Splits every segment of one commentary in parallel and returns the merged sections.
+    Cut-off replies are continued and repaired (see stream_sections and request_or_continue).
+    A segment that still fails is left out ("failed_segments" in the run metrics) and the
+    sections of the others are kept; only when every segment fails is the first error raised.
+    With routing, the providers that answered are recorded together.
+    """
+    def split_segment(segment):
+        prompt = build_prompt(segment)
+        if stream:
+            sections = stream_sections(model_name, api_url, headers, prompt, use_cache)
+        else:
+            sections = request_or_continue(model_name, api_url, headers, prompt, use_cache)
+        return sections, answered_by()
+
+    workers = min(len(segments), max_workers, provider_limits(api_url)["max_concurrency"])
+    results, _ = dispatch(segments, split_segment, max_workers=workers)
+    count("segments", len(segments))
+    replies = [value for value, error in results if error is None]
+    if not replies:
+        raise results[0][1]
+    count("failed_segments", len(results) - len(replies))
+    if current_router(api_url) is not None:
+        ANSWERED_BY.set(", ".join(dict.fromkeys(provider for _, provider in replies if provider)))
+    return merge_segments(sections for sections, _ in replies)
+
+
+def split_groups(groups, builder, build_prompt, model_name, api_url, headers, use_cache=True,
+                 journal=None, writer=None, on_group=None, stream=False, on_section=None, manifest=None,
+                 plan=None, segment_tokens=None):
+    """
+    Splits the commentary of every (group_name, group_df) into thematic sections and adds
+    them to 'builder'. With a 'writer', each group's rows are flushed to disk right away.
+    Groups already recorded in 'journal' are restored from it instead of being requested,
+    and newly split groups are recorded there.
+
+    With a FingerprintManifest, groups whose prompt is unchanged since the previous output
+    are carried over from it instead of being requested; the caller saves the manifest.
+    With a dedupe.RequestPlan, a group whose prompt matches an earlier group's (after
+    normalization) gets that group's sections instead of a request of its own.
+
+    'on_group(group_name, status, sections, error)' is called after each group, with status
+    one of "split", "shared", "restored", "reused", "empty" (no commentary) or "failed".
+    Returns a count per status.
+    With 'stream', replies are streamed and 'on_section(group_name, section)' is called as
+    each section arrives. When the builder has a PROVIDER_COLUMN (routing), split groups
+    get the provider that answered.
+
+    With 'segment_tokens', commentary longer than that is cut into segments that are split
+    in parallel and merged (see request_segments); on_section then gets the merged sections
+    once all segments are done. Cut-off replies are then continued even without 'stream'.
+    """
+    completed = journal.completed() if journal else {}
+    previous = manifest.previous_output("Commentary Group") if manifest else None
+    if previous is not None and not all(col in previous.columns for col in SECTION_COLUMNS):
+        previous = None
+    counts = {"split": 0, "shared": 0, "restored": 0, "reused": 0, "empty": 0, "failed": 0}
+    for group_name, group_df in groups:
+        restored = completed.get(str(group_name))
+        commentary_series = group_df["English Commentary"].dropna().astype(str)
+        commentary = commentary_series.iloc[0] if not commentary_series.empty else ""
+
+        sections, error, provider = None, None, None
+        if not commentary:
+            status = "empty"
+        else:
+            prompt = build_prompt(commentary)
+            group_fingerprint = manifest.fingerprint(model_name, prompt) if manifest else None
+            try:
+                if restored is not None:
+                    sections = restored
+                    status = "restored"
+                elif previous is not None and manifest.unchanged(group_name, group_fingerprint) and group_name in previous:
+                    status = "reused"
+                else:
+                    def request():
+                        segments = segment_commentary(commentary, segment_tokens) if segment_tokens else [commentary]
+                        if len(segments) > 1:
+                            sections = request_segments(model_name, api_url, headers, segments, build_prompt,
+                                                        use_cache, stream)
+                            if on_section:
+                                for section in sections:
+                                    on_section(group_name, section)
+                            return sections
+                        if not stream:
+                            if segment_tokens:
+                                return request_or_continue(model_name, api_url, headers, prompt, use_cache)
+                            return request_sections(model_name, api_url, headers, prompt, use_cache)
+                        return stream_sections(
+                            model_name, api_url, headers, prompt, use_cache,
+                            on_section=(lambda section: on_section(group_name, section)) if on_section else None
+                        )
+
+                    def answered():
+                        # The provider travels with the sections, so groups sharing them record it too
+                        return request(), answered_by()
+
+                    shared = plan.share(input_key(prompt), group_name) if plan else None
+                    if shared is not None:
+                        sections, provider = shared.result()
+                        status = "shared"
+                    else:
+                        sections, provider = plan.run(input_key(prompt), answered) if plan else answered()
+                        status = "split"
+                base_row = group_df.iloc[0]
+                if PROVIDER_COLUMN in builder.base_columns:
+                    base_row = base_row.copy()
+                    if status in ("split", "shared") and current_router(api_url) is not None:
+                        base_row[PROVIDER_COLUMN] = provider
+                    elif PROVIDER_COLUMN not in group_df.columns:
+                        base_row[PROVIDER_COLUMN] = ""
+                if status == "reused":
+                    builder.add_rows(base_row, previous.rows(group_name))
+                else:
+                    builder.add_group(group_name, base_row, sections)
+                if writer:
+                    writer.write(builder.flush())
+                if status in ("split", "shared") and journal:
+                    journal.record(group_name, sections)
+                if manifest:
+                    manifest.record(group_name, group_fingerprint)
+            except Exception as e:
+                status, error = "failed", e
+
+        counts[status] += 1
+        count("items")
+        if on_group:
+            on_group(group_name, status, sections, error)
+    return counts
@@ -0,0 +1,110 @@
+import os
+
+import pandas as pd
+
+from columnar import ParquetStreamWriter, is_parquet, read_chunks
+
+
+def iter_csv_groups(source, group_col, chunksize=50_000, strip_columns=False):
+    """
+    Reads a CSV (or Parquet) file in chunks and yields (group_name, group_df) for each run of rows
+    sharing the same 'group_col' value, without loading the whole file.
+
+    The input must be sorted (or at least contiguous) by 'group_col'; a group that
+    reappears after another group started raises ValueError instead of silently
+    producing a split group. Rows with an empty group value are skipped, as
+    DataFrame.groupby does.
+    """
+    closed = set()
+    carry = None
+    for chunk in read_chunks(source, chunksize):
+        if strip_columns:
+            chunk.columns = chunk.columns.str.strip()
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        keys = chunk[group_col]
+        run_ids = keys.ne(keys.shift()).cumsum()
+        runs = [run for _, run in chunk.groupby(run_ids, sort=False)]
+        # The last run may continue in the next chunk, so hold it back
+        carry = runs.pop()
+        for run in runs:
+            group_name = run[group_col].iloc[0]
+            if pd.isna(group_name):
+                continue
+            if group_name in closed:
+                raise ValueError(
+                    f"CSV is not sorted by '{group_col}': group '{group_name}' appears again "
+                    "after other groups. Sort the file by this column or turn off streaming mode."
+                )
+            closed.add(group_name)
+            yield group_name, run
+    if carry is not None and not pd.isna(carry[group_col].iloc[0]):
+        group_name = carry[group_col].iloc[0]
+        if group_name in closed:
+            raise ValueError(f"CSV is not sorted by '{group_col}': group '{group_name}' appears again.")
+        yield group_name, carry
+
+
+def verify_sorted(source, group_col, chunksize=500_000):
+    """
+    Cheap pre-pass that reads only 'group_col' and raises ValueError if any group is
+    not contiguous, so an unsorted file is rejected before any paid requests are made.
+    Rewinds 'source' afterwards when it is a file object.
+    """
+    closed = set()
+    current = None
+    for chunk in read_chunks(source, chunksize, usecols=lambda c: c.strip() == group_col):
+        for key in chunk.iloc[:, 0].dropna():
+            if key == current:
+                continue
+            if key in closed:
+                raise ValueError(
+                    f"CSV is not sorted by '{group_col}': group '{key}' appears again "
+                    "after other groups. Sort the file by this column or turn off streaming mode."
+                )
+            if current is not None:
+                closed.add(current)
+            current = key
+    if hasattr(source, "seek"):
+        source.seek(0)
+
+
+class CsvStreamWriter:
+    """
+    Appends DataFrames to a CSV file on disk as they are produced. The header is
+    written once, from the first frame; later frames are aligned to its columns.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = None
+        self.rows = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "w", encoding="utf-8", newline="")
+
+    def write(self, frame):
+        if frame.empty:
+            return
+        if self.columns is None:
+            self.columns = list(frame.columns)
+            frame.to_csv(self._file, index=False)
+        else:
+            frame.reindex(columns=self.columns).to_csv(self._file, index=False, header=False)
+        self._file.flush()
+        self.rows += len(frame)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(path, group_col="Commentary Group"):
+    """Streaming writer for 'path': Parquet (row groups by 'group_col') for .parquet paths, CSV otherwise."""
+    if is_parquet(path):
+        return ParquetStreamWriter(path, group_col)
+    return CsvStreamWriter(path)
@@ -0,0 +1,39 @@
+"""
+Uploaded files, parsed once.
+
+Streamlit reruns the whole script on every widget change, and each rerun used to
+parse the uploaded CSV again. read_upload() parses a file the first time and
+memoizes the DataFrame with st.cache_data, keyed by a hash of the file's bytes,
+so later reruns (and other steps given the same file) get a copy without parsing.
+"""
+import functools
+import hashlib
+import io
+
+import streamlit as st
+
+import config
+from columnar import read_table
+
+
+def parse_upload(digest, name, columns, _data):
+    """
+    The parsed contents of an upload. 'digest' stands for the file's bytes in the cache
+    key; '_data' (the bytes themselves) is left out of it, so they are not hashed again.
+    """
+    source = io.BytesIO(_data)
+    source.name = name  # read_table tells CSV from Parquet by the name
+    return read_table(source, columns=list(columns) if columns else None)
+
+
+@functools.cache
+def cached_parse_upload():
+    # Wrapped on first use, inside a script run: the CLI imports the stage modules too, without a Streamlit runtime
+    return st.cache_data(max_entries=config.UPLOAD_CACHE_ENTRIES, show_spinner=False)(parse_upload)
+
+
+def read_upload(uploaded_file, columns=None):
+    """Reads an uploaded CSV or Parquet file into a DataFrame, parsing each distinct file only once."""
+    data = uploaded_file.getvalue()
+    digest = hashlib.sha256(data).hexdigest()
+    return cached_parse_upload()(digest, uploaded_file.name, tuple(columns) if columns else None, data)
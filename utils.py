@@ -1,4 +1,19 @@
 # 
+import json
+import re
+from collections import deque
+
+try:
+    import tiktoken
+except ImportError:  # optional: exact token counts for OpenAI encodings
+    tiktoken = None
+
+# Sentence ends (incl. Arabic/Urdu marks) followed by whitespace, or a blank line between paragraphs
+BOUNDARY = re.compile(r"(?<=[.!?\u061F\u06D4])\s+|\n\s*\n\s*")
+WORD = re.compile(r"\S+\s*")
+# Text without any sentence boundary is cut at whitespace once this many characters are pending
+MAX_PENDING_CHARS = 1 << 16
+
 
 def chunk_text_with_overlap(text, chunk_size=200, overlap_ratio=0.1):
     """
@@ -14,3 +29,126 @@ def chunk_text_with_overlap(text, chunk_size=200, overlap_ratio=0.1):
         chunks.append(" ".join(chunk))
         i += (chunk_size - overlap)
     return chunks
+
+
+def estimate_tokens(text):
+    """Fast local token estimate (~4 characters per token for English text)."""
+    return len(text) // 4 + 1
+
+
+def get_token_counter(encoding_name=None):
+    """
+    Returns a function text -> token count. With an encoding name (e.g. "cl100k_base") and
+    tiktoken installed the count is exact; otherwise the fast estimate is used.
+    """
+    if encoding_name and tiktoken is not None:
+        encoding = tiktoken.get_encoding(encoding_name)
+        return lambda text: len(encoding.encode_ordinary(text))
+    return estimate_tokens
+
+
+def iter_sentences(pieces):
+    """
+    Yields (sentence, ends_paragraph) from an iterable of text pieces (e.g. a file's lines).
+
+    Only the unfinished tail of the text is carried between pieces, so any input size is
+    read in one pass with memory bounded by the longest sentence.
+    """
+    carry = ""
+    for piece in pieces:
+        buffer = carry + piece
+        start = 0
+        for match in BOUNDARY.finditer(buffer):
+            if match.end() == len(buffer):
+                break  # the boundary may continue into the next piece
+            sentence = buffer[start:match.start()]
+            if sentence:
+                yield sentence, "\n" in match.group()
+            start = match.end()
+        while len(buffer) - start > MAX_PENDING_CHARS:
+            cut = buffer.rfind(" ", start, start + MAX_PENDING_CHARS) + 1 or start + MAX_PENDING_CHARS
+            yield buffer[start:cut].strip(), False
+            start = cut
+        carry = buffer[start:]
+    carry = carry.strip()
+    if carry:
+        yield carry, True
+
+
+def split_oversized(sentence, max_tokens, count_tokens):
+    """Word-boundary pieces of a single sentence longer than max_tokens."""
+    piece_start = 0
+    tokens = 0
+    for word in WORD.finditer(sentence):
+        cost = count_tokens(word.group())
+        if tokens and tokens + cost > max_tokens:
+            yield sentence[piece_start:word.start()].strip()
+            piece_start, tokens = word.start(), 0
+        tokens += cost
+    tail = sentence[piece_start:].strip()
+    if tail:
+        yield tail
+
+
+def iter_token_chunks(text, max_tokens=400, overlap_tokens=40, count_tokens=estimate_tokens):
+    """
+    Streaming, token-aware replacement for chunk_text_with_overlap.
+
+    'text' is a string or an iterable of strings (e.g. an open file). Chunks are built from
+    whole sentences up to 'max_tokens' (measured with 'count_tokens'); a chunk also ends at
+    a paragraph break once it is at least half full. Consecutive chunks within a paragraph
+    share up to 'overlap_tokens' of trailing sentences, which are kept as references rather
+    than re-sliced. Every sentence is counted once, so the whole pass is linear in the input.
+    """
+    pieces = [text] if isinstance(text, str) else text
+    window = deque()  # (sentence, tokens)
+    total = 0
+
+    def emit():
+        return " ".join(sentence for sentence, _ in window)
+
+    def keep_overlap():
+        nonlocal total
+        while window and total > overlap_tokens:
+            total -= window.popleft()[1]
+
+    for sentence, ends_paragraph in iter_sentences(pieces):
+        tokens = count_tokens(sentence)
+        parts = [(sentence, tokens)] if tokens <= max_tokens else [
+            (part, count_tokens(part)) for part in split_oversized(sentence, max_tokens, count_tokens)
+        ]
+        for part, cost in parts:
+            if window and total + cost > max_tokens:
+                yield emit()
+                keep_overlap()
+                # An overlap that leaves no room for the next sentence is dropped
+                if total + cost > max_tokens:
+                    window.clear()
+                    total = 0
+            window.append((part, cost))
+            total += cost
+        if ends_paragraph and total >= max_tokens // 2:
+            yield emit()
+            window.clear()
+            total = 0
+    if window:
+        yield emit()
+
+
+def to_cell(value):
+    """Value as stored in an output cell: lists and dicts become JSON text, anything else is kept."""
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def strip_code_fences(content):
+    """Removes markdown code fences (```json ... ```) around a model reply."""
+    return content.strip().replace("```json", "").replace("```", "").strip()
+
+
+def parse_json_reply(content):
+    """
+    Strips markdown code fences from a model reply and parses it as JSON.
+    """
+    return json.loads(strip_code_fences(content))